@@ -30,6 +30,7 @@
         'data/events.xml',
         'data/res_users.xml',
         'data/server.xml',
+        'data/caller_index.xml',
         # UI Views
         'views/assets.xml',
         'views/menu.xml',
@@ -44,6 +45,7 @@
         'views/call.xml',
         'views/channel.xml',
         'views/channel_message.xml',
+        'views/call_job.xml',
         'views/templates.xml',
         'views/tag.xml',
         'views/conf.xml',
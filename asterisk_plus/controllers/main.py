@@ -1,4 +1,6 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from contextlib import contextmanager
+import json
 import logging
 from odoo import http, SUPERUSER_ID, registry
 from odoo.api import Environment
@@ -10,61 +12,74 @@ logger = logging.getLogger(__name__)
 
 class AsteriskPlusController(http.Controller):
 
-    def check_ip(self, db=None):
+    @contextmanager
+    def _get_env(self, db=None):
+        """Environment of the request or of the passed database.
+        One cursor is used for the whole request.
+        """
         if db:
             with registry(db).cursor() as cr:
-                env = Environment(cr, SUPERUSER_ID, {})
-                allowed_ips = env[
-                    'asterisk_plus.settings'].sudo().get_param(
-                    'permit_ip_addresses')
+                yield Environment(cr, SUPERUSER_ID, {})
         else:
-            allowed_ips = http.request.env[
-                'asterisk_plus.settings'].sudo().get_param(
-                'permit_ip_addresses')
-        if allowed_ips:
-            remote_ip = http.request.httprequest.remote_addr
-            if remote_ip not in [
-                    k.strip(' ') for k in allowed_ips.split(',')]:
-                return BadRequest(
-                    'Your IP address {} is not allowed!'.format(remote_ip))
+            yield http.request.env
 
-    def _get_partner_by_number(self, db, number, country_code):
-        # If db is passed init env for this db
-        dst_partner_info = {'id': None}  # Defaults
-        if db:
-            try:
-                with registry(db).cursor() as cr:
-                    env = Environment(cr, SUPERUSER_ID, {})
-                    dst_partner_info = env[
-                        'res.partner'].sudo().get_partner_by_number(
-                        number, country_code)
-            except Exception:
-                logger.exception('Db init error:')
-                return BadRequest('Db error, check Odoo logs')
-        else:
-            dst_partner_info = http.request.env[
-                'res.partner'].sudo().get_partner_by_number(
-                number, country_code)
-        return dst_partner_info
+    def _check_ip(self, env):
+        remote_ip = http.request.httprequest.remote_addr
+        if not env['asterisk_plus.settings'].sudo().is_ip_permitted(remote_ip):
+            return BadRequest(
+                'Your IP address {} is not allowed!'.format(remote_ip))
 
     @http.route('/asterisk_plus/get_caller_name', type='http', auth='none')
     def get_caller_name(self, **kw):
         db = kw.get('db')
         try:
-            checked = self.check_ip(db=db)
-            if checked is not None:
-                return checked
-            number = kw.get('number', '').replace(' ', '')  # Strip spaces
+            with self._get_env(db) as env:
+                checked = self._check_ip(env)
+                if checked is not None:
+                    return checked
+                number = kw.get('number', '').replace(' ', '')  # Strip spaces
+                country_code = kw.get('country') or False
+                if not number:
+                    return BadRequest('Number not specified in request')
+                debug(http.request, 'CALLER NAME REQUEST FOR NUMBER {} country {}'.format(
+                    number, country_code))
+                dst_partner_info = env[
+                    'res.partner'].sudo().get_partner_by_number(
+                    number, country_code)
+                if dst_partner_info['id']:
+                    return dst_partner_info['name']
+                return ''
+        except Exception as e:
+            logger.exception('Error:')
+            if 'request not bound to a database' in str(e):
+                return 'db_not_specified'
+            elif 'database' in str(e) and 'does not exist' in str(e):
+                return 'db_not_exists'
+            else:
+                return 'Error'
+
+    @http.route('/asterisk_plus/get_caller_info', type='http', auth='none')
+    def get_caller_info(self, **kw):
+        """Caller name, manager channels, tags and reference for one or
+        many comma separated numbers in JSON.
+        """
+        db = kw.get('db')
+        try:
+            numbers = [k.replace(' ', '') for k in
+                       kw.get('number', '').split(',') if k.strip()]
             country_code = kw.get('country') or False
-            if not number:
+            if not numbers:
                 return BadRequest('Number not specified in request')
-            debug(http.request, 'CALLER NAME REQUEST FOR NUMBER {} country {}'.format(
-                number, country_code))
-            dst_partner_info = self._get_partner_by_number(
-                db, number, country_code)
-            if dst_partner_info['id']:
-                return dst_partner_info['name']
-            return ''
+            debug(http.request, 'CALLER INFO REQUEST FOR NUMBERS {} country {}'.format(
+                numbers, country_code))
+            with self._get_env(db) as env:
+                checked = self._check_ip(env)
+                if checked is not None:
+                    return checked
+                res = env['res.partner'].sudo().get_caller_info(
+                    numbers, country_code)
+            return http.Response(json.dumps(res),
+                                 content_type='application/json')
         except Exception as e:
             logger.exception('Error:')
             if 'request not bound to a database' in str(e):
@@ -78,33 +93,35 @@ class AsteriskPlusController(http.Controller):
     def get_partner_manager(self, **kw):
         db = kw.get('db')
         try:
-            checked = self.check_ip(db=db)
-            if checked is not None:
-                return checked
-            number = kw.get('number', '').replace(' ', '')  # Strip spaces
-            country_code = kw.get('country') or False
-            if not number:
-                return BadRequest('Number not specified in request')
-            dst_partner_info = self._get_partner_by_number(
-                db, number, country_code)
-            if dst_partner_info['id']:
-                # Partner found, get manager.
-                partner = http.request.env['res.partner'].sudo().browse(
-                    dst_partner_info['id'])
-                if partner.user_id:
+            with self._get_env(db) as env:
+                checked = self._check_ip(env)
+                if checked is not None:
+                    return checked
+                number = kw.get('number', '').replace(' ', '')  # Strip spaces
+                country_code = kw.get('country') or False
+                if not number:
+                    return BadRequest('Number not specified in request')
+                dst_partner_info = env[
+                    'res.partner'].sudo().get_partner_by_number(
+                    number, country_code)
+                if dst_partner_info['id']:
+                    # Partner found, get manager.
+                    partner = env['res.partner'].sudo().browse(
+                        dst_partner_info['id'])
+                    if partner.user_id:
 
-                    # We have sales person set let check if he has extension.
-                    if partner.user_id.asterisk_users:
-                        # We have user configured so let return his exten
-                        originate_channels = [
-                            k.name for k in partner.user_id.asterisk_users[0].channels
-                            if k.originate_enabled]
-                        result = '&'.join(originate_channels)
-                        logger.info(
-                            "Returning partner %s manager's channel %s",
-                            partner.name, result)
-                        return result
-            return ''
+                        # We have sales person set let check if he has extension.
+                        if partner.user_id.asterisk_users:
+                            # We have user configured so let return his exten
+                            originate_channels = [
+                                k.name for k in partner.user_id.asterisk_users[0].channels
+                                if k.originate_enabled]
+                            result = '&'.join(originate_channels)
+                            logger.info(
+                                "Returning partner %s manager's channel %s",
+                                partner.name, result)
+                            return result
+                return ''
         except Exception as e:
             logger.exception('Error:')
             if 'request not bound to a database' in str(e):
@@ -118,22 +135,24 @@ class AsteriskPlusController(http.Controller):
     def get_caller_tags(self, **kw):
         db = kw.get('db')
         try:
-            checked = self.check_ip(db=db)
-            if checked is not None:
-                return checked
-            number = kw.get('number', '').replace(' ', '')  # Strip spaces
-            country_code = kw.get('country') or False
-            if not number:
-                return BadRequest('Number not specified in request')
-            dst_partner_info = self._get_partner_by_number(
-                db, number, country_code)
-            if dst_partner_info['id']:
-                # Partner found, get manager.
-                partner = http.request.env['res.partner'].sudo().browse(
-                    dst_partner_info['id'])
-                if partner:
-                    return ','.join([k.name for k in partner.category_id])
-            return ''
+            with self._get_env(db) as env:
+                checked = self._check_ip(env)
+                if checked is not None:
+                    return checked
+                number = kw.get('number', '').replace(' ', '')  # Strip spaces
+                country_code = kw.get('country') or False
+                if not number:
+                    return BadRequest('Number not specified in request')
+                dst_partner_info = env[
+                    'res.partner'].sudo().get_partner_by_number(
+                    number, country_code)
+                if dst_partner_info['id']:
+                    # Partner found, get manager.
+                    partner = env['res.partner'].sudo().browse(
+                        dst_partner_info['id'])
+                    if partner:
+                        return ','.join([k.name for k in partner.category_id])
+                return ''
         except Exception as e:
             logger.exception('Error:')
             if 'request not bound to a database' in str(e):
@@ -0,0 +1,38 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+import logging
+from odoo import http, SUPERUSER_ID, registry
+from odoo.api import Environment
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
+from werkzeug.wrappers import Response
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingController(http.Controller):
+
+    @http.route('/asterisk_plus/recording/upload/<db>/<token>', type='http',
+                auth='none', methods=['POST', 'PUT'], csrf=False)
+    def upload_recording(self, db, token, **kw):
+        """Receive the raw recording file posted by the Agent.
+        The request body is copied to the filestore by chunks.
+        """
+        if not token:
+            return BadRequest('Token not specified in request')
+        remote_ip = http.request.httprequest.remote_addr
+        try:
+            with registry(db).cursor() as cr:
+                env = Environment(cr, SUPERUSER_ID, {})
+                if not env['asterisk_plus.settings'].is_ip_permitted(remote_ip):
+                    return Forbidden(
+                        'Your IP address {} is not allowed!'.format(remote_ip))
+                rec = env['asterisk_plus.recording'].search([
+                    ('upload_token', '=', token),
+                    ('state', '=', 'uploading')], limit=1)
+                if not rec:
+                    return NotFound('Recording not found')
+                rec.upload_file(http.request.httprequest.stream)
+        except Exception:
+            logger.exception('Recording upload error:')
+            return Response('Recording upload error, check Odoo logs',
+                            status=500)
+        return Response('OK', status=200)
@@ -1,6 +1,8 @@
 from . import event
 from . import call
 from . import call_event
+from . import call_job
+from . import caller_index
 from . import channel
 from . import channel_message
 from . import recording
@@ -62,14 +62,27 @@ class Call(models.Model):
         string=_('Call Duration'),
         compute='_get_duration_human')
 
-    @api.model
-    def create(self, vals):
-        # Reload after call is created
+    @api.model_create_multi
+    def create(self, vals_list):
+        # Reload after calls are created
         call = super(Call, self.with_context(
-            mail_create_nosubscribe=True, mail_create_nolog=True)).create(vals)
+            mail_create_nosubscribe=True, mail_create_nolog=True)).create(vals_list)
         self.reload_calls()
         return call
 
+    def write(self, vals):
+        res = super(Call, self).write(vals)
+        if 'is_active' in vals and not vals['is_active']:
+            # Post-process ended calls out of the Hangup event transaction.
+            self.env['asterisk_plus.call_job'].enqueue(
+                self, self._get_end_call_jobs())
+        return res
+
+    def _get_end_call_jobs(self):
+        """Inherit in other modules to add methods called when the call ends.
+        """
+        return ['register_call', 'register_reference_call', 'reload_on_hangup']
+
     def _get_recording_icon(self):
         for rec in self:
             if rec.recordings:
@@ -82,7 +95,6 @@ class Call(models.Model):
         """
         self.ensure_one()
 
-    @api.constrains('is_active')
     def reload_on_hangup(self):
         """Reloads active calls list view after hangup.
         """
@@ -235,7 +247,6 @@ class Call(models.Model):
         for rec in self:
             rec.duration_human = str(timedelta(seconds=rec.duration))
 
-    @api.constrains('is_active')
     def register_call(self):
         self.ensure_one()
         # Missed calls to users
@@ -285,7 +296,6 @@ class Call(models.Model):
                         'mail.mt_note'),
                 })
 
-    @api.constrains('is_active')
     def register_reference_call(self):
         self.ensure_one()
         for rec in self:
@@ -0,0 +1,103 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+import logging
+from odoo import models, fields, api, _
+from .settings import debug
+
+logger = logging.getLogger(__name__)
+
+#: Failed jobs are retried this number of times.
+MAX_ATTEMPTS = 3
+
+
+class CallJob(models.Model):
+    """Queue of call post-processing jobs (chatter messages, leads, etc).
+    Jobs are created on call end and processed by the cron in batches.
+    """
+    _name = 'asterisk_plus.call_job'
+    _description = 'Call Job'
+    _order = 'id'
+    _rec_name = 'method'
+
+    call = fields.Many2one('asterisk_plus.call', ondelete='cascade', required=True,
+                           readonly=True)
+    method = fields.Char(required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('failed', 'Failed')], default='pending', required=True, index=True)
+    attempts = fields.Integer()
+    error = fields.Text()
+
+    @api.model
+    def enqueue(self, calls, methods):
+        """Create jobs for the calls and wake up the cron.
+        """
+        self.sudo().create([{'call': call.id, 'method': method}
+                            for call in calls for method in methods])
+        self._trigger_cron()
+
+    @api.model
+    def _trigger_cron(self):
+        cron = self.env.ref('asterisk_plus.process_call_jobs',
+                            raise_if_not_found=False)
+        if cron and hasattr(cron, '_trigger'):
+            # Run the cron after commit instead of waiting for its interval.
+            cron.sudo()._trigger()
+
+    @api.model
+    def process_jobs(self, batch_size=100):
+        """Cron job to process pending call jobs.
+        """
+        # Only the methods called on call end can be queued.
+        allowed = self.env['asterisk_plus.call']._get_end_call_jobs()
+        # Jobs failed in this run are retried by the next run.
+        failed_ids = []
+        while True:
+            # Lock the batch so that concurrent workers take other jobs.
+            self.env.cr.execute("""
+                SELECT id FROM asterisk_plus_call_job
+                WHERE state = 'pending' AND NOT id = ANY(%s)
+                ORDER BY id LIMIT %s
+                FOR UPDATE SKIP LOCKED""", (failed_ids, batch_size))
+            jobs = self.browse([k[0] for k in self.env.cr.fetchall()])
+            if not jobs:
+                break
+            done = self.browse()
+            for job in jobs:
+                if job.method not in allowed:
+                    logger.error('Call %s job %s is not allowed.',
+                                 job.call.id, job.method)
+                    job.write({
+                        'attempts': job.attempts + 1,
+                        'error': 'Method {} is not allowed.'.format(job.method),
+                        'state': 'failed',
+                    })
+                    failed_ids.append(job.id)
+                    continue
+                try:
+                    with self.env.cr.savepoint():
+                        getattr(job.call, job.method)()
+                    done |= job
+                except Exception as e:
+                    logger.exception('Call %s job %s error:',
+                                     job.call.id, job.method)
+                    job.write({
+                        'attempts': job.attempts + 1,
+                        'error': str(e),
+                        'state': 'failed' if job.attempts + 1 >= MAX_ATTEMPTS
+                        else 'pending',
+                    })
+                    failed_ids.append(job.id)
+            debug(self, 'Processed {} of {} call jobs.'.format(
+                len(done), len(jobs)))
+            done.unlink()
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+            if len(jobs) < batch_size:
+                break
+        return True
+
+    def retry_button(self):
+        """Put failed jobs back to the queue.
+        """
+        self.write({'state': 'pending', 'attempts': 0, 'error': False})
+        self._trigger_cron()
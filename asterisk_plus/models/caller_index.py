@@ -0,0 +1,288 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+from collections import OrderedDict
+import logging
+import threading
+import time
+from psycopg2.extras import execute_values
+from odoo import models, fields, api, tools, _
+from .settings import debug
+
+logger = logging.getLogger(__name__)
+
+#: Max numbers kept in the unknown numbers cache per process.
+UNKNOWN_NUMBERS_SIZE = 10000
+#: Seconds to keep an unknown number.
+UNKNOWN_NUMBERS_TTL = 60
+#: Seconds between checks of the unknown numbers version shared by workers.
+#: Other workers see new partners created with a cached number after this
+#: time at most.
+VERSION_CHECK_INTERVAL = 1
+#: Sequence incremented when numbers are changed to invalidate the unknown
+#: numbers caches of all workers.
+VERSION_SEQUENCE = 'asterisk_plus_caller_index_version'
+
+
+class NumberCache:
+    """Bounded cache of (database, number) keys with expiration time.
+    The least recently added keys are dropped when the cache is full.
+    """
+    def __init__(self, size=UNKNOWN_NUMBERS_SIZE, ttl=UNKNOWN_NUMBERS_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        #: Database -> (version, monotonic time of the last check).
+        self._versions = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            expires = self._data.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._data[key]
+                return False
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = time.monotonic() + self.ttl
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def check_version(self, cr):
+        """Clear the cache if numbers were changed by other workers.
+        The database version is checked at most every VERSION_CHECK_INTERVAL.
+        """
+        now = time.monotonic()
+        with self._lock:
+            version, checked = self._versions.get(cr.dbname, (None, 0))
+        if now - checked < VERSION_CHECK_INTERVAL:
+            return
+        cr.execute('SELECT last_value, is_called FROM {}'.format(
+            VERSION_SEQUENCE))
+        last_value, is_called = cr.fetchone()
+        current = last_value if is_called else 0
+        with self._lock:
+            if version is not None and current != version:
+                self._data.clear()
+            self._versions[cr.dbname] = (current, now)
+
+
+#: Numbers that have no partner.
+unknown_numbers = NumberCache()
+
+#: Max partners fetched by the last digits of a number to check that
+#: the match is not ambiguous.
+SUFFIX_MATCH_LIMIT = 10
+
+
+def get_number_suffix(number, digits=None):
+    """Return reversed digits of the number, only the last digits if passed.
+    """
+    suffix = ''.join(k for k in reversed(number) if k.isdigit())
+    return suffix[:digits] if digits else suffix
+
+
+class CallerIndex(models.Model):
+    """Caller ID lookup table of normalized number -> resolved partner.
+    Kept up to date from partner phone_normalized / mobile_normalized changes.
+    """
+    _name = 'asterisk_plus.caller_index'
+    _description = 'Caller ID Index'
+    _log_access = False
+    _rec_name = 'number'
+
+    number = fields.Char(required=True, index=True)
+    partner = fields.Many2one('res.partner', ondelete='cascade', required=True)
+    name = fields.Char()
+    #: Reversed digits of the number to match numbers by their last digits.
+    suffix = fields.Char()
+
+    _sql_constraints = [
+        ('number_uniq', 'unique (number)', _('This number is already indexed!')),
+    ]
+
+    def init(self):
+        self.env.cr.execute(
+            'CREATE SEQUENCE IF NOT EXISTS {}'.format(VERSION_SEQUENCE))
+        if not tools.index_exists(self.env.cr, 'asterisk_plus_caller_index_suffix_index'):
+            self.env.cr.execute("""
+                CREATE INDEX asterisk_plus_caller_index_suffix_index
+                ON asterisk_plus_caller_index (suffix text_pattern_ops)""")
+
+    @api.model
+    def rebuild(self):
+        """Build the index from scratch. Called on module install.
+
+        Numbers of a single partner are indexed with one query. Numbers
+        shared by many partners are resolved by search_by_numbers.
+        """
+        numbers_query = """
+            WITH numbers AS (
+                SELECT phone_normalized AS number, id FROM res_partner
+                    WHERE phone_normalized IS NOT NULL AND active = true
+                UNION
+                SELECT mobile_normalized, id FROM res_partner
+                    WHERE mobile_normalized IS NOT NULL AND active = true)"""
+        self.env.cr.execute('DELETE FROM asterisk_plus_caller_index')
+        self.env.cr.execute(numbers_query + """,
+            single AS (
+                SELECT number, min(id) AS partner FROM numbers
+                GROUP BY number HAVING count(*) = 1)
+            INSERT INTO asterisk_plus_caller_index (number, partner, name, suffix)
+            SELECT single.number, partner.id,
+                CASE WHEN parent.name IS NOT NULL
+                    THEN partner.name || ' (' || parent.name || ')'
+                    ELSE partner.name END,
+                reverse(regexp_replace(single.number, '\D', '', 'g'))
+            FROM single
+            JOIN res_partner partner ON partner.id = single.partner
+            LEFT JOIN res_partner parent ON parent.id = partner.parent_id""")
+        count = self.env.cr.rowcount
+        self.env.cr.execute(numbers_query + """
+            SELECT number FROM numbers GROUP BY number HAVING count(*) > 1""")
+        shared = [k[0] for k in self.env.cr.fetchall()]
+        self.update_numbers(shared)
+        logger.info('Caller ID index built for %s numbers.',
+                    count + len(shared))
+
+    @api.model
+    def update_numbers(self, numbers):
+        """Resolve partners for the numbers and store them in the index.
+        """
+        numbers = {k for k in numbers if k}
+        if not numbers:
+            return
+        self._forget_unknown(numbers)
+        Partner = self.env['res.partner'].sudo().with_context(active_test=True)
+        partners = Partner.search_by_numbers(numbers)
+        removed = [k for k in numbers if not partners.get(k)]
+        if removed:
+            self.env.cr.execute(
+                'DELETE FROM asterisk_plus_caller_index WHERE number IN %s',
+                (tuple(removed),))
+        rows = []
+        for number, partner in partners.items():
+            if not partner:
+                continue
+            if partner.parent_name:
+                name = u'{} ({})'.format(partner.name, partner.parent_name)
+            else:
+                name = partner.name
+            rows.append((number, partner.id, name, get_number_suffix(number)))
+        if rows:
+            execute_values(self.env.cr, """
+                INSERT INTO asterisk_plus_caller_index (number, partner, name, suffix)
+                VALUES %s
+                ON CONFLICT (number) DO UPDATE
+                SET partner = EXCLUDED.partner, name = EXCLUDED.name""", rows)
+        self.invalidate_cache()
+
+    @api.model
+    def lookup(self, numbers):
+        """Find partner by the first indexed number from the list.
+
+        If no number is indexed and suffix matching is enabled in settings,
+        the partner is matched by the last digits of the first number,
+        e.g. 02083661171 matches +442083661171. Numbers with the same last
+        digits of different partners do not match.
+
+        Args:
+            numbers (list): numbers to look for in order of preference.
+
+        Returns:
+            (partner ID, name) tuple or None.
+        """
+        numbers = [k for k in numbers if k]
+        if not numbers:
+            return None
+        dbname = self.env.cr.dbname
+        unknown_numbers.check_version(self.env.cr)
+        if all((dbname, k) in unknown_numbers for k in numbers):
+            debug(self, 'CALLER INDEX UNKNOWN NUMBERS {}'.format(numbers))
+            return None
+        digits = self.env['asterisk_plus.settings'].sudo().get_param(
+            'caller_id_suffix_digits')
+        suffix = get_number_suffix(numbers[0], digits) if digits else ''
+        if suffix and len(suffix) >= digits:
+            # Exact matches come first, suffix matches are bounded by limit.
+            self.env.cr.execute("""
+                SELECT number, partner, name FROM asterisk_plus_caller_index
+                WHERE number IN %s OR suffix LIKE %s
+                ORDER BY number IN %s DESC
+                LIMIT %s""", (tuple(numbers), suffix + '%', tuple(numbers),
+                              len(numbers) + SUFFIX_MATCH_LIMIT))
+        else:
+            suffix = None
+            self.env.cr.execute("""
+                SELECT number, partner, name FROM asterisk_plus_caller_index
+                WHERE number IN %s""", (tuple(numbers),))
+        rows = self.env.cr.fetchall()
+        found = {k[0]: (k[1], k[2]) for k in rows}
+        debug(self, 'CALLER INDEX LOOKUP {}: {}'.format(numbers, found))
+        for number in numbers:
+            if number in found:
+                return found[number]
+        if suffix and len({k[1] for k in rows}) == 1:
+            debug(self, 'CALLER INDEX SUFFIX MATCH {}: {}'.format(
+                suffix, rows[0][0]))
+            return rows[0][1], rows[0][2]
+        for number in numbers:
+            unknown_numbers.add((dbname, number))
+        return None
+
+    @api.model
+    def clear_unknown(self):
+        unknown_numbers.clear()
+        self._bump_version_on_commit()
+
+    @api.model
+    def _forget_unknown(self, numbers, cache=unknown_numbers):
+        """Evict numbers from the unknown numbers cache.
+        Numbers are evicted again after commit as a concurrent lookup can
+        cache them until the change is committed. Other workers clear their
+        caches when they see the new version after commit.
+        """
+        keys = {(self.env.cr.dbname, k) for k in numbers if k}
+        if not keys:
+            return
+        for key in keys:
+            cache.discard(key)
+        # One callback per cache evicts all the numbers of the transaction.
+        data = self.env.cr.postcommit.data
+        data_key = ('asterisk_plus.forget_unknown', id(cache))
+        if data_key not in data:
+            data[data_key] = set()
+
+            def forget(pending=data[data_key]):
+                for key in pending:
+                    cache.discard(key)
+
+            self.env.cr.postcommit.add(forget)
+        data[data_key].update(keys)
+        self._bump_version_on_commit()
+
+    @api.model
+    def _bump_version_on_commit(self):
+        data = self.env.cr.postcommit.data
+        if VERSION_SEQUENCE not in data:
+            data[VERSION_SEQUENCE] = True
+            self.env.cr.postcommit.add(self._bump_version)
+
+    @api.model
+    def _bump_version(self):
+        # Sequences are not transactional, it is visible to others at once.
+        self.env.cr.execute("SELECT nextval('{}')".format(VERSION_SEQUENCE))
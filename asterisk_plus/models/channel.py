@@ -1,7 +1,10 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import json
 import logging
+import threading
+import time
 from odoo import models, fields, api, _
 from odoo.exceptions import ValidationError
 from .server import debug
@@ -9,6 +12,70 @@ from .server import debug
 
 logger = logging.getLogger(__name__)
 
+#: Call status set by the Hangup cause of the primary channel.
+HANGUP_CALL_STATUS = {
+    '16': 'answered',
+    '17': 'busy',
+    '19': 'noanswer',
+}
+
+
+def get_channel_short(channel):
+    """Makes SIP/1001-000000bd to be SIP/1001."""
+    return '-'.join(channel.split('-')[:-1])
+
+
+class ActiveChannelIndex(object):
+    """Process wide index of live channels.
+
+    Entries are kept per (database, server) key and map a channel Uniqueid
+    to a (channel id, call id, linkedid, created) tuple where created is the
+    channel creation time. Entries of channels older than ``max_age``
+    seconds are dropped as vacuum() may have removed them. Every worker has
+    its own index so callers must check that the records still exist.
+    """
+
+    def __init__(self, max_age=24 * 3600):
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._data = {}
+
+    def is_loaded(self, key):
+        return key in self._data
+
+    def load(self, key, entries):
+        """Entries are (uniqueid, channel id, call id, linkedid, created)."""
+        with self._lock:
+            self._data[key] = {k[0]: tuple(k[1:]) for k in entries}
+
+    def get(self, key, uniqueid):
+        with self._lock:
+            entry = self._data.get(key, {}).get(uniqueid)
+            if entry and time.time() - entry[3] > self.max_age:
+                del self._data[key][uniqueid]
+                return None
+            return entry
+
+    def add(self, key, uniqueid, channel_id, call_id, linkedid):
+        with self._lock:
+            self._data.setdefault(key, {})[uniqueid] = (
+                channel_id, call_id, linkedid, time.time())
+
+    def discard(self, key, uniqueid):
+        with self._lock:
+            self._data.get(key, {}).pop(uniqueid, None)
+
+    def clear(self, key=None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+
+#: Active channels of all databases served by this process.
+active_channels = ActiveChannelIndex()
+
 
 class Channel(models.Model):
     _name = 'asterisk_plus.channel'
@@ -77,7 +144,7 @@ class Channel(models.Model):
     def _get_channel_short(self):
         # Makes SIP/1001-000000bd to be SIP/1001.
         for rec in self:
-            rec.channel_short = '-'.join(rec.channel.split('-')[:-1])
+            rec.channel_short = get_channel_short(rec.channel)
 
     def _get_parent_channel(self):
         for rec in self:
@@ -171,38 +238,9 @@ class Channel(models.Model):
             logger.exception('Update call reference error:')
 
     ########################### AMI Event handlers ############################
-    @api.model
-    def on_ami_new_channel(self, event):
-        """AMI NewChannel event is processed to create a new channel in Odoo.
-        """
-        debug(self, json.dumps(event, indent=2))
-        # Create a call for the primary channel.
-        if event['Uniqueid'] == event['Linkedid']:
-            # Check if call already exists
-            call = self.env['asterisk_plus.call'].search(
-                [('uniqueid', '=', event['Uniqueid'])], limit=1)
-            if not call:                
-                call = self.env['asterisk_plus.call'].create({
-                    'uniqueid': event['Uniqueid'],
-                    'calling_number': event['CallerIDNum'],
-                    'called_number': event['Exten'],
-                    'started': datetime.now(),
-                    'is_active': True,
-                    'status': 'progress',
-                    'server': self.env.user.asterisk_server.id,
-                })
-        else:
-            # There is already a parent channel and the call
-            call = self.env['asterisk_plus.call'].search(
-                [('uniqueid', '=', event['Linkedid'])], limit=1)
-        # Match channel owner
-        user_channel = self.env['asterisk_plus.user_channel'].get_user_channel(
-            event['Channel'], event['SystemName'])            
-        data = {
-            'call': call.id,
-            'user': user_channel.user.id,
+    def _get_new_channel_data(self, event):
+        return {
             'event': event['Event'],
-            'server': self.env.user.asterisk_server.id,
             'channel': event['Channel'],
             'state': event['ChannelState'],
             'state_desc': event['ChannelStateDesc'],
@@ -219,29 +257,10 @@ class Channel(models.Model):
             'linkedid': event['Linkedid'],
             'system_name': event['SystemName'],
         }
-        channel = self.env['asterisk_plus.channel'].search([('uniqueid', '=', event['Uniqueid'])])
-        if not channel:
-            channel = self.create(data)
-        else:
-            channel.write(data)
-        # Update call based on channel.
-        channel.update_call_data()
-        self.reload_channels()
-        if self.env['asterisk_plus.settings'].sudo().get_param('trace_ami'):
-            data['channel_id'] = channel.id
-            self.env['asterisk_plus.channel_message'].create_from_event(channel, event)
-        return channel.id
 
-    @api.model
-    def on_ami_update_channel_state(self, event):
-        """AMI Newstate event. Write call status and ansered time,
-            create channel message and call event log records.
-            Processed when channel's state changes.
-        """
-        debug(self, json.dumps(event, indent=2))
+    def _get_channel_state_data(self, event):
         get = event.get
-        data = {
-            'server': self.env.user.asterisk_server.id,
+        return {
             'channel': get('Channel'),
             'uniqueid': get('Uniqueid'),
             'linkedid': get('Linkedid'),
@@ -260,38 +279,9 @@ class Channel(models.Model):
             'language': get('Language'),
             'event': get('Event'),
         }
-        channel = self.env['asterisk_plus.channel'].search([('uniqueid', '=', get('Uniqueid'))], limit=1)
-        if not channel:
-            channel = self.create(data)
-        else:
-            channel.write(data)
-        if self.env['asterisk_plus.settings'].sudo().get_param('trace_ami'):
-            data['channel_id'] = channel.id
-            self.env['asterisk_plus.channel_message'].create_from_event(channel, event)
-        if get('ChannelStateDesc') == 'Up':
-            channel.call.write({
-                'status': 'answered',
-                'answered': datetime.now(),
-            })
-        self.env['asterisk_plus.call_event'].create({
-            'call': channel.call.id,
-            'create_date': datetime.now(),
-            'event': 'Channel {} status is {}'.format(channel.channel_short, get('ChannelStateDesc')),
-        })
-        return channel
 
-    @api.model
-    def on_ami_hangup(self, event):
-        """AMI Hangup event.
-        """
-        debug(self, json.dumps(event, indent=2))            
-        # TODO: Limit search domain by create_date less then one day.
-        channel = self.env['asterisk_plus.channel'].search([('uniqueid', '=', event['Uniqueid'])])
-        if not channel:
-            debug(self, 'Channel {} not found for hangup.'.format(event['Channel']))
-            return False
-        debug(self, 'Found {} channel(s) {}'.format(len(channel), event['Channel']))
-        data = {
+    def _get_hangup_data(self, event):
+        return {
             'event': event['Event'],
             'channel': event['Channel'],
             'state': event['ChannelState'],
@@ -311,35 +301,306 @@ class Channel(models.Model):
             'cause': event['Cause'],
             'cause_txt': event['Cause-txt'],
         }
-        channel.write(data)
-        # Set call status by the originated channel
-        if event['Uniqueid'] == event['Linkedid']:
-            if channel.cause == '16':
-                call_status = 'answered'
-            elif channel.cause == '17':
-                call_status = 'busy'
-            elif channel.cause == '19':
-                call_status = 'noanswer'
+
+    @api.model
+    def on_ami_events(self, events):
+        """Process a batch of AMI channel events in one transaction.
+
+        Newchannel, Newstate, Hangup and VarSet events are grouped by
+        Linkedid and applied in the order received. Calls, channels and
+        call events are created in bulk and every channel and call is
+        written only once with the merged values of all its events.
+
+        Args:
+            events (list): AMI events as received from Asterisk.
+
+        Returns:
+            A list with a channel ID (or False) for every event.
+        """
+        debug(self, json.dumps(events, indent=2))
+        server_id = self.env.user.asterisk_server.id
+        trace_ami = self.env['asterisk_plus.settings'].sudo().get_param(
+            'trace_ami')
+        coalesce_states = self.env['asterisk_plus.event'].is_coalesced(
+            'Newstate', self._name)
+        # Group events by call keeping the order of arrival.
+        groups = OrderedDict()
+        for pos, event in enumerate(events):
+            groups.setdefault(
+                event.get('Linkedid') or event.get('Uniqueid'),
+                []).append((pos, event))
+        # Prefetch channels and calls of the batch with one search each.
+        uniqueids = {k.get('Uniqueid') for k in events if k.get('Uniqueid')}
+        linkedids = {k.get('Linkedid') for k in events if k.get('Linkedid')}
+        channels = self._get_active_channels(uniqueids)
+        calls = self._get_active_calls(linkedids | uniqueids)
+        # Create calls for the new primary channels.
+        new_calls = OrderedDict()
+        for linkedid, group in groups.items():
+            for pos, event in group:
+                if event['Event'] == 'Newchannel' and \
+                        event['Uniqueid'] == event['Linkedid'] and \
+                        event['Uniqueid'] not in calls and \
+                        event['Uniqueid'] not in new_calls:
+                    new_calls[event['Uniqueid']] = {
+                        'uniqueid': event['Uniqueid'],
+                        'calling_number': event['CallerIDNum'],
+                        'called_number': event['Exten'],
+                        'started': datetime.now(),
+                        'is_active': True,
+                        'status': 'progress',
+                        'server': server_id,
+                    }
+        if new_calls:
+            created = self.env['asterisk_plus.call'].create(
+                list(new_calls.values()))
+            calls.update(zip(new_calls.keys(), created))
+        # Create the new channels.
+        new_channels = OrderedDict()
+        channel_events = []
+        for linkedid, group in groups.items():
+            for pos, event in group:
+                if event['Event'] != 'Newchannel':
+                    continue
+                user_id = self.env[
+                    'asterisk_plus.user_channel']._resolve_channel(
+                    event['Channel'], event['SystemName'])[1]
+                data = self._get_new_channel_data(event)
+                data.update({
+                    'call': calls.get(event['Linkedid'],
+                                      self.env['asterisk_plus.call']).id,
+                    'user': user_id,
+                    'server': server_id,
+                })
+                if event['Uniqueid'] in channels:
+                    channels[event['Uniqueid']].write(data)
+                else:
+                    new_channels[event['Uniqueid']] = data
+                channel_events.append(event['Uniqueid'])
+        if new_channels:
+            created = self.create(list(new_channels.values()))
+            channels.update(zip(new_channels.keys(), created))
+        # Update call data for the channels in their order of appearance.
+        for uniqueid in OrderedDict.fromkeys(channel_events):
+            channels[uniqueid].update_call_data()
+        # Apply the rest of the events merging values per channel and call.
+        channel_vals = OrderedDict()
+        call_vals = OrderedDict()
+        call_events = []
+        # Channel -> (call event values, state transitions) when coalesced.
+        state_events = {}
+        hangups = []
+        result = [False] * len(events)
+        for linkedid, group in groups.items():
+            for pos, event in group:
+                name = event.get('Event')
+                uniqueid = event.get('Uniqueid')
+                channel = channels.get(uniqueid)
+                if name == 'Newchannel':
+                    result[pos] = channel.id
+                elif name == 'Newstate':
+                    data = self._get_channel_state_data(event)
+                    data['server'] = server_id
+                    if not channel:
+                        channel = self.create(data)
+                        channels[uniqueid] = channel
+                    else:
+                        channel_vals.setdefault(channel, {}).update(data)
+                    if event.get('ChannelStateDesc') == 'Up':
+                        call_vals.setdefault(channel.call, {}).update({
+                            'status': 'answered',
+                            'answered': datetime.now(),
+                        })
+                    state_desc = event.get('ChannelStateDesc')
+                    if coalesce_states and channel in state_events:
+                        # Record the transition in the existing log entry.
+                        entry, transitions = state_events[channel]
+                        transitions.append(state_desc)
+                        entry['event'] = 'Channel {} status is {}'.format(
+                            get_channel_short(data['channel'] or ''),
+                            ' -> '.join(transitions))
+                    else:
+                        entry = {
+                            'call': channel.call.id,
+                            'create_date': datetime.now(),
+                            'event': 'Channel {} status is {}'.format(
+                                get_channel_short(data['channel'] or ''),
+                                state_desc),
+                        }
+                        call_events.append(entry)
+                        state_events[channel] = (entry, [state_desc])
+                    result[pos] = channel.id
+                elif name == 'Hangup':
+                    if not channel:
+                        debug(self, 'Channel {} not found for hangup.'.format(
+                            event['Channel']))
+                        continue
+                    channel_vals.setdefault(channel, {}).update(
+                        self._get_hangup_data(event))
+                    # Set call status by the originated channel
+                    if event['Uniqueid'] == event['Linkedid']:
+                        call_vals.setdefault(channel.call, {}).update({
+                            'status': HANGUP_CALL_STATUS.get(
+                                event['Cause'], 'failed'),
+                            'is_active': False,
+                            'ended': datetime.now(),
+                        })
+                    call_events.append({
+                        'call': channel.call.id,
+                        'create_date': datetime.now(),
+                        'event': 'Channel {} hangup'.format(
+                            get_channel_short(event['Channel'])),
+                    })
+                    hangups.append((channel, event))
+                    result[pos] = channel.id
+                elif name == 'VarSet':
+                    if event.get('Variable') != 'MIXMONITOR_FILENAME':
+                        continue
+                    if channel:
+                        channel_vals.setdefault(channel, {}).update({
+                            'recording_file_path': event['Value']})
+                    result[pos] = True
+                else:
+                    logger.warning('Unsupported AMI event in batch: %s', name)
+                    continue
+                if trace_ami and channel:
+                    self.env[
+                        'asterisk_plus.channel_message'].create_from_event(
+                        channel, event)
+        for channel, data in channel_vals.items():
+            channel.write(data)
+        for call, data in call_vals.items():
+            if call:
+                call.write(data)
+        call_events = [k for k in call_events if k['call']]
+        if call_events:
+            self.env['asterisk_plus.call_event'].create(call_events)
+        for uniqueid in channel_events:
+            channel = channels[uniqueid]
+            self._index_active_channel(
+                uniqueid, channel.id, channel.call.id, channel.linkedid)
+        for channel, event in hangups:
+            self._unindex_active_channel(channel.uniqueid)
+            self._on_ami_hangup_done(channel, event)
+        if channel_events or hangups:
+            self.reload_channels()
+        return result
+
+    ########################### Active channels index #########################
+    def _active_channels_key(self):
+        return (self.env.cr.dbname, self.env.user.asterisk_server.id)
+
+    def _load_active_channels(self, key):
+        """Rebuild the active channels index of the server from the DB.
+        """
+        self.env.cr.execute("""
+            SELECT ch.uniqueid, ch.id, ch.call, ch.linkedid,
+                extract(epoch from ch.create_date)::float
+            FROM asterisk_plus_channel ch
+            JOIN asterisk_plus_call c ON c.id = ch.call
+            WHERE c.is_active = true AND ch.hangup_date IS NULL
+                AND ch.uniqueid IS NOT NULL AND ch.server = %s
+                AND ch.create_date >= now() at time zone 'utc' - %s * interval '1 second'
+            ORDER BY ch.id""", (key[1], active_channels.max_age))
+        active_channels.load(key, self.env.cr.fetchall())
+        debug(self, 'Loaded active channels for server {}.'.format(key[1]))
+
+    def _get_active_channels(self, uniqueids):
+        """Resolve channels by their Uniqueid using the active channels index.
+        Returns:
+            A dictionary of uniqueid -> channel. Channels missing in the
+            index are searched in the database.
+        """
+        key = self._active_channels_key()
+        if not active_channels.is_loaded(key):
+            self._load_active_channels(key)
+        res, missing = {}, []
+        for uniqueid in uniqueids:
+            entry = active_channels.get(key, uniqueid)
+            if entry:
+                res[uniqueid] = entry[0]
             else:
-                call_status = 'failed'
-            channel.call.write({
-                'status': call_status,
-                'is_active': False,
-                'ended': datetime.now(),
-            })
-        # Create hangup event
-        self.env['asterisk_plus.call_event'].create({
-            'call': channel.call.id,
-            'create_date': datetime.now(),
-            'event': 'Channel {} hangup'.format(channel.channel_short),
-        })
-        self.reload_channels()
-        if self.env['asterisk_plus.settings'].sudo().get_param('trace_ami'):
-            # Remove and add fields according to the message
-            data['channel_id'] = channel.id
-            self.env['asterisk_plus.channel_message'].create_from_event(channel, event)
+                missing.append(uniqueid)
+        # Channels may be removed by another worker.
+        existing = set(self.browse(list(res.values())).exists().ids)
+        for uniqueid, channel_id in list(res.items()):
+            if channel_id in existing:
+                res[uniqueid] = self.browse(channel_id)
+            else:
+                del res[uniqueid]
+                active_channels.discard(key, uniqueid)
+                missing.append(uniqueid)
+        if missing:
+            # Channels are ordered by id desc so the latest channel wins.
+            for channel in self.search([('uniqueid', 'in', missing)]):
+                res.setdefault(channel.uniqueid, channel)
+        return res
+
+    def _get_active_calls(self, uniqueids):
+        """Resolve calls by the Uniqueid of their primary channel.
+        """
+        key = self._active_channels_key()
+        Call = self.env['asterisk_plus.call']
+        res, missing = {}, []
+        for uniqueid in uniqueids:
+            entry = active_channels.get(key, uniqueid)
+            if entry and entry[1] and entry[2] == uniqueid:
+                res[uniqueid] = entry[1]
+            else:
+                missing.append(uniqueid)
+        existing = set(Call.browse(list(res.values())).exists().ids)
+        for uniqueid, call_id in list(res.items()):
+            if call_id in existing:
+                res[uniqueid] = Call.browse(call_id)
+            else:
+                del res[uniqueid]
+                missing.append(uniqueid)
+        if missing:
+            for call in Call.search(
+                    [('uniqueid', 'in', missing)]):
+                res.setdefault(call.uniqueid, call)
+        return res
+
+    @api.model
+    def _get_active_channel(self, uniqueid):
+        return self._get_active_channels([uniqueid]).get(
+            uniqueid, self.browse())
+
+    def _index_active_channel(self, uniqueid, channel_id, call_id, linkedid):
+        # Update the index only when the transaction is committed.
+        key = self._active_channels_key()
+        self.env.cr.postcommit.add(lambda: active_channels.add(
+            key, uniqueid, channel_id, call_id, linkedid))
+
+    def _unindex_active_channel(self, uniqueid):
+        key = self._active_channels_key()
+        self.env.cr.postcommit.add(
+            lambda: active_channels.discard(key, uniqueid))
+
+    def _on_ami_hangup_done(self, channel, event):
+        """Called for every channel after its Hangup event is applied.
+        """
         self.env['asterisk_plus.recording'].save_call_recording(event)
-        return channel.id
+
+    @api.model
+    def on_ami_new_channel(self, event):
+        """AMI NewChannel event is processed to create a new channel in Odoo.
+        """
+        return self.on_ami_events([event])[0]
+
+    @api.model
+    def on_ami_update_channel_state(self, event):
+        """AMI Newstate event. Write call status and ansered time,
+            create channel message and call event log records.
+            Processed when channel's state changes.
+        """
+        return self.on_ami_events([event])[0]
+
+    @api.model
+    def on_ami_hangup(self, event):
+        """AMI Hangup event.
+        """
+        return self.on_ami_events([event])[0]
 
     @api.model
     def on_ami_originate_response_failure(self, event):
@@ -350,7 +611,7 @@ class Channel(models.Model):
         if event['Response'] != 'Failure':
             logger.error(self, 'Response', 'UNEXPECTED ORIGINATE RESPONSE FROM ASTERISK!')
             return False
-        channel = self.env['asterisk_plus.channel'].search([('uniqueid', '=', event['Uniqueid'])])
+        channel = self._get_active_channel(event['Uniqueid'])
         if not channel:
             debug(self, 'CHANNEL NOT FOUND FOR ORIGINATE RESPONSE!')
             return False
@@ -376,13 +637,8 @@ class Channel(models.Model):
     def update_recording_filename(self, event):
         """AMI VarSet event.
         """
-        debug(self, json.dumps(event, indent=2))
         if event.get('Variable') == 'MIXMONITOR_FILENAME':
-            file_path = event['Value']
-            uniqueid = event['Uniqueid']
-            channel = self.search([('uniqueid', '=', uniqueid)], limit=1)
-            channel.recording_file_path = file_path
-            return True
+            return self.on_ami_events([event])[0]
         return False
 
     @api.model
@@ -394,3 +650,7 @@ class Channel(models.Model):
             ('create_date', '<=', expire_date.strftime('%Y-%m-%d %H:%M:%S'))
         ])
         channels.unlink()
+        # Rebuild the index on next event as it may point to removed channels.
+        dbname = self.env.cr.dbname
+        for server in self.env['asterisk_plus.server'].search([]):
+            active_channels.clear((dbname, server.id))
@@ -118,17 +118,20 @@ class AsteriskConf(models.Model):
     def upload_conf(self):
         """Upload conf on server.
         """
-        self.ensure_one()
-        self.server.local_job(
-            fun='asterisk.put_config',
-            arg=[self.name, "'{}'".format(base64.b64encode(self.content.encode()).decode())],
-            res_model='asterisk_plus.conf',
-            res_method='upload_conf_response',
-            pass_back={
-                'res_id': self.id,
-                'uid': self.env.uid,
-                'name': self.name,
-            })
+        self.env['asterisk_plus.server'].local_jobs([(
+            rec.server,
+            'asterisk.put_config',
+            [rec.name, "'{}'".format(base64.b64encode(rec.content.encode()).decode())],
+            None,
+            {
+                'res_model': 'asterisk_plus.conf',
+                'res_method': 'upload_conf_response',
+                'pass_back': {
+                    'res_id': rec.id,
+                    'uid': self.env.uid,
+                    'name': rec.name,
+                },
+            }) for rec in self])
 
     @api.model
     def upload_conf_response(self, response, pass_back):
@@ -1,5 +1,148 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
-from odoo import models, fields, api, _
+import ast
+import json
+import logging
+from odoo import models, fields, api, tools, _, SUPERUSER_ID
+from odoo.exceptions import AccessError
+
+logger = logging.getLogger(__name__)
+
+#: Comparison operators supported in event conditions and their negations.
+COMPARE_OPERATORS = {
+    ast.Eq: ('=', '!='),
+    ast.NotEq: ('!=', '='),
+    ast.In: ('in', 'not in'),
+    ast.NotIn: ('not in', 'in'),
+    ast.Lt: ('<', '>='),
+    ast.LtE: ('<=', '>'),
+    ast.Gt: ('>', '<='),
+    ast.GtE: ('>=', '<'),
+}
+
+#: String methods supported in event conditions.
+CALL_OPERATORS = ('startswith', 'endswith')
+
+
+def _get_event_field(node):
+    """Return AMI message field name for event['Field'] or event.get('Field')."""
+    if isinstance(node, ast.Subscript) and \
+            isinstance(node.value, ast.Name) and node.value.id == 'event':
+        key = node.slice
+        if isinstance(key, getattr(ast, 'Index', ())):
+            key = key.value
+        return ast.literal_eval(key)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+            node.func.attr == 'get' and \
+            isinstance(node.func.value, ast.Name) and \
+            node.func.value.id == 'event' and len(node.args) == 1:
+        return ast.literal_eval(node.args[0])
+    raise ValueError('Unsupported expression: {}'.format(ast.dump(node)))
+
+
+def _compile_node(node, negate=False):
+    if isinstance(node, ast.BoolOp):
+        # De Morgan: not (a and b) == not a or not b.
+        is_and = isinstance(node.op, ast.And) != negate
+        terms = [_compile_node(k, negate) for k in node.values]
+        res = ['&' if is_and else '|'] * (len(terms) - 1)
+        for term in terms:
+            res.extend(term)
+        return res
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        return _compile_node(node.operand, not negate)
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        op = COMPARE_OPERATORS.get(type(node.ops[0]))
+        if not op:
+            raise ValueError('Unsupported operator: {}'.format(
+                type(node.ops[0]).__name__))
+        operator = op[1] if negate else op[0]
+        left, right = node.left, node.comparators[0]
+        if operator in ('in', 'not in') and \
+                not isinstance(right, (ast.List, ast.Tuple, ast.Set)):
+            # 'Local/' in event['Channel']
+            operator = 'contains' if operator == 'in' else 'not contains'
+            return [[_get_event_field(right), operator,
+                     ast.literal_eval(left)]]
+        value = ast.literal_eval(right)
+        if isinstance(value, (tuple, set)):
+            value = list(value)
+        return [[_get_event_field(left), operator, value]]
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+            node.func.attr in CALL_OPERATORS and len(node.args) == 1:
+        operator = node.func.attr
+        if negate:
+            operator = 'not {}'.format(operator)
+        return [[_get_event_field(node.func.value), operator,
+                 ast.literal_eval(node.args[0])]]
+    raise ValueError('Unsupported expression: {}'.format(ast.dump(node)))
+
+
+def compile_condition(condition):
+    """Compile a Python event condition into a declarative filter.
+
+    The filter is a list of [field, operator, value] terms in the prefix
+    notation of Odoo domains ('&' and '|' operators, implicit '&' between
+    terms). Negations are pushed down to the terms.
+
+    Example:
+
+    .. code:: python
+
+        >>> compile_condition("not event['Channel'].startswith('Local/')")
+        [['Channel', 'not startswith', 'Local/']]
+
+    Raises:
+        ValueError: the condition cannot be expressed as a filter.
+    """
+    if not condition or not condition.strip():
+        return []
+    try:
+        tree = ast.parse(condition.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('Syntax error: {}'.format(e))
+    return _compile_node(tree.body)
+
+
+def _match_term(term, event):
+    field, operator, value = term
+    data = event.get(field)
+    negate = operator.startswith('not ')
+    if negate:
+        operator = operator[4:]
+    if operator in ('startswith', 'endswith'):
+        res = isinstance(data, str) and getattr(data, operator)(value)
+    elif operator == 'contains':
+        res = data is not None and value in data
+    elif operator == 'in':
+        res = data in value
+    elif operator == '=':
+        res = data == value
+    elif operator == '!=':
+        res = data != value
+    else:
+        try:
+            res = {
+                '<': lambda a, b: a < b,
+                '<=': lambda a, b: a <= b,
+                '>': lambda a, b: a > b,
+                '>=': lambda a, b: a >= b,
+            }[operator](data, value)
+        except TypeError:
+            res = False
+    return not res if negate else bool(res)
+
+
+def match_filter(event_filter, event):
+    """Check an AMI message against a filter made by compile_condition().
+    """
+    stack = []
+    for term in reversed(event_filter):
+        if term in ('&', '|'):
+            first, second = stack.pop(), stack.pop()
+            stack.append(first and second if term == '&' else first or second)
+        else:
+            stack.append(_match_term(term, event))
+    return all(stack)
 
 
 class Event(models.Model):
@@ -12,8 +155,25 @@ class Event(models.Model):
     model = fields.Char(required=True)
     method = fields.Char(required=True)
     delay = fields.Float(default=0, required=True)
+    #: Keep only the latest event per channel within the coalesce window.
+    coalesce = fields.Boolean(
+        help='The Agent sends to the method only the latest event per '
+             'channel received within the window and drops the others. '
+             'Useful only when the condition passes intermediate events. '
+             'When enabled for Newstate, asterisk_plus.channel on_ami_events '
+             'logs the states of a channel received in one batch as one '
+             'call event.')
+    coalesce_window = fields.Float(default=0.5, string='Coalesce Window',
+                                   help='Window in seconds.')
     is_enabled = fields.Boolean(default=True, string='Enabled')
     condition = fields.Text()
+    #: Condition compiled into a declarative filter, JSON encoded.
+    condition_filter = fields.Text(compute='_compile_condition', store=True,
+                                   string='Compiled Condition')
+    condition_error = fields.Char(compute='_compile_condition', store=True,
+                                  string='Condition Error')
+    #: Number of events dropped by the condition as reported by the Agent.
+    dropped_count = fields.Integer(readonly=True, string='Dropped')
     update = fields.Selection([
             ('no', 'Not Updateable'),
             ('yes', 'Updateable'),
@@ -34,8 +194,123 @@ class Event(models.Model):
             else:
                 rec.icon = '<span class="fa fa-lock"></span>'
 
+    @api.depends('condition')
+    def _compile_condition(self):
+        for rec in self:
+            try:
+                rec.condition_filter = json.dumps(
+                    compile_condition(rec.condition))
+                rec.condition_error = False
+            except ValueError as e:
+                logger.warning('Event %s condition not compiled: %s',
+                               rec.name, e)
+                rec.condition_filter = False
+                rec.condition_error = str(e)
+
+    @api.model
+    def create(self, vals):
+        res = super(Event, self).create(vals)
+        self._bump_routing_version()
+        return res
+
     def write(self, vals):
         # Prevent record update if update = 'no'. If statement hack to allow overwrite update value
         if self.update == 'no' and vals.get('update', 'no') == 'no':
             return
-        return super(Event, self).write(vals)
+        res = super(Event, self).write(vals)
+        self._bump_routing_version()
+        return res
+
+    def unlink(self):
+        res = super(Event, self).unlink()
+        self._bump_routing_version()
+        return res
+
+    ########################### Routing table #################################
+    def _bump_routing_version(self):
+        # Increment in one statement so that concurrent writers do not
+        # lose versions.
+        self.env.cr.execute("""
+            INSERT INTO ir_config_parameter
+                (key, value, create_uid, create_date, write_uid, write_date)
+            VALUES (%(key)s, '1', %(uid)s, now() at time zone 'utc',
+                    %(uid)s, now() at time zone 'utc')
+            ON CONFLICT (key) DO UPDATE
+            SET value = (ir_config_parameter.value::int + 1)::text,
+                write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date
+            """, {'key': 'asterisk_plus.event_routing_version',
+                  'uid': self.env.uid})
+        self.env['ir.config_parameter'].invalidate_cache(['value'])
+        # Invalidate cached parameters and the routing table as set_param().
+        self.env['ir.config_parameter'].clear_caches()
+
+    @api.model
+    def _get_routing_version(self):
+        return int(self.env['ir.config_parameter'].sudo().get_param(
+            'asterisk_plus.event_routing_version', 0))
+
+    @api.model
+    @tools.ormcache()
+    def _get_routing_table(self):
+        events = {}
+        for rec in self.sudo().search([('is_enabled', '=', True)]):
+            route = {
+                'id': rec.id,
+                'source': rec.source,
+                'model': rec.model,
+                'method': rec.method,
+                'delay': rec.delay,
+                'coalesce_window': rec.coalesce_window if rec.coalesce else 0,
+            }
+            if rec.condition_filter:
+                route['filter'] = json.loads(rec.condition_filter)
+            else:
+                # Not compiled, Agent has to evaluate the condition.
+                route['condition'] = rec.condition
+            events.setdefault(rec.name, []).append(route)
+        return events
+
+    @api.model
+    def is_coalesced(self, name, model):
+        """Check if events with the name sent to the model are coalesced."""
+        return any(k['coalesce_window'] and k['model'] == model
+                   for k in self._get_routing_table().get(name, []))
+
+    @api.model
+    def get_routing_table(self, version=None):
+        """Called by the Agent to get enabled events grouped by name.
+
+        Args:
+            version (int): routing table version the Agent already has.
+
+        Returns:
+            A dictionary with the current version and events. Events are
+            omitted when the passed version is the current one.
+        """
+        current = self._get_routing_version()
+        if version is not None and int(version) == current:
+            return {'version': current}
+        return {'version': current, 'events': self._get_routing_table()}
+
+    @api.model
+    def report_dropped(self, counts):
+        """Called by the Agent to report events dropped by event filters.
+
+        Args:
+            counts (dict): event ID -> number of dropped events.
+        """
+        if not (self.env.user.has_group('asterisk_plus.group_asterisk_server')
+                or self.env.user.id == SUPERUSER_ID):
+            raise AccessError(_('Only the PBX server can report dropped events.'))
+        for event_id, count in counts.items():
+            self.env.cr.execute("""
+                UPDATE asterisk_plus_event
+                SET dropped_count = COALESCE(dropped_count, 0) + %s
+                WHERE id = %s""", (int(count), int(event_id)))
+        return True
+
+    def reset_dropped_count(self):
+        self.env.cr.execute("""
+            UPDATE asterisk_plus_event SET dropped_count = 0
+            WHERE id IN %s""", (tuple(self.ids),))
+        self.invalidate_cache(['dropped_count'], self.ids)
@@ -0,0 +1,58 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+"""WAV to MP3 encoder.
+
+Recordings are encoded in parallel by running this file as a script in
+separate processes, so it must not import Odoo.
+
+Usage: python3 mp3_encoder.py <wav path> <mp3 path> <bit rate> <quality>
+"""
+import logging
+import sys
+import time
+import wave
+
+logger = logging.getLogger(__name__)
+
+#: Audio frames passed to MP3 encoder at once.
+ENCODE_CHUNK_FRAMES = 32 * 1024
+
+try:
+    import lameenc
+    LAMEENC = True
+except ImportError:
+    logger.info('MP3 encoding not available. '
+                'To enable pip3 install lameenc.')
+    LAMEENC = False
+
+
+def wav_to_mp3(wav_path, mp3_path, bit_rate, quality):
+    """Encode .wav file to .mp3 file.
+    Audio is encoded by chunks of ENCODE_CHUNK_FRAMES frames so memory
+    usage does not depend on the recording length.
+
+    Returns:
+        Encoding time in seconds.
+    """
+    started = time.time()
+    with wave.open(wav_path) as wav_data, open(mp3_path, 'wb') as f:
+        num_channels = wav_data.getnchannels()
+        sample_rate = wav_data.getframerate()
+        logger.debug('Encoding Wave file. Number of channels: %s. '
+                     'Sample rate: %s, Number of frames: %s', num_channels,
+                     sample_rate, wav_data.getnframes())
+        encoder = lameenc.Encoder()
+        encoder.set_bit_rate(bit_rate)
+        encoder.set_in_sample_rate(sample_rate)
+        encoder.set_channels(num_channels)
+        encoder.set_quality(quality)  # 2-highest, 7-fastest
+        while True:
+            pcm_data = wav_data.readframes(ENCODE_CHUNK_FRAMES)
+            if not pcm_data:
+                break
+            f.write(encoder.encode(pcm_data))
+        f.write(encoder.flush())
+    return time.time() - started
+
+
+if __name__ == '__main__':
+    wav_to_mp3(sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
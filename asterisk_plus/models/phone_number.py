@@ -0,0 +1,112 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+"""Phone number formatting shared by all modules.
+
+Parsing a number with phonenumbers is expensive, and the same caller numbers
+are formatted over and over, so results are kept in a LRU cache keyed by
+(number, region, format type).
+"""
+import functools
+import logging
+import threading
+import time
+import phonenumbers
+
+logger = logging.getLogger(__name__)
+
+#: Max formatted numbers kept per process.
+FORMAT_CACHE_SIZE = 20000
+
+#: Format types:
+#: e164, international - formatted if the number is possible and valid.
+#: out_of_country - as dialed from calling_region if possible and valid.
+#: normalized - E.164 if the number is possible or valid, used to store
+#: phone_normalized fields.
+FORMAT_TYPES = ('e164', 'international', 'out_of_country', 'normalized')
+
+_parse_stats = {'time': 0.0}
+_parse_stats_lock = threading.Lock()
+
+
+def _format_number(number, region, format_type, calling_region):
+    try:
+        phone_nbr = phonenumbers.parse(number, region)
+    except phonenumbers.phonenumberutil.NumberParseException:
+        return number
+    if format_type == 'normalized':
+        if phonenumbers.is_possible_number(phone_nbr) or \
+                phonenumbers.is_valid_number(phone_nbr):
+            return phonenumbers.format_number(
+                phone_nbr, phonenumbers.PhoneNumberFormat.E164)
+        return number
+    if not phonenumbers.is_possible_number(phone_nbr) or \
+            not phonenumbers.is_valid_number(phone_nbr):
+        return number
+    if format_type == 'e164':
+        return phonenumbers.format_number(
+            phone_nbr, phonenumbers.PhoneNumberFormat.E164)
+    elif format_type == 'international':
+        return phonenumbers.format_number(
+            phone_nbr, phonenumbers.PhoneNumberFormat.INTERNATIONAL)
+    elif format_type == 'out_of_country':
+        return phonenumbers.format_out_of_country_calling_number(
+            phone_nbr, calling_region)
+    logger.error('WRONG FORMATTING PASSED: %s', format_type)
+    return number
+
+
+@functools.lru_cache(maxsize=FORMAT_CACHE_SIZE)
+def _format_number_cached(number, region, format_type, calling_region):
+    start = time.perf_counter()
+    try:
+        return _format_number(number, region, format_type, calling_region)
+    except Exception:
+        logger.exception('FORMAT NUMBER ERROR:')
+        return number
+    finally:
+        with _parse_stats_lock:
+            _parse_stats['time'] += time.perf_counter() - start
+
+
+def format_number(number, region=None, format_type='e164',
+                  calling_region=None):
+    """Format the number.
+
+    Args:
+        number (str): number to format.
+        region (str): country code to parse the number for.
+        format_type (str): one of FORMAT_TYPES.
+        calling_region (str): country code the number is dialed from,
+            for out_of_country format only.
+
+    Returns:
+        Formatted number or the number as is if it cannot be formatted.
+    """
+    if not number:
+        return number
+    if format_type != 'out_of_country':
+        calling_region = None
+    return _format_number_cached(number, region or None, format_type,
+                                 calling_region or None)
+
+
+def get_stats():
+    """Cache hit rate and time spent to parse numbers in this process.
+    """
+    info = _format_number_cached.cache_info()
+    requests = info.hits + info.misses
+    return {
+        'size': info.currsize,
+        'max_size': info.maxsize,
+        'hits': info.hits,
+        'misses': info.misses,
+        'hit_rate': info.hits / requests if requests else 0.0,
+        'parse_time': _parse_stats['time'],
+        'avg_parse_time': _parse_stats['time'] / info.misses
+        if info.misses else 0.0,
+    }
+
+
+def clear_cache():
+    _format_number_cached.cache_clear()
+    with _parse_stats_lock:
+        _parse_stats['time'] = 0.0
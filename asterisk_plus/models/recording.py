@@ -1,28 +1,53 @@
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from datetime import datetime, timedelta
+import hashlib
 import io
+import json
+import mimetypes
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
 import time
-import wave
 import logging
 from odoo import models, fields, api, _
 from .server import debug
+from . import mp3_encoder, transcription
+from .mp3_encoder import LAMEENC, wav_to_mp3
 
 logger = logging.getLogger(__name__)
 
-try:
-    import lameenc
-    LAMEENC = True
-except ImportError:
-    logger.info('MP3 encoding not available. '
-                'To enable pip3 install lameenc.')
-    LAMEENC = False
-try:
-    import speech_recognition as sr
-    SR = True
-except ImportError:
-    logger.error('Recording speech recognition not available. '
-                 'To enable pip3 install SpeechRecognition.')
-    SR = False
+#: Bytes read at once when a recording file is copied.
+FILE_CHUNK_SIZE = 64 * 1024
+#: ir.config_parameter key of the recording storage migration checkpoint.
+MIGRATION_PARAM = 'asterisk_plus.recording_storage_migration'
+#: Max size of a file moved to the database column. The file and its base64
+#: copy are kept in memory while it is written, bigger files stay in the
+#: filestore.
+MIGRATION_MAX_DB_FILE_SIZE = 100 * 1024 * 1024
+#: Minutes to wait for the recording file upload before getting it by RPC.
+UPLOAD_TIMEOUT = 15
+
+
+def run_mp3_encoder(wav_path, mp3_path, bit_rate, quality):
+    """Encode .wav file to .mp3 file in a separate process.
+
+    Returns:
+        Encoding time in seconds.
+    """
+    started = time.time()
+    res = subprocess.run(
+        [sys.executable, mp3_encoder.__file__, wav_path, mp3_path,
+         str(bit_rate), str(quality)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if res.returncode:
+        raise RuntimeError('MP3 encoder exited with code {}: {}'.format(
+            res.returncode,
+            res.stderr.decode('utf-8', 'replace').strip()[-1024:]))
+    return time.time() - started
 
 
 class Recording(models.Model):
@@ -59,6 +84,22 @@ class Recording(models.Model):
         ('yes', 'Keep Forever')
     ], default='no', tracking=True)
     icon = fields.Html(compute='_get_icon', string='I')
+    state = fields.Selection([
+        ('uploading', 'Uploading'),
+        ('pending_encode', 'Pending Encode'),
+        ('done', 'Done'),
+    ], default='done', required=True, index=True, readonly=True)
+    encode_time = fields.Float(readonly=True, help='MP3 encoding seconds.')
+    transcript_state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], index=True, readonly=True, copy=False)
+    transcript_attempts = fields.Integer(readonly=True, copy=False)
+    transcript_error = fields.Text(readonly=True, copy=False)
+    #: One time token to upload the recording file by HTTP.
+    upload_token = fields.Char(index=True, readonly=True, copy=False,
+                               groups='base.group_system')
 
     @api.model
     def create(self, vals):
@@ -116,18 +157,104 @@ class Recording(models.Model):
                 ' on {}'.format(found.channel))
             return False
         debug(self, 'Save call recording for channel {}.'.format(found.channel))
-        # Transfer the file.
-        found.server.local_job(
+        token = secrets.token_urlsafe(32)
+        rec = self.create(dict(self._get_recording_vals(found),
+                               state='uploading', upload_token=token))
+        base_url = self.env['ir.config_parameter'].sudo().get_param(
+            'web.base.url')
+        url = '{}/asterisk_plus/recording/upload/{}/{}'.format(
+            base_url, self.env.cr.dbname, token)
+        server = found.server
+        path = found.recording_file_path
+        pass_back = {'channel_id': found.id, 'recording_id': rec.id}
+
+        def send_job():
+            # The Agent posts the file right away so the recording must be
+            # committed first. Errors must not stop other postcommit
+            # callbacks, check_uploads() gets the file later.
+            try:
+                server.local_job(
+                    fun='asterisk.upload_file',
+                    kwarg={'path': path, 'url': url},
+                    res_model='asterisk_plus.recording',
+                    res_method='on_upload_file',
+                    pass_back=pass_back)
+            except Exception:
+                logger.exception('Recording %s upload request error:', uniqueid)
+
+        self.env.cr.postcommit.add(send_job)
+        return True
+
+    @api.model
+    def on_upload_file(self, data, pass_back):
+        """Salt asterisk.upload_file callback.
+        Falls back to asterisk.get_file if the Agent could not upload the file.
+        """
+        if data is True or (isinstance(data, dict) and not data.get('error')):
+            return True
+        rec = self.browse(pass_back['recording_id']).exists()
+        if not rec or rec.state != 'uploading':
+            return False
+        logger.warning('Recording %s upload error: %s, getting the file by RPC.',
+                       rec.uniqueid, data)
+        rec._get_file_by_rpc()
+        return True
+
+    def _get_file_by_rpc(self):
+        """Request the recording file by Salt asterisk.get_file.
+        """
+        self.ensure_one()
+        # HTTP upload is not expected any more.
+        self.sudo().write({'upload_token': False})
+        self.channel.server.local_job(
             fun='asterisk.get_file',
-            arg=found.recording_file_path,
+            arg=self.file_path,
             res_model='asterisk_plus.recording',
             res_method='upload_recording',
-            pass_back={'channel_id': found.id}
-        )
+            pass_back={'channel_id': self.channel.id, 'recording_id': self.id})
+
+    @api.model
+    def check_uploads(self, minutes=UPLOAD_TIMEOUT):
+        """Cron job to get recordings that were not uploaded in time.
+
+        Recordings not uploaded by HTTP are requested by asterisk.get_file.
+        Recordings that did not get a file in time after that are deleted.
+        """
+        expire_date = (datetime.utcnow() - timedelta(minutes=minutes)).strftime(
+            '%Y-%m-%d %H:%M:%S')
+        recs = self.sudo().search([('state', '=', 'uploading'),
+                                   ('write_date', '<=', expire_date)])
+        lost = recs.filtered(lambda r: not r.upload_token or not r.channel)
+        if lost:
+            logger.warning('Recordings %s were not uploaded, deleting.',
+                           ', '.join(lost.mapped('uniqueid')))
+            lost.unlink()
+        for rec in recs - lost:
+            try:
+                with self.env.cr.savepoint():
+                    rec._get_file_by_rpc()
+            except Exception:
+                logger.exception('Recording %s get file error:', rec.uniqueid)
         return True
 
+    def _get_recording_vals(self, channel):
+        return {
+            'uniqueid': channel.uniqueid,
+            'call': channel.call.id,
+            'channel': channel.id,
+            'partner': channel.call.partner.id,
+            'calling_user': channel.call.calling_user.id,
+            'called_user': channel.call.called_user.id,
+            'calling_number': channel.call.calling_number,
+            'called_number': channel.call.called_number,
+            'answered': channel.call.answered,
+            'file_path': channel.recording_file_path,
+        }
+
     @api.model
     def upload_recording(self, data, pass_back):
+        """Salt asterisk.get_file callback with base64 encoded file data.
+        """
         channel_id = pass_back.get('channel_id')
         input_data = data.get('file_data')
         if data.get('error'):
@@ -137,100 +264,523 @@ class Recording(models.Model):
         channel = self.env['asterisk_plus.channel'].browse(channel_id)
         debug(self, 'Call recording upload for channel {}'.format(
             channel.channel))
-        mp3_encode = self.env['asterisk_plus.settings'].get_param(
-            'use_mp3_encoder')
-        transcipt_recording = self.env['asterisk_plus.settings'].get_param(
-            'transcipt_recording')
-        # Transcript
-        transcript = None
-        if SR and transcipt_recording:
-            debug(self, 'Transcript call recording for channel {}'.format(
-                channel.channel))
-            key = self.env['asterisk_plus.settings'].get_param(
-                'google_sr_api_key') or None
-            lang = self.env['asterisk_plus.settings'].get_param(
-                'recognition_lang')
-            r = sr.Recognizer()
-            decoded_input = base64.b64decode(input_data)
-            audio_file = sr.AudioFile(io.BytesIO(decoded_input))
-            with audio_file as src:
-                r.adjust_for_ambient_noise(src, duration=0.5)
-                audio = r.record(src)
-            try:
-                transcript = r.recognize_google(audio, key=key, language=lang)
-            except Exception as e:
-                logger.error('Speech Recognition error: {}'.format(e))
-                transcript = ''
-            transcript = transcript
-        # Convert to mp3
-        if LAMEENC and mp3_encode:
-            bit_rate = int(self.env['asterisk_plus.settings'].get_param(
-                'mp3_encoder_bitrate', default=96))
-            quality = int(self.env['asterisk_plus.settings'].get_param(
-                'mp3_encoder_quality', default=4))
-            decoded_input = base64.b64decode(input_data)
-            output_data = base64.b64encode(
-                self._wav_to_mp3(io.BytesIO(decoded_input), bit_rate, quality))
-            extension = 'mp3'
+        if pass_back.get('recording_id'):
+            rec = self.browse(pass_back['recording_id']).exists()
+            if not rec or rec.state != 'uploading':
+                # Already uploaded by HTTP.
+                return False
         else:
-            output_data = input_data
-            extension = 'wav'
-        # Set filestore
-        fs = {}
+            rec = self.create(self._get_recording_vals(channel))
+        rec.upload_file(io.BytesIO(base64.b64decode(input_data)))
+        return True
+
+    def upload_file(self, stream):
+        """Store the uploaded WAV file and process it.
+
+        Args:
+            stream: file object to read the recording from.
+        """
+        self.ensure_one()
+        self.sudo().write({'upload_token': False})
+        filename = '{}.wav'.format(self.uniqueid)
+        self._save_file(stream, filename, 'audio/wav')
         if self.env['asterisk_plus.settings'].get_param(
-                'recording_storage') == 'db':
-            fs['recording_attachment'] = output_data
+                'transcipt_recording') and self._get_transcription_engine():
+            self.transcript_state = 'pending'
+            self._trigger_cron('asterisk_plus.transcribe_recordings')
+        if LAMEENC and self.env['asterisk_plus.settings'].get_param(
+                'use_mp3_encoder'):
+            # Encoding takes time so it is done by the cron.
+            self.state = 'pending_encode'
+            self._trigger_cron('asterisk_plus.encode_recordings')
         else:
-            fs['recording_data'] = output_data
-        # Create a recording
-        rec = self.create({
-            'uniqueid': channel.uniqueid,
-            **fs,
-            'recording_filename': '{}.{}'.format(channel.uniqueid, extension),
-            'call': channel.call.id,
-            'channel': channel.id,
-            'partner': channel.call.partner.id,
-            'calling_user': channel.call.calling_user.id,
-            'called_user': channel.call.called_user.id,
-            'calling_number': channel.call.calling_number,
-            'called_number': channel.call.called_number,
-            'answered': channel.call.answered,
-            'transcript': transcript,
-            'file_path': channel.recording_file_path,
-        })
+            self.state = 'done'
         # Delete recording from the Asterisk server
         if self.env['asterisk_plus.settings'].get_param('delete_recordings'):
-            debug(self, 'DELETE RECORDING {}'.format(rec.file_path))
-            channel.server.local_job(
+            debug(self, 'DELETE RECORDING {}'.format(self.file_path))
+            self.channel.server.local_job(
                 fun='asterisk.delete_file',
-                arg=rec.file_path)
+                arg=self.file_path)
+
+    @api.model
+    def _trigger_cron(self, xml_id):
+        cron = self.env.ref(xml_id, raise_if_not_found=False)
+        if cron and hasattr(cron, '_trigger'):
+            # Run the cron after commit instead of waiting for its interval.
+            cron.sudo()._trigger()
+
+    @api.model
+    def _get_transcription_engine(self):
+        """Engine selected in settings or None if it cannot run.
+        """
+        # The command is only visible to system administrators.
+        settings = self.env['asterisk_plus.settings'].sudo()
+        engine_name = settings.get_param('transcription_engine') or 'google'
+        engine = transcription.get_engine(engine_name, {
+            'language': settings.get_param('recognition_lang'),
+            'api_key': settings.get_param('google_sr_api_key') or None,
+            'command': settings.get_param('transcription_command'),
+            'timeout': settings.get_param('transcription_timeout'),
+        })
+        if not engine or not engine.is_available():
+            logger.warning('Transcription engine %s not available.',
+                           engine_name)
+            return None
+        return engine
+
+    @api.model
+    def transcribe_recordings(self, batch_size=None):
+        """Cron job to transcript pending recordings.
+        Recordings of a batch are sent to the engine by parallel threads.
+        """
+        settings = self.env['asterisk_plus.settings']
+        engine = self._get_transcription_engine()
+        if not engine:
+            # Do not keep recordings waiting for MP3 encoding.
+            self.env.cr.execute("""
+                UPDATE asterisk_plus_recording
+                SET transcript_state = 'failed', transcript_error = %s
+                WHERE transcript_state = 'pending'""",
+                ('Transcription engine not available.',))
+            self.invalidate_cache(['transcript_state', 'transcript_error'])
+            self._trigger_cron('asterisk_plus.encode_recordings')
+            return False
+        workers = settings.get_param('transcription_workers') or 1
+        max_attempts = settings.get_param('transcription_attempts') or 1
+        batch_size = batch_size or workers * 4
+        while True:
+            # Lock the batch so that concurrent workers take other recordings.
+            self.env.cr.execute("""
+                SELECT id FROM asterisk_plus_recording
+                WHERE transcript_state = 'pending'
+                ORDER BY id LIMIT %s
+                FOR UPDATE SKIP LOCKED""", (batch_size,))
+            recs = self.browse([k[0] for k in self.env.cr.fetchall()])
+            if not recs:
+                break
+            recs._transcribe(engine, workers, max_attempts)
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+            if len(recs) < batch_size:
+                break
+        # Recordings are encoded to MP3 after transcription.
+        self._trigger_cron('asterisk_plus.encode_recordings')
         return True
 
-    def _wav_to_mp3(self, file_data, bit_rate, quality):
-        """Converts call recording from .wav to .mp3.
-        """
-        started = time.time()
-        wav_data = wave.open(file_data)
-        num_channels = wav_data.getnchannels()
-        sample_rate = wav_data.getframerate()
-        num_frames = wav_data.getnframes()
-        pcm_data = wav_data.readframes(num_frames)
-        debug(self,
-              'Encoding Wave file. Number of channels: '
-              '{}. Sample rate: {}, Number of frames: {}'.format(
-                num_channels, sample_rate, num_frames))
-        wav_data.close()
-
-        encoder = lameenc.Encoder()
-        encoder.set_bit_rate(bit_rate)
-        encoder.set_in_sample_rate(sample_rate)
-        encoder.set_channels(num_channels)
-        encoder.set_quality(quality)  # 2-highest, 7-fastest
-        mp3_data = encoder.encode(pcm_data)
-        mp3_data += encoder.flush()
-        logger.info('Recording convert .wav -> .mp3 took %.2f seconds.',
-                    time.time() - started)
-        return mp3_data
+    def _transcribe(self, engine, workers, max_attempts):
+        def transcribe(wav_path):
+            try:
+                return engine.transcribe(wav_path)
+            except Exception as e:
+                return e
+
+        with ExitStack() as stack:
+            paths = {rec: stack.enter_context(rec._get_file_path())
+                     for rec in self}
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = dict(zip(paths, pool.map(transcribe, paths.values())))
+        for rec, res in results.items():
+            if not isinstance(res, Exception):
+                debug(self, 'Recording {} transcript: {}'.format(
+                    rec.uniqueid, res))
+                rec.write({'transcript': res, 'transcript_state': 'done',
+                           'transcript_error': False})
+                continue
+            logger.error('Recording %s transcription error: %s',
+                         rec.uniqueid, res)
+            attempts = rec.transcript_attempts + 1
+            rec.write({
+                'transcript_attempts': attempts,
+                'transcript_error': str(res),
+                'transcript_state': 'failed' if attempts >= max_attempts
+                else 'pending',
+            })
+
+    def transcribe_button(self):
+        self.write({'transcript_state': 'pending',
+                    'transcript_attempts': 0,
+                    'transcript_error': False})
+        self._trigger_cron('asterisk_plus.transcribe_recordings')
+
+    @api.model
+    def encode_recordings(self, batch_size=None):
+        """Cron job to encode pending recordings to MP3.
+        Recordings of a batch are encoded in parallel by a process pool.
+        """
+        if not LAMEENC:
+            logger.warning('MP3 encoding not available, install lameenc.')
+            return False
+        settings = self.env['asterisk_plus.settings']
+        workers = int(settings.get_param('mp3_encoder_workers') or 0) or \
+            os.cpu_count() or 1
+        bit_rate = int(settings.get_param('mp3_encoder_bitrate') or 96)
+        quality = int(settings.get_param('mp3_encoder_quality') or 4)
+        batch_size = batch_size or workers * 4
+        while True:
+            # Lock the batch so that concurrent workers take other recordings.
+            # Transcription needs WAV files so wait for it.
+            self.env.cr.execute("""
+                SELECT id FROM asterisk_plus_recording
+                WHERE state = 'pending_encode'
+                    AND transcript_state IS DISTINCT FROM 'pending'
+                ORDER BY id LIMIT %s
+                FOR UPDATE SKIP LOCKED""", (batch_size,))
+            recs = self.browse([k[0] for k in self.env.cr.fetchall()])
+            if not recs:
+                break
+            recs._encode_mp3(workers, bit_rate, quality)
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+            if len(recs) < batch_size:
+                break
+        return True
+
+    def _encode_mp3(self, workers, bit_rate, quality):
+        """Encode the recordings and replace WAV files with MP3 files.
+        """
+        with ExitStack() as stack:
+            tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(
+                prefix='asterisk_plus-'))
+            tasks = {}
+            for rec in self:
+                wav_path = stack.enter_context(rec._get_file_path())
+                mp3_path = os.path.join(tmp_dir, '{}.mp3'.format(rec.id))
+                tasks[rec] = (wav_path, mp3_path, bit_rate, quality)
+            results = {}
+            if workers > 1 and len(tasks) > 1:
+                # Encoders run as separate processes that do not inherit
+                # locks and database connections of the Odoo worker.
+                with ThreadPoolExecutor(
+                        max_workers=min(workers, len(tasks))) as pool:
+                    futures = {rec: pool.submit(run_mp3_encoder, *args)
+                               for rec, args in tasks.items()}
+                    for rec, future in futures.items():
+                        try:
+                            results[rec] = future.result()
+                        except Exception as e:
+                            results[rec] = e
+            else:
+                for rec, args in tasks.items():
+                    try:
+                        results[rec] = wav_to_mp3(*args)
+                    except Exception as e:
+                        results[rec] = e
+            for rec, res in results.items():
+                if isinstance(res, Exception):
+                    # Keep WAV file.
+                    logger.error('Recording %s MP3 encoding error: %s',
+                                 rec.uniqueid, res)
+                    rec.state = 'done'
+                    continue
+                logger.info('Recording %s convert .wav -> .mp3 took %.2f '
+                            'seconds.', rec.uniqueid, res)
+                with open(tasks[rec][1], 'rb') as f:
+                    rec._save_file(f, '{}.mp3'.format(rec.uniqueid),
+                                   'audio/mpeg')
+                rec.write({'state': 'done', 'encode_time': res})
+
+    @api.model
+    def get_encode_stats(self):
+        """MP3 encoding queue depth and encoding time for the last day.
+        """
+        self.env.cr.execute("""
+            SELECT count(*) FROM asterisk_plus_recording
+            WHERE state = 'pending_encode'""")
+        pending = self.env.cr.fetchone()[0]
+        self.env.cr.execute("""
+            SELECT count(*), avg(encode_time), max(encode_time)
+            FROM asterisk_plus_recording
+            WHERE encode_time IS NOT NULL
+                AND create_date >= now() at time zone 'utc' - interval '1 day'""")
+        count, avg_time, max_time = self.env.cr.fetchone()
+        return {
+            'pending': pending,
+            'encoded': count,
+            'avg_encode_time': avg_time or 0.0,
+            'max_encode_time': max_time or 0.0,
+        }
+
+    ########################### Recording files ###############################
+    def _get_storage_field(self):
+        """Field to keep recording files in according to the storage setting.
+        """
+        if self.env['asterisk_plus.settings'].get_param(
+                'recording_storage') == 'db':
+            return 'recording_data'
+        return 'recording_attachment'
+
+    def _get_file_field(self):
+        self.ensure_one()
+        # Recordings made before a storage change are kept in the old field.
+        if self.with_context(bin_size=True).recording_data:
+            return 'recording_data'
+        return 'recording_attachment'
+
+    def _get_file_attachment(self, field='recording_attachment'):
+        return self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', self._name),
+            ('res_field', '=', field),
+            ('res_id', '=', self.id)])
+
+    @contextmanager
+    def _open_file(self):
+        """Open the recording file for reading without loading it in memory
+        when it is kept in the filestore.
+        """
+        self.ensure_one()
+        field = self._get_file_field()
+        attachment = field == 'recording_attachment' and \
+            self._get_file_attachment(field)
+        if attachment and attachment.store_fname:
+            with open(attachment._full_path(attachment.store_fname), 'rb') as f:
+                yield f
+        else:
+            yield io.BytesIO(base64.b64decode(self[field] or b''))
+
+    @contextmanager
+    def _get_file_path(self):
+        """Path of the recording file. Files kept in the database are saved
+        to a temporary file.
+        """
+        self.ensure_one()
+        field = self._get_file_field()
+        attachment = field == 'recording_attachment' and \
+            self._get_file_attachment(field)
+        if attachment and attachment.store_fname:
+            yield attachment._full_path(attachment.store_fname)
+            return
+        suffix = os.path.splitext(self.recording_filename or '')[1] or '.wav'
+        with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+            f.write(base64.b64decode(self[field] or b''))
+            f.flush()
+            yield f.name
+
+    def _save_file(self, stream, filename, mimetype):
+        """Save the recording file replacing the previous one.
+
+        Files kept in attachments are streamed into the filestore by chunks,
+        other files are read in memory.
+        """
+        self.ensure_one()
+        field = self._get_storage_field()
+        Attachment = self.env['ir.attachment'].sudo()
+        if field == 'recording_attachment' and Attachment._storage() == 'file':
+            self._stream_attachment(stream, field, mimetype)
+            self.write({'recording_data': False,
+                        'recording_filename': filename})
+        else:
+            vals = {'recording_data': False, 'recording_attachment': False}
+            vals.update({
+                field: base64.b64encode(stream.read()),
+                'recording_filename': filename,
+            })
+            self.write(vals)
+
+    def _stream_attachment(self, stream, field, mimetype):
+        """Copy the stream into the filestore and attach the file to the field.
+        """
+        Attachment = self.env['ir.attachment'].sudo()
+        checksum = hashlib.sha1()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=Attachment._filestore(),
+                                        prefix='.recording-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(FILE_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    checksum.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            checksum = checksum.hexdigest()
+            fname = '{}/{}'.format(checksum[:2], checksum)
+            full_path = Attachment._full_path(fname)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            if os.path.isfile(full_path):
+                # The same content is already there.
+                os.unlink(tmp_path)
+            else:
+                os.replace(tmp_path, full_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        if hasattr(Attachment, '_mark_for_gc'):
+            # Remove the file if the transaction is rolled back.
+            Attachment._mark_for_gc(fname)
+        old_attachment = self._get_file_attachment(field)
+        attachment = Attachment.create({
+            'name': field,
+            'res_model': self._name,
+            'res_field': field,
+            'res_id': self.id,
+            'type': 'binary',
+            'mimetype': mimetype,
+            'store_fname': fname,
+        })
+        # Computed from data by ORM, set them for the streamed file.
+        self.env.cr.execute("""
+            UPDATE ir_attachment SET checksum = %s, file_size = %s
+            WHERE id = %s""", (checksum, size, attachment.id))
+        old_attachment.unlink()
+        attachment.invalidate_cache(['checksum', 'file_size'])
+        self.invalidate_cache([field])
+        return attachment
+
+    ####################### Recording storage migration #######################
+    @api.model
+    def start_storage_migration(self):
+        """Start moving recording files to the storage set in settings.
+        Files are moved by the migrate_storage cron.
+        """
+        field = self._get_storage_field()
+        if field == 'recording_attachment':
+            self.env.cr.execute("""
+                SELECT count(*) FROM asterisk_plus_recording
+                WHERE recording_data IS NOT NULL""")
+        else:
+            self.env.cr.execute("""
+                SELECT count(*) FROM ir_attachment
+                WHERE res_model = %s AND res_field = 'recording_attachment'""",
+                (self._name,))
+        total = self.env.cr.fetchone()[0]
+        self._set_migration({'state': 'running', 'field': field,
+                             'last_id': 0, 'moved': 0, 'total': total})
+        logger.info('Recording storage migration of %s files to %s started.',
+                    total, field)
+        self._trigger_cron('asterisk_plus.migrate_recording_storage')
+
+    @api.model
+    def cancel_storage_migration(self):
+        migration = self.get_storage_migration()
+        if migration.get('state') == 'running':
+            migration['state'] = 'cancelled'
+            self._set_migration(migration)
+
+    @api.model
+    def get_storage_migration(self):
+        """Migration checkpoint: state (running, done, cancelled), target
+        field, last moved recording ID and moved / total files counters.
+        """
+        # Not cached ir.config_parameter value to see cancel by other workers.
+        self.env.cr.execute(
+            'SELECT value FROM ir_config_parameter WHERE key = %s',
+            (MIGRATION_PARAM,))
+        row = self.env.cr.fetchone()
+        return json.loads(row[0]) if row else {}
+
+    @api.model
+    def _set_migration(self, migration):
+        self.env['ir.config_parameter'].sudo().set_param(
+            MIGRATION_PARAM, json.dumps(migration))
+
+    @api.model
+    def migrate_storage(self, batch_size=200, batches=10):
+        """Cron job to move recording files between storages in batches.
+        Runs a limited number of batches committing the checkpoint after each
+        one, so that the next run resumes the migration and it can be
+        cancelled between batches.
+        """
+        for _i in range(batches):
+            migration = self.get_storage_migration()
+            if migration.get('state') != 'running':
+                break
+            if migration['field'] == 'recording_attachment':
+                self.env.cr.execute("""
+                    SELECT id FROM asterisk_plus_recording
+                    WHERE id > %s AND recording_data IS NOT NULL
+                    ORDER BY id LIMIT %s""", (migration['last_id'], batch_size))
+            else:
+                self.env.cr.execute("""
+                    SELECT res_id FROM ir_attachment
+                    WHERE res_model = %s AND res_field = 'recording_attachment'
+                        AND res_id > %s
+                    ORDER BY res_id LIMIT %s""",
+                    (self._name, migration['last_id'], batch_size))
+            ids = [k[0] for k in self.env.cr.fetchall()]
+            if ids:
+                if migration['field'] == 'recording_attachment':
+                    migration['moved'] += self._move_to_attachments(ids)
+                else:
+                    migration['moved'] += self._move_to_database(ids)
+                migration['last_id'] = ids[-1]
+            if len(ids) < batch_size:
+                migration['state'] = 'done'
+            self._set_migration(migration)
+            logger.info('Recording storage migration: %s of %s files moved.',
+                        migration['moved'], migration['total'])
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+        return True
+
+    @api.model
+    def _move_to_attachments(self, ids):
+        """Move files from the database column to the filestore.
+        Files are fetched one by one to keep memory usage low.
+        """
+        Attachment = self.env['ir.attachment'].sudo()
+        moved = 0
+        for rec in self.browse(ids):
+            self.env.cr.execute("""
+                SELECT recording_data FROM asterisk_plus_recording
+                WHERE id = %s""", (rec.id,))
+            data = self.env.cr.fetchone()[0]
+            if not data:
+                continue
+            if Attachment._storage() == 'file':
+                mimetype = mimetypes.guess_type(
+                    rec.recording_filename or '')[0] or 'audio/wav'
+                rec._stream_attachment(io.BytesIO(base64.b64decode(bytes(data))),
+                                       'recording_attachment', mimetype)
+                self.env.cr.execute("""
+                    UPDATE asterisk_plus_recording SET recording_data = NULL
+                    WHERE id = %s""", (rec.id,))
+            else:
+                rec.write({'recording_attachment': bytes(data),
+                           'recording_data': False})
+            moved += 1
+        self.invalidate_cache(['recording_data', 'recording_attachment'], ids)
+        return moved
+
+    @api.model
+    def _move_to_database(self, ids):
+        """Move attachment files to the database column.
+        Files are read one by one. A database value cannot be written by
+        chunks, so files bigger than MIGRATION_MAX_DB_FILE_SIZE are skipped.
+        """
+        Attachment = self.env['ir.attachment'].sudo()
+        self.env.cr.execute("""
+            SELECT id, res_id, store_fname, file_size FROM ir_attachment
+            WHERE res_model = %s AND res_field = 'recording_attachment'
+                AND res_id IN %s""", (self._name, tuple(ids)))
+        moved = Attachment.browse()
+        for attachment_id, res_id, store_fname, file_size in self.env.cr.fetchall():
+            if (file_size or 0) > MIGRATION_MAX_DB_FILE_SIZE:
+                logger.warning('Recording %s file is too big to be moved to '
+                               'the database: %s bytes.', res_id, file_size)
+                continue
+            if store_fname:
+                full_path = Attachment._full_path(store_fname)
+                if not os.path.isfile(full_path):
+                    logger.warning('Recording %s file %s not found.',
+                                   res_id, full_path)
+                    continue
+                with open(full_path, 'rb') as f:
+                    data = f.read()
+            else:
+                self.env.cr.execute(
+                    'SELECT db_datas FROM ir_attachment WHERE id = %s',
+                    (attachment_id,))
+                data = bytes(self.env.cr.fetchone()[0] or b'')
+            self.env.cr.execute("""
+                UPDATE asterisk_plus_recording SET recording_data = %s
+                WHERE id = %s""", (base64.b64encode(data), res_id))
+            moved |= Attachment.browse(attachment_id)
+        # Files are removed by the filestore garbage collector.
+        moved.unlink()
+        self.invalidate_cache(['recording_data', 'recording_attachment'], ids)
+        return len(moved)
 
     @api.model
     def delete_recordings(self):
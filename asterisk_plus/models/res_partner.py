@@ -1,13 +1,24 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from collections import defaultdict
 import logging
 import re
-import phonenumbers
-from phonenumbers import phonenumberutil
+from psycopg2.extras import execute_values
 from odoo import models, fields, api, tools, _
+from .phone_number import format_number
 from .settings import debug
 
 logger = logging.getLogger(__name__)
 
+#: Partner fields that affect the country used to parse partner numbers.
+COUNTRY_FIELDS = {'country_id', 'parent_id', 'company_id'}
+
+#: Partner fields that affect caller ID index entries.
+CALLER_INDEX_FIELDS = {'phone', 'mobile', 'country_id', 'company_id',
+                       'name', 'parent_id', 'active'}
+
+#: Partner fields that affect caller ID index entries of its contacts.
+CALLER_INDEX_CHILD_FIELDS = {'name', 'parent_id', 'country_id'}
+
 
 def strip_number(number):
     """Strip number formating"""
@@ -15,6 +26,12 @@ def strip_number(number):
     return re.sub(pattern, '', number)
 
 
+def normalize_number(number, country_code):
+    """Return E.164 number if it is possible or valid, otherwise the number as is.
+    """
+    return format_number(number, country_code, 'normalized')
+
+
 class Partner(models.Model):
     _inherit = ['res.partner']
 
@@ -43,22 +60,55 @@ class Partner(models.Model):
         except Exception as e:
             logger.exception(e)
         res = super(Partner, self).create(vals)
-        if res and not self.env.context.get('no_clear_cache'):
-            self.clear_caches()
+        if res:
+            self.env['asterisk_plus.caller_index'].update_numbers(
+                res._get_indexed_numbers(children=False))
         return res
 
     def write(self, values):
+        # Only numbers of changed partners are updated in the caller ID index.
+        update_index = bool(CALLER_INDEX_FIELDS.intersection(values))
+        # Contacts are indexed with the parent name.
+        children = bool(CALLER_INDEX_CHILD_FIELDS.intersection(values))
+        if update_index:
+            numbers = self._get_indexed_numbers(children=children)
+        country_fields = COUNTRY_FIELDS.intersection(values)
+        if country_fields:
+            countries = self._get_country_values(country_fields)
         res = super(Partner, self).write(values)
-        if res and not self.env.context.get('no_clear_cache'):
+        # Forms send unchanged values, clear the registry wide cache of
+        # country codes only when they are changed.
+        if country_fields and \
+                countries != self._get_country_values(country_fields):
             self.clear_caches()
+        if update_index:
+            self.env['asterisk_plus.caller_index'].update_numbers(
+                numbers | self._get_indexed_numbers(children=children))
         return res
 
+    def _get_country_values(self, field_names):
+        return {rec.id: tuple(rec[k].id for k in sorted(field_names))
+                for rec in self.sudo()}
+
     def unlink(self):
+        numbers = self._get_indexed_numbers()
         res = super(Partner, self).unlink()
-        if res and not self.env.context.get('no_clear_cache'):
-            self.clear_caches()
+        self.env['asterisk_plus.caller_index'].update_numbers(numbers)
         return res
 
+    def _get_indexed_numbers(self, children=True):
+        """Return numbers of partners and their contacts for the caller ID index.
+        Contacts are included as their index names contain the parent name.
+        """
+        partners = self.sudo().with_context(active_test=False)
+        if children:
+            partners |= partners.mapped('child_ids')
+        numbers = set()
+        for rec in partners:
+            numbers.update(k for k in (rec.phone_normalized,
+                                       rec.mobile_normalized) if k)
+        return numbers
+
     @api.model
     def originate_call(self, number, model=None, res_id=None, exten=None):
         """Originate Call to partner.
@@ -81,29 +131,98 @@ class Partner(models.Model):
 
     @api.depends('phone', 'mobile', 'country_id')
     def _get_phone_normalized(self):
+        numbers = self._get_normalized_numbers()
         for rec in self:
             rec.update({
-                'phone_normalized': rec._normalize_phone(rec.phone) if rec.phone else False,
-                'mobile_normalized': rec._normalize_phone(rec.mobile) if rec.mobile else False
+                'phone_normalized': numbers[rec.id][0],
+                'mobile_normalized': numbers[rec.id][1],
             })
 
+    def _get_normalized_numbers(self):
+        """Normalize phone and mobile numbers of many partners at once.
+        Partners are grouped by country and every number is parsed once.
+
+        Returns:
+            A dictionary partner ID -> (phone_normalized, mobile_normalized).
+        """
+        by_country = defaultdict(list)
+        for rec in self:
+            # Not cached to read all partners at once.
+            by_country[rec._resolve_country_code()].append(rec)
+        res = {}
+        for country_code, partners in by_country.items():
+            parsed = {}
+            for rec in partners:
+                values = []
+                for number in (rec.phone, rec.mobile):
+                    if number and number not in parsed:
+                        parsed[number] = normalize_number(number, country_code)
+                    values.append(parsed[number] if number else False)
+                res[rec.id] = tuple(values)
+        return res
+
     def _normalize_phone(self, number):
         """Keep normalized phone numbers in normalized fields.
         """
         self.ensure_one()
-        country_code = self._get_country_code()
-        try:
-            phone_nbr = phonenumbers.parse(number, country_code)
-            if phonenumbers.is_possible_number(phone_nbr) or \
-                    phonenumbers.is_valid_number(phone_nbr):
-                number = phonenumbers.format_number(
-                    phone_nbr, phonenumbers.PhoneNumberFormat.E164)
-        except phonenumbers.phonenumberutil.NumberParseException:
-            pass
-        except Exception as e:
-            logger.warning('Normalize phone error: %s', e)
-        # Strip the number if parse error.
-        return number
+        return normalize_number(number, self._get_country_code())
+
+    @api.model
+    def recompute_phone_normalized(self, batch_size=5000):
+        """Recompute normalized numbers of all partners, e.g. after a country
+        change or an update of the phonenumbers library. Changed numbers are
+        written with one SQL update per batch.
+        """
+        count = last_id = 0
+        while last_id is not None:
+            last_id, changed = self.recompute_phone_batch(last_id, batch_size)
+            count += changed
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+        return count
+
+    @api.model
+    def recompute_phone_batch(self, last_id, batch_size):
+        """Recompute normalized numbers of partners with ID after last_id.
+
+        Returns:
+            (last processed ID or None when there are no more partners,
+            number of changed partners) tuple.
+        """
+        Partner = self.sudo().with_context(active_test=False)
+        self.env.cr.execute("""
+            SELECT id FROM res_partner
+            WHERE id > %s AND (phone IS NOT NULL OR mobile IS NOT NULL)
+            ORDER BY id LIMIT %s""", (last_id, batch_size))
+        partners = Partner.browse([k[0] for k in self.env.cr.fetchall()])
+        if not partners:
+            return None, 0
+        numbers = partners._get_normalized_numbers()
+        changed = []
+        changed_numbers = set()
+        for rec in partners:
+            phone, mobile = numbers[rec.id]
+            if (rec.phone_normalized or False, rec.mobile_normalized or False) \
+                    == (phone, mobile):
+                continue
+            changed.append((rec.id, phone or None, mobile or None))
+            changed_numbers.update([rec.phone_normalized, rec.mobile_normalized,
+                                    phone, mobile])
+        if changed:
+            execute_values(self.env.cr, """
+                UPDATE res_partner p
+                SET phone_normalized = v.phone, mobile_normalized = v.mobile
+                FROM (VALUES %s) AS v(id, phone, mobile)
+                WHERE p.id = v.id""", changed)
+            self.invalidate_cache(['phone_normalized', 'mobile_normalized'])
+            self.env['asterisk_plus.caller_index'].update_numbers(
+                [k for k in changed_numbers if k])
+        last_id = partners[-1].id
+        logger.info('Partner numbers recomputed: %s changed up to ID %s.',
+                    len(changed), last_id)
+        # Free the record cache of the processed batch.
+        self.invalidate_cache()
+        return last_id, len(changed)
 
     def search_by_number(self, number):
         """Search partner by number.
@@ -118,6 +237,32 @@ class Partner(models.Model):
             ('phone_normalized', '=', number),
             ('mobile_normalized', '=', number)])
         debug(self, 'SEARCH_PARTNER_BY_NUMBER {} FOUND: {}'.format(number, found))
+        return self._resolve_number_partners(number, found)
+
+    @api.model
+    def search_by_numbers(self, numbers):
+        """Search partners of many numbers with one query.
+
+        Returns:
+            A dictionary number -> partner found as by search_by_number.
+        """
+        numbers = {k for k in numbers if k}
+        if not numbers:
+            return {}
+        found = defaultdict(lambda: self.env['res.partner'])
+        for rec in self.env['res.partner'].search([
+                '|',
+                ('phone_normalized', 'in', list(numbers)),
+                ('mobile_normalized', 'in', list(numbers))]):
+            for number in {rec.phone_normalized, rec.mobile_normalized}:
+                if number in numbers:
+                    found[number] |= rec
+        return {number: self._resolve_number_partners(number, found[number])
+                for number in numbers}
+
+    def _resolve_number_partners(self, number, found):
+        """Choose the partner of the number from the partners found by it.
+        """
         parents = found.mapped('parent_id')
         # 1-st case: just one partner, perfect!
         if len(found) == 1:
@@ -151,25 +296,34 @@ class Partner(models.Model):
     def search_by_caller_number(self, number):
         # Called from AMI events.fields.
         # Get country code of Asterisk server account.
-        country_code = self.env.user.country_id.code
-        try:
-            phone_nbr = phonenumbers.parse(number, country_code)
-            if not phonenumbers.is_possible_number(phone_nbr):
-                debug(self, 'PHONE NUMBER {} NOT POSSIBLE'.format(number))
-            elif not phonenumbers.is_valid_number(phone_nbr):
-                debug(self, 'PHONE NUMBER {} NOT VALID'.format(number))
-            # We have a parsed number, let check what format to return.
-            number = phonenumbers.format_number(
-                phone_nbr, phonenumbers.PhoneNumberFormat.E164)
-            debug(self, 'E164 FORMATTED NUMBER: {}'.format(number))
-        except phonenumberutil.NumberParseException:
-            debug(self, 'PHONE NUMBER {} PARSE ERROR'.format(number))
-        except Exception:
-            logger.exception('FORMAT NUMBER ERROR:')
-        finally:            
-            return self.search_by_number(number)
+        country_code = self._get_user_country_code()
+        # Format the number the same way as stored partner numbers.
+        number = normalize_number(number, country_code)
+        debug(self, 'NORMALIZED NUMBER: {}'.format(number))
+        found = self.env['asterisk_plus.caller_index'].lookup([number])
+        return self.browse(found[0]) if found else None
 
     def _get_country_code(self):
+        """Country code to parse partner numbers.
+        Cached for saved partners until a partner country or company changes.
+        """
+        if len(self) == 1 and isinstance(self.id, int):
+            return self._get_partner_country_code(self.id)
+        return self._resolve_country_code()
+
+    @api.model
+    @tools.ormcache('partner_id', 'self.env.uid')
+    def _get_partner_country_code(self, partner_id):
+        return self.browse(partner_id)._resolve_country_code()
+
+    @api.model
+    @tools.ormcache('self.env.uid')
+    def _get_user_country_code(self):
+        """Country code of the current user, e.g. the Asterisk server account.
+        """
+        return self.env.user.partner_id._get_country_code()
+
+    def _resolve_country_code(self):
         partner = self
         if partner and partner.country_id:
             # Return partner country code
@@ -196,46 +350,21 @@ class Partner(models.Model):
             debug(self, 'GOT COUNTRY FOR PARTNER {} CODE {}'.format(self, country_code))
         elif not country_code:
             # Get country code for requesting account
-            country_code = self.env.user.partner_id._get_country_code()
+            country_code = self._get_user_country_code()
             debug(self, 'GOT COUNTRY CODE {} FROM ENV USER'.format(country_code))
         elif not country_code:
             debug(self, 'COULD NOT GET COUNTRY CODE')
-        if country_code is False:
-            # False -> None
-            country_code = None
-        try:
-            phone_nbr = phonenumbers.parse(number, country_code)
-            if not phonenumbers.is_possible_number(phone_nbr):
-                debug(self, 'PHONE NUMBER {} NOT POSSIBLE'.format(number))
-            elif not phonenumbers.is_valid_number(phone_nbr):
-                debug(self, 'PHONE NUMBER {} NOT VALID'.format(number))
-            # We have a parsed number, let check what format to return.
-            elif format_type == 'out_of_country':
-                # For out of country format we must get the Asterisk
-                # agent country to format numbers according to it.
-                country_code = self.env.user.partner_id._get_country_code()
-                number = phonenumbers.format_out_of_country_calling_number(
-                    phone_nbr, country_code)
-                debug(self, 'OUT OF COUNTRY FORMATTED NUMBER: {}'.format(number))
-            elif format_type == 'e164':
-                number = phonenumbers.format_number(
-                    phone_nbr, phonenumbers.PhoneNumberFormat.E164)
-                debug(self, 'E164 FORMATTED NUMBER: {}'.format(number))
-            elif format_type == 'international':
-                number = phonenumbers.format_number(
-                    phone_nbr, phonenumbers.PhoneNumberFormat.INTERNATIONAL)
-                debug(self, 'INTERN FORMATTED NUMBER: {}'.format(number))
-            else:
-                logger.error('WRONG FORMATTING PASSED: %s', format_type)
-        except phonenumberutil.NumberParseException:
-            debug(self, 'PHONE NUMBER {} PARSE ERROR'.format(number))
-        except Exception:
-            logger.exception('FORMAT NUMBER ERROR:')
-        finally:
-            return number
+        calling_region = None
+        if format_type == 'out_of_country':
+            # For out of country format we must get the Asterisk
+            # agent country to format numbers according to it.
+            calling_region = self._get_user_country_code()
+        number = format_number(number, country_code, format_type,
+                               calling_region)
+        debug(self, 'FORMATTED NUMBER: {}'.format(number))
+        return number
 
     @api.model
-    @tools.ormcache('number', 'country_code')
     def get_partner_by_number(self, number, country_code=None):
         # Default values
         partner_info = {'name': _('Unknown'), 'id': False}
@@ -246,32 +375,58 @@ class Partner(models.Model):
         if 'unknown' in number or number == 's':
             debug(self, '<UNKNOWN>/s NUMBER PASSED')
             return partner_info
-        partner = None
-        # 1. Convert to E.164 and make a search
+        # Look up in order: E.164 number, number as is, number with +.
         e164_number = self._format_number(
             number, country_code=country_code, format_type='e164')
-        partner = self.search_by_number(e164_number)
-        # 2. Make a search as as.
-        if not partner:
-            partner = self.search_by_number(number)
-        # 3. Add + and make a search.
-        if not partner:
-            number_plus = '+' + number if number[0] != '+' else number
-            partner = self.search_by_number(number_plus)
-        if partner:
+        number_plus = '+' + number if number[0] != '+' else number
+        found = self.env['asterisk_plus.caller_index'].lookup(
+            [e164_number, number, number_plus])
+        if found:
             # We have partner, populate result data.
-            partner_info['id'] = partner.id
-            if partner.parent_name:
-                partner_info['name'] = u'{} ({})'.format(partner.name,
-                                                         partner.parent_name)
-            else:
-                partner_info['name'] = partner.name
-                # On Odoo 10 we have to use unicode formatting!
-                debug(self, u'FOUND PARTNER {}'.format(partner_info['name']))
+            partner_info['id'], partner_info['name'] = found
+            # On Odoo 10 we have to use unicode formatting!
+            debug(self, u'FOUND PARTNER {}'.format(partner_info['name']))
         else:
             debug(self, 'NO PARTNER FOUND')
         return partner_info
 
+    @api.model
+    def get_caller_info(self, numbers, country_code=None):
+        """Caller info used in the dialplan.
+
+        Args:
+            numbers (list): caller numbers.
+            country_code (str): country to parse numbers for.
+
+        Returns:
+            A dictionary number -> {'name', 'partner', 'manager_channels',
+            'tags', 'reference'}.
+        """
+        res = {}
+        for number in numbers:
+            partner_info = self.get_partner_by_number(number, country_code)
+            res[number] = {
+                'name': partner_info['name'] if partner_info['id'] else '',
+                'partner': partner_info['id'],
+                'manager_channels': [],
+                'tags': [],
+                'reference': False,
+            }
+        # Read all found partners at once.
+        partners = self.browse([k['partner'] for k in res.values()
+                                if k['partner']])
+        partners = {k.id: k for k in partners}
+        for info in res.values():
+            partner = partners.get(info['partner'])
+            if not partner:
+                continue
+            if partner.user_id.asterisk_users:
+                info['manager_channels'] = [
+                    k.name for k in partner.user_id.asterisk_users[0].channels
+                    if k.originate_enabled]
+            info['tags'] = [k.name for k in partner.category_id]
+        return res
+
     def _get_call_count(self):
         for rec in self:
             if rec.is_company:
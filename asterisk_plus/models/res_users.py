@@ -14,6 +14,16 @@ class ResUser(models.Model):
     # Server of Agent account, One2one simulation.
     asterisk_server = fields.Many2one('asterisk_plus.server', compute='_get_asterisk_server')
 
+    def write(self, vals):
+        if 'company_id' in vals:
+            companies = {rec.id: rec.company_id.id for rec in self.sudo()}
+        res = super(ResUser, self).write(vals)
+        if 'company_id' in vals and \
+                companies != {rec.id: rec.company_id.id for rec in self.sudo()}:
+            # User company country is cached to parse phone numbers.
+            self.clear_caches()
+        return res
+
     def _get_asterisk_server(self):
         for rec in self:
             # There is an unique constraint to limit 1 user per server.
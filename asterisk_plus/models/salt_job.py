@@ -1,17 +1,25 @@
+from datetime import datetime, timedelta
+from functools import partial
 import json
 import logging
+import time
 from odoo import fields, models, api
 from .settings import debug
 
 logger = logging.getLogger(__name__)
 
+#: How many times the returner looks for a job that is not registered yet.
+JOB_LOOKUP_ATTEMPTS = 5
+#: Delay in seconds between the job lookups.
+JOB_LOOKUP_DELAY = 0.2
+
 
 class SaltJob(models.Model):
     _name = 'asterisk_plus.salt_job'
     _description = 'Salt job'
 
     fun = fields.Char()
-    jid = fields.Char(required=True)
+    jid = fields.Char(required=True, index=True)
     ret = fields.Text()
     full_ret = fields.Text()
     success = fields.Char()
@@ -19,6 +27,14 @@ class SaltJob(models.Model):
     res_method = fields.Char()
     pass_back = fields.Text()
     res_notify_uid = fields.Integer()
+    status = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done')], default='pending', required=True, index=True)
+    completed_at = fields.Datetime(index=True, readonly=True)
+
+    _sql_constraints = [
+        ('jid_uniq', 'unique (jid)', 'This job is already registered!'),
+    ]
 
     @api.model
     def returner(self, ret):
@@ -35,24 +51,102 @@ class SaltJob(models.Model):
         ret_txt = json.dumps(ret, indent=2)
         # Debug only first 1kb of return.
         debug(self, ret_txt[:1024])
-        job = self.sudo().search([('jid', '=', ret['jid'])])
+        job = self._claim_job(ret['jid'], ret.get('success'))
         if not job:
-            logger.error('NO JOB FOUND FOR JID: %s', ret['jid'])
+            logger.error('NO PENDING JOB FOUND FOR JID: %s', ret['jid'])
             return False
         # Check if return shoud be sent in notification box.
-        if job.res_notify_uid:
+        if job['res_notify_uid']:
             if ret['success']:
                 self.env['res.users'].asterisk_plus_notify(
-                    '{}: OK'.format(ret['fun']), uid=job.res_notify_uid)
+                    '{}: OK'.format(ret['fun']), uid=job['res_notify_uid'])
             else:
                 self.env.user.asterisk_plus_notify(
-                    '{}: FAIL'.format(ret['fun']), uid=job.res_notify_uid, warning=True)
+                    '{}: FAIL'.format(ret['fun']), uid=job['res_notify_uid'], warning=True)
 
         # Check if return is sent to callback method.
-        if job.res_model and job.res_method:
-            method = getattr(self.env[job.res_model], job.res_method)
-            res = method(ret['return'], json.loads(job.pass_back) if job.pass_back else None)
+        if job['res_model'] and job['res_method']:
+            method = getattr(self.env[job['res_model']], job['res_method'])
+            res = method(ret['return'], json.loads(job['pass_back']) if job['pass_back'] else None)
             # JSON-RPC requires a result to be returned.
             return res if res else False
         # If no res model / method is specified.
         return False
+
+    def _claim_job_query(self, cr, jid, success):
+        # Only one of concurrent returns for the same jid gets the row.
+        cr.execute("""
+            UPDATE asterisk_plus_salt_job
+            SET status = 'done', completed_at = now() at time zone 'utc',
+                success = %s
+            WHERE jid = %s AND status = 'pending'
+            RETURNING res_model, res_method, res_notify_uid, pass_back""",
+            (str(success), jid))
+        return cr.dictfetchone()
+
+    @api.model
+    def _claim_job(self, jid, success):
+        """Mark the job done and return its callback data.
+
+        The job is registered in a separate transaction right after the
+        Salt API request returns, so it may be not visible in the current
+        transaction snapshot yet. In this case it is claimed in a fresh
+        transaction polling for it for a while, and it is put back to
+        pending if the current transaction is rolled back.
+
+        Returns:
+            A dictionary with job callback data or None if there is no
+            pending job with this jid.
+        """
+        job = self._claim_job_query(self.env.cr, jid, success)
+        if job:
+            return job
+        for attempt in range(JOB_LOOKUP_ATTEMPTS):
+            with self.pool.cursor() as cr:
+                job = self._claim_job_query(cr, jid, success)
+                if not job:
+                    cr.execute(
+                        'SELECT 1 FROM asterisk_plus_salt_job WHERE jid = %s',
+                        (jid,))
+                    if cr.fetchone():
+                        # The job is there but it is already done.
+                        return None
+            if job:
+                # Keep the job result if the callback fails.
+                self.env.cr.postrollback.add(partial(self._reopen_job, jid))
+                return job
+            time.sleep(JOB_LOOKUP_DELAY)
+        return None
+
+    @api.model
+    def _reopen_job(self, jid):
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE asterisk_plus_salt_job
+                SET status = 'pending', completed_at = NULL, success = NULL
+                WHERE jid = %s AND status = 'done'""", (jid,))
+        logger.warning('Salt job %s is pending again after rollback.', jid)
+
+    @api.model
+    def delete_jobs(self, hours=24, batch_size=1000):
+        """Cron job to delete done jobs and pending jobs that never returned.
+        """
+        expire_date = datetime.utcnow() - timedelta(hours=hours)
+        # Jobs without return are kept longer to let slow jobs complete.
+        stale_date = datetime.utcnow() - timedelta(hours=hours * 7)
+        count = 0
+        while True:
+            self.env.cr.execute("""
+                DELETE FROM asterisk_plus_salt_job WHERE id IN (
+                    SELECT id FROM asterisk_plus_salt_job
+                    WHERE (status = 'done' AND completed_at <= %s)
+                        OR (status = 'pending' AND create_date <= %s)
+                    LIMIT %s)""", (expire_date, stale_date, batch_size))
+            deleted = self.env.cr.rowcount
+            count += deleted
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+            if deleted < batch_size:
+                break
+        logger.info('Deleted %s Salt jobs', count)
+        return count
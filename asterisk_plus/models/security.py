@@ -63,6 +63,7 @@ class AccessList(models.Model):
         """Update access rules for server.
         """
         servers_domain = [] if not server_id else [('id', '=', server_id)]
+        jobs = []
         for server in self.env['asterisk_plus.server'].search(servers_domain):
             entries = self.search([('server', '=', server.id),
                                    ('is_enabled', '=', True)])
@@ -74,10 +75,9 @@ class AccessList(models.Model):
                     'netmask': entry.netmask,
                     'address_type': entry.address_type,
                     'access_type': entry.access_type})
-            server.local_job(
-                fun='asterisk.update_access_rules',
-                arg=[rules],
-                res_notify_uid=self.env.uid)
+            jobs.append((server, 'asterisk.update_access_rules', [rules],
+                         None, {'res_notify_uid': self.env.uid}))
+        self.env['asterisk_plus.server'].local_jobs(jobs)
 
 
 class Ban(models.Model):
@@ -97,15 +97,13 @@ class Ban(models.Model):
     def reload_bans(self, delay=0):
         """Get banned IPs from server.
         """
-        for server in self.env['asterisk_plus.server'].search([]):
-            server.local_job(
-                fun='asterisk.get_banned',
-                timeout=delay,
-                res_model='asterisk_plus.access_ban',
-                res_method='reload_bans_response',
-                pass_back={
-                    'notify_uid': self.env.uid,
-                })
+        self.env['asterisk_plus.server'].local_jobs([
+            (server, 'asterisk.get_banned', None, None, {
+                'timeout': delay,
+                'res_model': 'asterisk_plus.access_ban',
+                'res_method': 'reload_bans_response',
+                'pass_back': {'notify_uid': self.env.uid},
+            }) for server in self.env['asterisk_plus.server'].search([])])
 
     @api.model
     def reload_bans_response(self, response, pass_back):
@@ -4,9 +4,11 @@ import base64
 from datetime import datetime
 import json
 import logging
+import threading
 import time
 import urllib
 import uuid
+import requests
 import yaml
 from odoo import api, models, fields, SUPERUSER_ID, registry, release, _
 from odoo.exceptions import ValidationError
@@ -30,6 +32,83 @@ ORIGINATE_FORMAT_TYPES = [
 ]
 
 
+#: Salt API token is refreshed this number of seconds before it expires.
+SALTAPI_TOKEN_REFRESH = 60
+
+
+class PooledPepper(pepper.Pepper):
+    """Pepper client keeping a HTTP keep-alive session to Salt API.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PooledPepper, self).__init__(*args, **kwargs)
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'X-Requested-With': 'XMLHttpRequest',
+        })
+        self.lock = threading.RLock()
+
+    def req(self, path, data=None):
+        headers = {}
+        if path != '/run' and self.auth and self.auth.get('token'):
+            headers['X-Auth-Token'] = self.auth['token']
+        try:
+            resp = self.session.post(
+                self._construct_url(path), json=data, headers=headers,
+                verify=self._ssl_verify)
+        except requests.exceptions.ConnectionError as e:
+            # Callers handle urllib errors raised by Pepper.
+            raise urllib.error.URLError(e)
+        if resp.status_code == 401:
+            raise pepper.PepperException('Authentication denied')
+        if resp.status_code == 500:
+            raise pepper.PepperException('Server error.')
+        resp.raise_for_status()
+        if not self.salt_version and 'x-salt-version' in resp.headers:
+            self._parse_salt_version(resp.headers['x-salt-version'])
+        try:
+            return resp.json()
+        except ValueError:
+            raise pepper.PepperException('Unable to parse the server response.')
+
+    def ensure_login(self, username, password, force=False):
+        """Login if there is no token or it is about to expire.
+        """
+        with self.lock:
+            if force or self.auth.get('expire', 0) - time.time() < \
+                    SALTAPI_TOKEN_REFRESH:
+                logger.info('SALT API LOGIN.')
+                self.login(username, password, 'file')
+        return self
+
+
+class SaltApiPool(object):
+    """Process wide pool of Salt API clients keyed by (database, Salt API URL).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def get(self, dbname, url):
+        with self._lock:
+            client = self._clients.get((dbname, url))
+            if not client:
+                client = PooledPepper(url)
+                self._clients[(dbname, url)] = client
+            return client
+
+    def clear(self, dbname):
+        with self._lock:
+            for key in [k for k in self._clients if k[0] == dbname]:
+                del self._clients[key]
+
+
+#: Salt API clients of all databases served by this process.
+saltapi_pool = SaltApiPool()
+
+
 def get_default_server(rec):
     try:
         return rec.env.ref('asterisk_plus.default_server')
@@ -81,6 +160,13 @@ class Server(models.Model):
         ('user_unique', 'UNIQUE("user")', 'This user is already used for another server!'),
     ]
 
+    def write(self, vals):
+        res = super(Server, self).write(vals)
+        if 'server_id' in vals:
+            # User channels are resolved by the minion ID.
+            self.env['asterisk_plus.user_channel']._clear_user_channels_map()
+        return res
+
     def open_server_form(self):
         rec = self.env.ref('asterisk_plus.default_server')
         return {
@@ -108,96 +194,30 @@ class Server(models.Model):
 
     @api.model
     def _get_saltapi(self, force_login=False):
-        """Get Salt API pepper instance.
-        TODO: Cache auth in ORM cache not ir.config_parameter.
+        """Get Salt API pepper instance from the process pool.
         Returns:
             A connected pepper instance. See `libpepper.py <https://github.com/saltstack/pepper/blob/develop/pepper/libpepper.py>`__ for details.
         """
         get_param = self.env['asterisk_plus.settings'].sudo().get_param
-        saltapi = pepper.Pepper(get_param('saltapi_url'))
-        # Get saltapi auth params
-        auth = self.env[
-            'ir.config_parameter'].sudo().get_param('saltapi_auth')
-        # Check if we already logged in.
-        if not force_login and auth:
-            # Convert into dictionary.
-            try:
-                auth = json.loads(auth)
-            except json.decoder.JSONDecodeError as e:
-                logger.error('Auth token error: %s: %s', auth, e)
-                auth = {'expire': 0}
-            if auth['expire'] - time.time() < 0:
-                # Token is no longer valid so need to login.
-                logger.info('SALT API LOGIN AS TOKEN IS EXPIRED.')
-                saltapi.login(
-                    get_param('saltapi_user'),
-                    get_param('saltapi_passwd'),
-                    'file',
-                )
-                # Update auth data.
-                self.env['ir.config_parameter'].sudo().set_param(
-                    'saltapi_auth', json.dumps(saltapi.auth))
-            else:
-                # Token not expired, take it.
-                saltapi.auth = auth
-        else:
-            # Token is no longer valid so need to login.
-            logger.info('SALT API LOGIN.')
-            saltapi.login(
-                get_param('saltapi_user'),
-                get_param('saltapi_passwd'),
-                'file',
-            )
-            self.env['ir.config_parameter'].set_param(
-                'saltapi_auth', json.dumps(saltapi.auth))
-        return saltapi
+        saltapi = saltapi_pool.get(self.env.cr.dbname, get_param('saltapi_url'))
+        return saltapi.ensure_login(
+            get_param('saltapi_user'), get_param('saltapi_passwd'),
+            force=force_login)
 
-    def local_job(self, fun, arg=None, kwarg=None, timeout=None,
-                  res_model=None, res_method=None, res_notify_uid=None,
-                  pass_back=None, sync=False):
-        """Execute a function on Salt minion.
+    @api.model
+    def _reset_saltapi(self):
+        """Drop Salt API clients of the database e.g. on settings change."""
+        saltapi_pool.clear(self.env.cr.dbname)
 
-        Args:
-            fun (str): function name. Example: test.ping.
-            arg (list): positional arguments.
-            kwarg (dict): named arguments.
-            timeout (int): function execution timeout in seconds.
-            res_model (str): name of the model to receive function result.
-            res_method (str): name of the method to receive function result. Function result is passed as the 1-st paramater.
-            res_notify_uid (int): User ID that will receive function result in notification message.
-            pass_back (dict): json serializable dictionary that is passed to res_method as the 2-nd paramater.
+    def _saltapi_call(self, func):
+        """Call func with a Salt API client handling errors and re-login.
         """
         try:
             saltapi = self.sudo()._get_saltapi()
         except urllib.error.URLError:
             raise ValidationError('Cannot connect to Salt API process.')
-        # Wrap calling function to be able to re-login on session expiration.
-
-        def call_fun():
-            if not sync:
-                ret = saltapi.local_async(tgt=self.server_id, fun=fun, arg=arg,
-                                          kwarg=kwarg, timeout=timeout, ret='odoo')
-                self.env['asterisk_plus.salt_job'].sudo().create({
-                    'jid': ret['return'][0]['jid'],
-                    'res_model': res_model,
-                    'res_method': res_method,
-                    'res_notify_uid': res_notify_uid,
-                    'pass_back': json.dumps(pass_back) if pass_back else False,
-                })
-            else:
-                ret = saltapi.local(tgt=self.server_id, fun=fun, arg=arg,
-                                    kwarg=kwarg, timeout=timeout)
-            # TODO: Add server:
-            # {'return': [{'jid': '20210928122846179815', 'minions': ['asterisk']}]}
-            # TODO: When minion is not accepted it raises error.
-            debug(self, json.dumps(ret, indent=2))
-            if not self.env.context.get('no_commit'):
-                # Commit ASAP so that returner can find the job.
-                # TODO: Move the above to separate transation not to commit the current one.
-                self.env.cr.commit()
-            return ret
         try:
-            return call_fun()
+            return func(saltapi)
         except ConnectionResetError:
             raise ValidationError('Salt API connection reset! Check HTTP/HTTPS settings.')
         except urllib.error.URLError:
@@ -213,10 +233,108 @@ class Server(models.Model):
             if 'Authentication denied' in str(e):
                 logger.warning('Salt Authentication denied.')
                 saltapi = self.sudo()._get_saltapi(force_login=True)
-                return call_fun()
+                return func(saltapi)
             else:
                 raise
 
+    def local_job(self, fun, arg=None, kwarg=None, timeout=None,
+                  res_model=None, res_method=None, res_notify_uid=None,
+                  pass_back=None, sync=False):
+        """Execute a function on Salt minion.
+
+        Args:
+            fun (str): function name. Example: test.ping.
+            arg (list): positional arguments.
+            kwarg (dict): named arguments.
+            timeout (int): function execution timeout in seconds.
+            res_model (str): name of the model to receive function result.
+            res_method (str): name of the method to receive function result. Function result is passed as the 1-st paramater.
+            res_notify_uid (int): User ID that will receive function result in notification message.
+            pass_back (dict): json serializable dictionary that is passed to res_method as the 2-nd paramater.
+        """
+        if not sync:
+            ret = self.local_jobs([(self, fun, arg, kwarg, {
+                'timeout': timeout,
+                'res_model': res_model,
+                'res_method': res_method,
+                'res_notify_uid': res_notify_uid,
+                'pass_back': pass_back,
+            })])
+            if ret and not ret[0]:
+                raise ValidationError('No job ID was returned. Check Minion ID!')
+            return {'return': ret} if ret else ret
+
+        def call_fun(saltapi):
+            ret = saltapi.local(tgt=self.server_id, fun=fun, arg=arg,
+                                kwarg=kwarg, timeout=timeout)
+            debug(self, json.dumps(ret, indent=2))
+            return ret
+        return self._saltapi_call(call_fun)
+
+    @api.model
+    def local_jobs(self, jobs):
+        """Execute many functions on Salt minions with one Salt API request.
+
+        Args:
+            jobs (list): (server, fun, arg, kwarg, callback) tuples. callback
+                is a dictionary with optional timeout, res_model, res_method,
+                res_notify_uid and pass_back keys as in local_job.
+
+        Returns:
+            A list of Salt API returns in the order of jobs. Example:
+            [{'jid': '20210928122846179815', 'minions': ['asterisk']}]
+            The return is empty for a minion that is not accepted and its
+            job is not registered.
+        """
+        if not jobs:
+            return []
+        lowstate = []
+        for server, fun, arg, kwarg, callback in jobs:
+            low = {
+                'client': 'local_async',
+                'tgt': server.server_id,
+                'fun': fun,
+                'expr_form': 'glob',
+                'ret': 'odoo',
+            }
+            if arg:
+                low['arg'] = arg
+            if kwarg:
+                low['kwarg'] = kwarg
+            if (callback or {}).get('timeout'):
+                low['timeout'] = callback['timeout']
+            lowstate.append(low)
+
+        def call_fun(saltapi):
+            ret = saltapi.low(lowstate)['return']
+            debug(self, json.dumps(ret, indent=2))
+            vals_list = []
+            for job, job_ret in zip(jobs, ret):
+                if not job_ret or not job_ret.get('jid'):
+                    # Salt returns {} when the minion is not accepted.
+                    logger.error('No job ID returned for %s on minion %s.',
+                                 job[1], job[0].server_id)
+                    continue
+                callback = job[4] or {}
+                pass_back = callback.get('pass_back')
+                vals_list.append({
+                    'fun': job[1],
+                    'jid': job_ret['jid'],
+                    'res_model': callback.get('res_model'),
+                    'res_method': callback.get('res_method'),
+                    'res_notify_uid': callback.get('res_notify_uid'),
+                    'pass_back': json.dumps(pass_back) if pass_back else False,
+                })
+            if not vals_list:
+                return ret
+            # Register jobs in a separate short transaction so that the
+            # returner can find them without committing the current one.
+            with self.pool.cursor() as cr:
+                self.env(cr=cr)['asterisk_plus.salt_job'].sudo().create(
+                    vals_list)
+            return ret
+        return self._saltapi_call(call_fun)
+
     def ami_action(self, action, timeout=5, no_wait=False, as_list=None, **kwargs):
         """Send AMI action to the server.
 
@@ -459,8 +577,7 @@ class Server(models.Model):
         changed_configs = self.env['asterisk_plus.conf'].search(
             [('server', '=', self.id), ('is_updated', '=', True)])
         try:
-            for conf in changed_configs:
-                conf.upload_conf()
+            changed_configs.upload_conf()
             if changed_configs:
                 self.reload_action(delay=0.5)
                 return True
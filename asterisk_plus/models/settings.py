@@ -1,13 +1,19 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
 import inspect
+import ipaddress
+import json
 import logging
 import sys
-from odoo import fields, models, api, release, _
+from odoo import fields, models, api, _
 from odoo.exceptions import ValidationError
 from odoo.tools import ormcache
+from . import phone_number
 
 logger = logging.getLogger(__name__)
 
+#: ir.config_parameter key of the phone numbers recompute checkpoint.
+PHONE_RECOMPUTE_PARAM = 'asterisk_plus.phone_recompute'
+
 FORMAT_TYPE = 'e164'
 
 
@@ -42,8 +48,15 @@ class Settings(models.Model):
         help='Save all AMI messages on channels')
     permit_ip_addresses = fields.Char(
         string=_('Permit IP address(es)'),
-        help=_('Comma separated list of IP addresses permitted to query caller'
-               ' ID number, etc. Leave empty to allow all addresses.'))
+        help=_('Comma separated list of IP addresses or networks (e.g. '
+               '10.0.0.0/24) permitted to query caller ID number, etc. '
+               'Leave empty to allow all addresses.'))
+    caller_id_suffix_digits = fields.Integer(
+        string='Match Callers by Last Digits',
+        help='When a caller number is not found, match a partner whose number '
+             'ends with the same number of last digits, e.g. 9. The match '
+             'is skipped if several partners have these digits. '
+             'Set 0 to disable.')
     originate_context = fields.Char(
         string='Default context',
         default='from-internal', required=True,
@@ -56,13 +69,40 @@ class Settings(models.Model):
     recording_storage = fields.Selection(
         [('db', _('Database')), ('filestore', _('Files'))],
         default='filestore', required=True)
+    phone_recompute_progress = fields.Char(
+        compute='_get_phone_recompute_progress', string=_('Numbers Recompute'))
+    recording_migration_state = fields.Selection(
+        [('running', _('Running')), ('done', _('Done')),
+         ('cancelled', _('Cancelled'))],
+        compute='_get_recording_migration', string=_('Storage Move'))
+    recording_migration_progress = fields.Char(
+        compute='_get_recording_migration', string=_('Storage Move Progress'))
     delete_recordings = fields.Boolean(
         default=True,
         help='Keep recordings on Asterisk after upload to Odoo.')
     transcipt_recording = fields.Boolean(
         default=False, string=_("Transcript Recording"),
-        help=_("If checked, call recordings will be transcripted using the Google Speech Recognition API."
-               "Requires SpeechRecognition Python package installed to work."))
+        help=_("If checked, call recordings will be transcripted by the transcription engine."))
+    transcription_engine = fields.Selection(
+        [('google', _('Google Speech Recognition')),
+         ('command', _('Local Command'))],
+        default='google', required=True,
+        help=_('Google Speech Recognition requires SpeechRecognition Python '
+               'package installed to work. Local Command runs an offline '
+               'engine like whisper.cpp or Vosk.'))
+    transcription_command = fields.Char(
+        groups='base.group_system',
+        help=_('Command printing the recording text, e.g. '
+               '"whisper-cli -m /opt/models/ggml-base.bin -l {lang} -nt -f {file}". '
+               '{file}, {language} and {lang} are replaced with the recording '
+               'file path, the recognition language and its 2 letter code.'))
+    transcription_timeout = fields.Integer(
+        default=600, help=_('Seconds to wait for the transcription command.'))
+    transcription_workers = fields.Integer(
+        default=2, string=_('Transcription Threads'),
+        help=_('Number of recordings transcripted in parallel.'))
+    transcription_attempts = fields.Integer(
+        default=3, help=_('Failed transcriptions are retried this number of times.'))
     google_sr_api_key = fields.Char(
         string=_("API Key"),
         help=_('The Google Speech Recognition API key.'
@@ -92,6 +132,15 @@ class Settings(models.Model):
                    ('6', '6'),
                    ('7', '7-Fastest')],
         required=False)
+    mp3_encoder_workers = fields.Integer(
+        string=_('MP3 Encoder Processes'),
+        help=_('Number of processes to encode recordings in parallel, '
+               '0 to use all CPU cores.'))
+    mp3_encode_queue = fields.Integer(
+        compute='_get_mp3_encode_stats', string=_('MP3 Encode Queue'))
+    mp3_encode_time = fields.Float(
+        compute='_get_mp3_encode_stats', string=_('Avg MP3 Encode Time'),
+        help=_('Average seconds to encode a recording for the last day.'))
     calls_keep_days = fields.Char(
         string=_('Call History Keep Days'),
         default='365',
@@ -147,6 +196,68 @@ class Settings(models.Model):
             data = data[0]
         return getattr(data, param, default)
 
+    @api.model
+    @ormcache()
+    def _get_permit_ip_networks(self):
+        """Parsed permit_ip_addresses. Invalidated on settings write.
+
+        Returns:
+            A tuple of permitted networks or None if all addresses are permitted.
+        """
+        value = self.sudo().get_param('permit_ip_addresses')
+        if not value:
+            return None
+        networks = []
+        for address in value.split(','):
+            address = address.strip()
+            if not address:
+                continue
+            try:
+                networks.append(ipaddress.ip_network(address, strict=False))
+            except ValueError:
+                logger.warning('Bad permitted IP address: %s', address)
+        return tuple(networks)
+
+    @api.model
+    def is_ip_permitted(self, remote_ip):
+        """Check the address against permit_ip_addresses.
+        """
+        networks = self._get_permit_ip_networks()
+        if networks is None:
+            return True
+        try:
+            address = ipaddress.ip_address(remote_ip)
+        except ValueError:
+            return False
+        return any(address in k for k in networks)
+
+    def _get_phone_recompute_progress(self):
+        recompute = self.get_phone_recompute()
+        for rec in self:
+            rec.phone_recompute_progress = _(
+                'Running, {} numbers changed').format(recompute['count']) \
+                if recompute.get('state') == 'running' else ''
+
+    def _get_recording_migration(self):
+        migration = self.env[
+            'asterisk_plus.recording'].sudo().get_storage_migration()
+        for rec in self:
+            rec.recording_migration_state = migration.get('state')
+            rec.recording_migration_progress = _('{} of {} files moved').format(
+                migration['moved'], migration['total']) if migration else ''
+
+    def _get_mp3_encode_stats(self):
+        stats = self.env['asterisk_plus.recording'].sudo().get_encode_stats()
+        for rec in self:
+            rec.mp3_encode_queue = stats['pending']
+            rec.mp3_encode_time = stats['avg_encode_time']
+
+    @api.model
+    def get_number_format_stats(self):
+        """Phone number formatting cache hit rate and parse time of the worker.
+        """
+        return phone_number.get_stats()
+
     @api.model
     def set_param(self, param, value, keep_existing=False):
         """
@@ -171,6 +282,11 @@ class Settings(models.Model):
 
     def write(self, vals):
         self.clear_caches()
+        if 'caller_id_suffix_digits' in vals:
+            # Unknown numbers may match by last digits now.
+            self.env['asterisk_plus.caller_index'].clear_unknown()
+        if any(k.startswith('saltapi_') for k in vals):
+            self.env['asterisk_plus.server']._reset_saltapi()
         return super(Settings, self).write(vals)
 
     @api.constrains('record_calls')
@@ -215,33 +331,72 @@ class Settings(models.Model):
                 rec.mp3_encoder_bitrate = '96'
                 rec.mp3_encoder_quality = '4'
 
+    def recompute_phone_numbers(self):
+        """Recompute normalized numbers used to match callers in background.
+        """
+        self._set_phone_recompute({
+            'state': 'running', 'models': self._get_phone_recompute_models(),
+            'last_id': 0, 'count': 0})
+        cron = self.env.ref('asterisk_plus.recompute_phone_numbers',
+                            raise_if_not_found=False)
+        if cron and hasattr(cron, '_trigger'):
+            cron.sudo()._trigger()
+
+    @api.model
+    def _get_phone_recompute_models(self):
+        """Models with recompute_phone_batch method to recompute in order.
+        """
+        return ['res.partner']
+
+    @api.model
+    def get_phone_recompute(self):
+        """Recompute checkpoint: state (running, done), models left, last
+        processed ID of the first model and changed records counter.
+        """
+        self.env.cr.execute(
+            'SELECT value FROM ir_config_parameter WHERE key = %s',
+            (PHONE_RECOMPUTE_PARAM,))
+        row = self.env.cr.fetchone()
+        return json.loads(row[0]) if row else {}
+
+    @api.model
+    def _set_phone_recompute(self, recompute):
+        self.env['ir.config_parameter'].sudo().set_param(
+            PHONE_RECOMPUTE_PARAM, json.dumps(recompute))
+
+    @api.model
+    def process_phone_recompute(self, batches=10, batch_size=5000):
+        """Cron job to recompute normalized numbers.
+        Runs a limited number of batches committing the checkpoint after each
+        one, the next run resumes from the checkpoint.
+        """
+        for _i in range(batches):
+            recompute = self.get_phone_recompute()
+            if recompute.get('state') != 'running':
+                break
+            if recompute['models']:
+                last_id, changed = self.env[
+                    recompute['models'][0]].recompute_phone_batch(
+                        recompute['last_id'], batch_size)
+                recompute['count'] += changed
+                if last_id is None:
+                    recompute['models'].pop(0)
+                    recompute['last_id'] = 0
+                else:
+                    recompute['last_id'] = last_id
+            if not recompute['models']:
+                recompute['state'] = 'done'
+                logger.info('Recomputed %s normalized numbers.',
+                            recompute['count'])
+            self._set_phone_recompute(recompute)
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+        return True
+
     def sync_recording_storage(self):
-        """Sync where call recordings are stored.
+        """Move call recordings to the selected storage in background.
         """
-        count = 0
-        try:
-            recordings = self.env['asterisk_plus.recording'].search([])
-            for rec in recordings:
-                if self.recording_storage == 'db' and not rec.recording_attachment:
-                    rec.write({
-                        'recording_data': False,
-                        'recording_attachment': rec.recording_data})
-                    count += 1
-                    self.env.cr.commit()
-                    logger.info('Recording {} moved to {}'.format(rec, self.recording_storage))
-                elif self.recording_storage == 'filestore' and not rec.recording_data:
-                    rec.write({
-                        'recording_attachment': False,
-                        'recording_data': rec.recording_attachment})
-                    count += 1
-                    self.env.cr.commit()
-                    logger.info('Recording {} moved to {}'.format(rec, self.recording_storage))
-        except Exception as e:
-            logger.info('Sync recordings error: %s', str(e))
-        finally:
-            logger.info('Moved %s recordings', count)
-            # Perform the garbage collection of the filestore.
-            if release.version_info[0] >= 14:
-                self.env['ir.attachment']._gc_file_store()
-            else:
-                self.env['ir.attachment']._file_gc()
+        self.env['asterisk_plus.recording'].start_storage_migration()
+
+    def cancel_recording_storage_sync(self):
+        self.env['asterisk_plus.recording'].cancel_storage_migration()
@@ -0,0 +1,117 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+"""Speech recognition engines used to transcript call recordings.
+
+Engines are called from transcription worker threads so they get all the
+options from settings and must not use Odoo environment. Other modules can
+add an engine with register_engine and a transcription_engine selection
+option with the same name.
+"""
+import logging
+import shlex
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+try:
+    import speech_recognition as sr
+    SR = True
+except ImportError:
+    logger.info('Google speech recognition not available. '
+                'To enable pip3 install SpeechRecognition.')
+    SR = False
+
+#: Default seconds to wait for the transcription command.
+COMMAND_TIMEOUT = 600
+
+ENGINES = {}
+
+
+def register_engine(cls):
+    ENGINES[cls.name] = cls
+    return cls
+
+
+def get_engine(name, options):
+    """Return the engine instance or None if there is no such engine.
+
+    Args:
+        name (str): engine name.
+        options (dict): language, api_key, command and timeout.
+    """
+    cls = ENGINES.get(name)
+    return cls(options) if cls else None
+
+
+class TranscriptionEngine:
+    name = None
+
+    def __init__(self, options):
+        self.options = options
+
+    def is_available(self):
+        return True
+
+    def transcribe(self, wav_path):
+        """Return the text of the .wav file. Raises an exception on error.
+        """
+        raise NotImplementedError()
+
+
+@register_engine
+class GoogleEngine(TranscriptionEngine):
+    """Google Speech Recognition API."""
+    name = 'google'
+
+    def is_available(self):
+        return SR
+
+    def transcribe(self, wav_path):
+        r = sr.Recognizer()
+        with sr.AudioFile(wav_path) as src:
+            r.adjust_for_ambient_noise(src, duration=0.5)
+            audio = r.record(src)
+        try:
+            return r.recognize_google(audio, key=self.options.get('api_key'),
+                                      language=self.options.get('language'))
+        except sr.UnknownValueError:
+            # Speech is unintelligible, there is nothing to retry.
+            return ''
+
+
+@register_engine
+class CommandEngine(TranscriptionEngine):
+    """Offline engine run as a command printing the text to stdout,
+    e.g. whisper.cpp or vosk-transcriber.
+
+    {file}, {language} (en-US) and {lang} (en) are replaced in the command.
+    The file path is appended if there is no {file} in the command.
+    """
+    name = 'command'
+
+    def get_args(self, wav_path):
+        command = self.options.get('command')
+        if not command:
+            raise ValueError('Transcription command is not set.')
+        language = self.options.get('language') or ''
+        params = {'{file}': wav_path, '{language}': language,
+                  '{lang}': language.split('-')[0]}
+        args = []
+        for arg in shlex.split(command):
+            # Other braces e.g. in JSON options are passed as is.
+            for key, value in params.items():
+                arg = arg.replace(key, value)
+            args.append(arg)
+        if '{file}' not in command:
+            args.append(wav_path)
+        return args
+
+    def transcribe(self, wav_path):
+        res = subprocess.run(
+            self.get_args(wav_path), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=self.options.get('timeout') or COMMAND_TIMEOUT)
+        if res.returncode:
+            raise RuntimeError('Command exited with code {}: {}'.format(
+                res.returncode,
+                res.stderr.decode('utf-8', 'replace').strip()[-1024:]))
+        return res.stdout.decode('utf-8', 'replace').strip()
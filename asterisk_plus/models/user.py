@@ -6,6 +6,9 @@ from .settings import debug
 
 logger = logging.getLogger(__name__)
 
+#: PBX user fields used by cached lookups.
+CACHED_FIELDS = {'exten', 'user', 'server', 'channels'}
+
 
 class PbxUser(models.Model):
     _name = 'asterisk_plus.user'
@@ -55,10 +58,17 @@ class PbxUser(models.Model):
 
     def write(self, vals):
         user = super(PbxUser, self).write(vals)
-        if user and not self.env.context.get('no_clear_cache'):
+        if user and CACHED_FIELDS.intersection(vals) and \
+                not self.env.context.get('no_clear_cache'):
             self.pool.clear_caches()
         return user
 
+    def unlink(self):
+        res = super(PbxUser, self).unlink()
+        if res and not self.env.context.get('no_clear_cache'):
+            self.pool.clear_caches()
+        return res
+
     @api.model
     def has_asterisk_plus_group(self):
         """Used from actions.js to check if Odoo user is enabled to
@@ -13,6 +13,9 @@ USER_PERMITTED_FIELDS = [
     'originate_vars', 'channels', 'originate_enabled', 'auto_answer_header',
 ]
 
+#: Fields used by the user channels lookup table.
+CACHED_FIELDS = {'name', 'asterisk_user'}
+
 #: When click to dial is used to originate call to a partner Asterisk first makes
 #: a call to user (1-st call leg) and after user answered his phone the 2-nd call leg
 #: is originated to the partner number. It is possible to auto answer the 1-st leg using
@@ -32,6 +35,19 @@ AUTO_ANSWER_HEADERS = [
 ]
 
 
+def parse_channel_name(channel):
+    """Take channel name from an AMI event and return it as defined for user.
+
+    E.g. PJSIP/1001-0000abcd becomes PJSIP/1001 and
+    Local/1001@from-internal-00000023;1 becomes Local/1001@from-internal.
+    """
+    if ';' in channel:
+        channel = channel.split(';')[0]
+    if '-' in channel:
+        channel = '-'.join(channel.split('-')[:-1])
+    return channel
+
+
 class UserChannel(models.Model):
     _name = 'asterisk_plus.user_channel'
     _description = 'User Channel'
@@ -62,6 +78,17 @@ class UserChannel(models.Model):
          _('The channel is already defined for this server!')),
     ]
 
+    @api.model
+    def create(self, vals):
+        res = super(UserChannel, self).create(vals)
+        self._clear_user_channels_map()
+        return res
+
+    def unlink(self):
+        res = super(UserChannel, self).unlink()
+        self._clear_user_channels_map()
+        return res
+
     def write(self, values):
         """
         """
@@ -74,7 +101,10 @@ class UserChannel(models.Model):
                 raise ValidationError(
                     _('Fields {} not allowed to be changed by user!').format(
                         ', '.join(restricted_fields)))
-        return super(UserChannel, self).write(values)
+        res = super(UserChannel, self).write(values)
+        if CACHED_FIELDS.intersection(values):
+            self._clear_user_channels_map()
+        return res
 
     @api.constrains('name')
     def _check_channel_name(self):
@@ -93,12 +123,30 @@ class UserChannel(models.Model):
         return self.env['asterisk_plus.settings'].sudo().get_param(
             'originate_context', 'from-internal')
 
+    @api.model
+    @tools.ormcache()
+    def _get_user_channels_map(self):
+        """Lookup table of (channel name, system name) -> (user channel ID, user ID).
+        Invalidated on user channels and PBX users change.
+        """
+        res = {}
+        for rec in self.sudo().search([]):
+            res.setdefault((rec.name, rec.system_name), (rec.id, rec.user.id))
+        return res
+
+    @api.model
+    def _clear_user_channels_map(self):
+        UserChannel = self.env['asterisk_plus.user_channel']
+        UserChannel._get_user_channels_map.clear_cache(UserChannel)
+
+    @api.model
+    def _resolve_channel(self, channel, system_name):
+        """Returns (user channel ID, user ID) for a channel from an AMI event."""
+        return self._get_user_channels_map().get(
+            (parse_channel_name(channel), system_name), (False, False))
+
     @api.model
     def get_user_channel(self, channel, system_name):
         """Take channel from an AMI event, parse it and return user channel object."""
-        if '-' in channel:
-            channel = '-'.join(channel.split('-')[:-1])
-        user_channel = self.search([
-            ('name', '=', channel),
-            ('system_name', '=', system_name)], limit=1)
-        return user_channel
+        user_channel_id = self._resolve_channel(channel, system_name)[0]
+        return self.browse(user_channel_id or [])
@@ -4,4 +4,8 @@ from . import test_event
 from . import test_user_channel
 from . import test_user
 from . import test_controllers
-from . import test_res_partner
\ No newline at end of file
+from . import test_res_partner
+from . import test_channel
+from . import test_settings
+from . import test_recording
+from . import test_salt_job
@@ -0,0 +1,151 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from  odoo.addons.asterisk_plus.models.server import Server
+from odoo.addons.asterisk_plus.models.call import Call
+from odoo.addons.asterisk_plus.models.channel import active_channels, \
+    ActiveChannelIndex
+from odoo.tests.common import TransactionCase
+from unittest.mock import MagicMock, patch
+import time
+
+
+def ami_event(name, uniqueid, linkedid, **kwargs):
+    event = {
+        'Event': name,
+        'Channel': 'PJSIP/1001-0000000{}'.format(uniqueid[-1]),
+        'ChannelState': '4',
+        'ChannelStateDesc': 'Ring',
+        'CallerIDNum': '1001',
+        'CallerIDName': 'Test',
+        'ConnectedLineNum': '',
+        'ConnectedLineName': '',
+        'Language': 'en',
+        'AccountCode': '',
+        'Priority': '1',
+        'Context': 'from-internal',
+        'Exten': '1002',
+        'Uniqueid': uniqueid,
+        'Linkedid': linkedid,
+        'SystemName': 'asterisk',
+    }
+    event.update(kwargs)
+    return event
+
+
+class TestChannel(TransactionCase):
+
+    def setUp(self):
+        super(TestChannel, self).setUp()
+        # Mock local_job to emulate Salt API success response.
+        Server.local_job = MagicMock()
+        self.Channel = self.env['asterisk_plus.channel']
+
+    def test_on_ami_events(self):
+        res = self.Channel.on_ami_events([
+            ami_event('Newchannel', 'test-1.1', 'test-1.1'),
+            ami_event('Newchannel', 'test-1.2', 'test-1.1'),
+            ami_event('Newstate', 'test-1.2', 'test-1.1',
+                      ChannelState='6', ChannelStateDesc='Up'),
+            ami_event('Hangup', 'test-1.2', 'test-1.1',
+                      Cause='16', **{'Cause-txt': 'Normal Clearing'}),
+            ami_event('Hangup', 'test-1.1', 'test-1.1',
+                      Cause='16', **{'Cause-txt': 'Normal Clearing'}),
+        ])
+        channels = self.Channel.browse(set(res))
+        self.assertEqual(len(channels), 2)
+        call = channels.mapped('call')
+        self.assertEqual(len(call), 1)
+        self.assertEqual(call.uniqueid, 'test-1.1')
+        self.assertEqual(call.status, 'answered')
+        self.assertFalse(call.is_active)
+        self.assertTrue(call.answered)
+        self.assertEqual(set(channels.mapped('cause')), {'16'})
+        self.assertEqual(len(call.events), 3)
+
+    def test_single_event_wrappers(self):
+        channel_id = self.Channel.on_ami_new_channel(
+            ami_event('Newchannel', 'test-2.1', 'test-2.1'))
+        channel = self.Channel.browse(channel_id)
+        self.assertTrue(channel.call.is_active)
+        self.Channel.on_ami_hangup(
+            ami_event('Hangup', 'test-2.1', 'test-2.1',
+                      Cause='17', **{'Cause-txt': 'User busy'}))
+        self.assertEqual(channel.call.status, 'busy')
+        self.assertFalse(channel.call.is_active)
+        self.assertFalse(self.Channel.on_ami_hangup(
+            ami_event('Hangup', 'test-2.2', 'test-2.2',
+                      Cause='16', **{'Cause-txt': 'Normal Clearing'})))
+
+    def test_active_channels_index(self):
+        channel = self.Channel.browse(self.Channel.on_ami_new_channel(
+            ami_event('Newchannel', 'test-5.1', 'test-5.1')))
+        key = self.Channel._active_channels_key()
+        self.Channel._get_active_channels([])
+        # Another worker removed the channel the index points to.
+        removed = self.Channel.create({'uniqueid': 'test-5.1'})
+        active_channels.add(key, 'test-5.1', removed.id, channel.call.id,
+                            'test-5.1')
+        removed.unlink()
+        self.assertEqual(
+            self.Channel._get_active_channels(['test-5.1'])['test-5.1'],
+            channel)
+        self.assertIsNone(active_channels.get(key, 'test-5.1'))
+        # Entries expire by the channel creation time.
+        index = ActiveChannelIndex(max_age=3600)
+        index.load(key, [('test-5.2', 1, 1, 'test-5.2', time.time() - 7200),
+                         ('test-5.3', 2, 1, 'test-5.2', time.time() - 60)])
+        self.assertIsNone(index.get(key, 'test-5.2'))
+        self.assertEqual(index.get(key, 'test-5.3')[0], 2)
+
+    def test_coalesce_states(self):
+        self.env.ref('asterisk_plus.new_state').coalesce = True
+        res = self.Channel.on_ami_events([
+            ami_event('Newchannel', 'test-3.1', 'test-3.1'),
+            ami_event('Newstate', 'test-3.1', 'test-3.1',
+                      ChannelState='4', ChannelStateDesc='Ring'),
+            ami_event('Newstate', 'test-3.1', 'test-3.1',
+                      ChannelState='5', ChannelStateDesc='Ringing'),
+            ami_event('Newstate', 'test-3.1', 'test-3.1',
+                      ChannelState='6', ChannelStateDesc='Up'),
+        ])
+        channel = self.Channel.browse(res[0])
+        self.assertEqual(channel.state_desc, 'Up')
+        self.assertEqual(channel.call.events.mapped('event'), [
+            'Channel PJSIP/1001 status is Ring -> Ringing -> Up'])
+
+    def test_call_jobs(self):
+        channel_id = self.Channel.on_ami_new_channel(
+            ami_event('Newchannel', 'test-4.1', 'test-4.1'))
+        call = self.Channel.browse(channel_id).call
+        CallJob = self.env['asterisk_plus.call_job']
+        self.assertFalse(CallJob.search([('call', '=', call.id)]))
+        self.Channel.on_ami_hangup(
+            ami_event('Hangup', 'test-4.1', 'test-4.1',
+                      Cause='19', **{'Cause-txt': 'No answer'}))
+        jobs = CallJob.search([('call', '=', call.id)])
+        self.assertIn('register_call', jobs.mapped('method'))
+        CallJob.with_context(no_commit=True).process_jobs()
+        self.assertFalse(jobs.exists())
+        # Only the end of call methods are run.
+        job = CallJob.create({'call': call.id, 'method': 'unlink'})
+        CallJob.with_context(no_commit=True).process_jobs()
+        self.assertTrue(call.exists())
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.attempts, 1)
+        job.unlink()
+        # A failing job is tried once per run.
+        job = CallJob.create({'call': call.id, 'method': 'reload_on_hangup'})
+        with patch.object(Call, 'reload_on_hangup',
+                          side_effect=Exception('Test error')):
+            CallJob.with_context(no_commit=True).process_jobs(batch_size=1)
+            self.assertEqual(job.state, 'pending')
+            self.assertEqual(job.attempts, 1)
+            for _i in range(2):
+                CallJob.with_context(no_commit=True).process_jobs()
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.attempts, 3)
+        self.assertEqual(job.error, 'Test error')
+        # Failed jobs are retried from the admin views.
+        job.retry_button()
+        self.assertEqual(job.state, 'pending')
+        self.assertEqual(job.attempts, 0)
+        self.assertFalse(job.error)
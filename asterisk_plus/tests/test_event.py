@@ -1,9 +1,11 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
 
+from odoo.tests import new_test_user
 from odoo.tests.common import TransactionCase
 from odoo.exceptions import AccessError, UserError, ValidationError
 from odoo.tools import mute_logger
 from psycopg2 import IntegrityError
+from odoo.addons.asterisk_plus.models.event import compile_condition, match_filter
 
 
 class TestEvent(TransactionCase):
@@ -88,3 +90,50 @@ class TestEvent(TransactionCase):
         })
         self.assertEqual(event.icon, '<span class="fa fa-unlock"></span>')
         self.assertEqual(event_locked.icon, '<span class="fa fa-lock"></span>')
+
+    def test_compile_condition(self):
+        event_filter = compile_condition(
+            "not (event['Channel'].startswith('Local/') or "
+            "event['ChannelStateDesc'] not in ['Up'])")
+        self.assertEqual(event_filter, [
+            '&', ['Channel', 'not startswith', 'Local/'],
+            ['ChannelStateDesc', 'in', ['Up']]])
+        self.assertTrue(match_filter(
+            event_filter, {'Channel': 'SIP/1001-01', 'ChannelStateDesc': 'Up'}))
+        self.assertFalse(match_filter(
+            event_filter, {'Channel': 'Local/1001-01', 'ChannelStateDesc': 'Up'}))
+        self.assertFalse(match_filter(
+            event_filter, {'Channel': 'SIP/1001-01', 'ChannelStateDesc': 'Ring'}))
+        self.assertEqual(compile_condition(''), [])
+        with self.assertRaises(ValueError):
+            compile_condition("__import__('os').system('ls')")
+
+    def test_routing_table(self):
+        Event = self.env['asterisk_plus.event']
+        table = Event.get_routing_table()
+        self.assertIn('Hangup', table['events'])
+        self.assertEqual(Event.get_routing_table(table['version']),
+                         {'version': table['version']})
+        event = Event.create({
+            'source': 'AMI',
+            'name': 'Test Event',
+            'model': 'asterisk_plus.server',
+            'method': 'test_method',
+            'condition': "event['Status'] == 'Test'",
+        })
+        table = Event.get_routing_table(table['version'])
+        self.assertEqual(table['events']['Test Event'][0]['filter'],
+                         [['Status', '=', 'Test']])
+        Event.report_dropped({event.id: 5})
+        event.invalidate_cache()
+        self.assertEqual(event.dropped_count, 5)
+        # Only the server reports dropped events.
+        user = new_test_user(self.env, login='asterisk_plus_event_test',
+                             groups='asterisk_plus.group_asterisk_admin')
+        with self.assertRaises(AccessError):
+            Event.with_user(user).report_dropped({event.id: 5})
+        # Each change increments the version.
+        version = Event._get_routing_version()
+        event.write({'delay': 1.0})
+        event.write({'delay': 2.0})
+        self.assertEqual(Event._get_routing_version(), version + 2)
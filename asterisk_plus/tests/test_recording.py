@@ -0,0 +1,246 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+import base64
+import io
+import os
+import tempfile
+import unittest
+import wave
+from odoo.addons.asterisk_plus.models import mp3_encoder, recording, transcription
+from odoo.addons.asterisk_plus.models.server import Server
+from odoo.tests.common import TransactionCase
+from unittest.mock import MagicMock, patch
+
+
+def wav_file(seconds=1, sample_rate=8000):
+    data = io.BytesIO()
+    with wave.open(data, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(b'\x00\x01' * sample_rate * seconds)
+    return data.getvalue()
+
+
+class TestRecording(TransactionCase):
+
+    def setUp(self):
+        super(TestRecording, self).setUp()
+        # Mock local_job to emulate Salt API success response.
+        Server.local_job = MagicMock()
+        self.Recording = self.env['asterisk_plus.recording']
+        self.Settings = self.env['asterisk_plus.settings']
+        self.Settings.set_param('use_mp3_encoder', False)
+        self.Settings.set_param('transcipt_recording', False)
+        self.Settings.set_param('delete_recordings', False)
+
+    def test_upload_file(self):
+        data = wav_file()
+        self.Settings.set_param('recording_storage', 'filestore')
+        rec = self.Recording.create({'uniqueid': 'test-1.1',
+                                     'state': 'uploading'})
+        rec.upload_file(io.BytesIO(data))
+        self.assertEqual(rec.state, 'done')
+        self.assertEqual(rec.recording_filename, 'test-1.1.wav')
+        self.assertFalse(rec.recording_data)
+        self.assertEqual(base64.b64decode(rec.recording_attachment), data)
+        attachment = rec._get_file_attachment()
+        self.assertEqual(attachment.file_size, len(data))
+        with rec._open_file() as f:
+            self.assertEqual(f.read(), data)
+        # Database storage.
+        self.Settings.set_param('recording_storage', 'db')
+        rec.upload_file(io.BytesIO(data))
+        self.assertEqual(base64.b64decode(rec.recording_data), data)
+        self.assertFalse(rec.recording_attachment)
+        self.assertFalse(rec._get_file_attachment())
+
+    def test_upload_recording_fallback(self):
+        rec = self.Recording.create({'uniqueid': 'test-2.1',
+                                     'state': 'uploading'})
+        pass_back = {'recording_id': rec.id, 'channel_id': False}
+        self.assertTrue(self.Recording.on_upload_file(True, pass_back))
+        self.assertFalse(Server.local_job.called)
+        self.Recording.on_upload_file({'error': 'Timeout'}, pass_back)
+        self.assertEqual(Server.local_job.call_args[1]['fun'],
+                         'asterisk.get_file')
+        self.Recording.upload_recording(
+            {'file_data': base64.b64encode(wav_file())}, pass_back)
+        self.assertEqual(rec.state, 'done')
+        # The file uploaded twice is ignored.
+        self.assertFalse(self.Recording.upload_recording(
+            {'file_data': base64.b64encode(wav_file())}, pass_back))
+
+    def test_check_uploads(self):
+        Server.local_job.reset_mock()
+        channel = self.env['asterisk_plus.channel'].create({
+            'uniqueid': 'test-2.2', 'server': self.env.ref(
+                'asterisk_plus.default_server').id})
+        recs = self.Recording.create([
+            {'uniqueid': 'test-2.2', 'state': 'uploading',
+             'channel': channel.id, 'upload_token': 'test-token'},
+            {'uniqueid': 'test-2.3', 'state': 'uploading',
+             'channel': channel.id, 'upload_token': 'test-token-2'},
+        ])
+        self.env.cr.execute("""
+            UPDATE asterisk_plus_recording
+            SET write_date = now() at time zone 'utc' - interval '1 hour'
+            WHERE id = %s""", (recs[0].id,))
+        recs.invalidate_cache()
+        self.Recording.check_uploads(minutes=15)
+        # The file of the expired upload is requested by RPC.
+        self.assertEqual(Server.local_job.call_count, 1)
+        self.assertEqual(Server.local_job.call_args[1]['fun'],
+                         'asterisk.get_file')
+        self.assertEqual(Server.local_job.call_args[1]['pass_back'],
+                         {'channel_id': channel.id, 'recording_id': recs[0].id})
+        self.assertFalse(recs[0].upload_token)
+        self.assertTrue(recs[1].upload_token)
+        # The file did not come by RPC too.
+        self.env.cr.execute("""
+            UPDATE asterisk_plus_recording
+            SET write_date = now() at time zone 'utc' - interval '1 hour'
+            WHERE id = %s""", (recs[0].id,))
+        recs.invalidate_cache()
+        self.Recording.check_uploads(minutes=15)
+        self.assertEqual(recs.exists(), recs[1])
+
+    @unittest.skipIf(not recording.LAMEENC, 'lameenc is not installed')
+    def test_encode_recordings(self):
+        self.Settings.set_param('use_mp3_encoder', True)
+        self.Settings.set_param('mp3_encoder_workers', 1)
+        recs = self.Recording
+        for k in range(2):
+            rec = self.Recording.create({'uniqueid': 'test-3.{}'.format(k),
+                                         'state': 'uploading'})
+            rec.upload_file(io.BytesIO(wav_file()))
+            recs |= rec
+        self.assertEqual(set(recs.mapped('state')), {'pending_encode'})
+        self.assertEqual(self.Recording.get_encode_stats()['pending'], 2)
+        self.Recording.with_context(no_commit=True).encode_recordings()
+        recs.invalidate_cache()
+        self.assertEqual(set(recs.mapped('state')), {'done'})
+        self.assertEqual(recs[0].recording_filename, 'test-3.0.mp3')
+        self.assertEqual(
+            recs[0]._get_file_attachment().mimetype, 'audio/mpeg')
+        self.assertEqual(self.Recording.get_encode_stats()['pending'], 0)
+
+    @unittest.skipIf(not recording.LAMEENC, 'lameenc is not installed')
+    def test_wav_to_mp3_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            wav_path = os.path.join(tmp_dir, 'test.wav')
+            mp3_path = os.path.join(tmp_dir, 'test.mp3')
+            with open(wav_path, 'wb') as f:
+                f.write(wav_file(seconds=3))
+            with patch.object(mp3_encoder, 'ENCODE_CHUNK_FRAMES', 1000):
+                mp3_encoder.wav_to_mp3(wav_path, mp3_path, 32, 7)
+            # Encoder process.
+            os.unlink(mp3_path)
+            recording.run_mp3_encoder(wav_path, mp3_path, 32, 7)
+            self.assertTrue(os.path.getsize(mp3_path))
+            with open(mp3_path, 'rb') as f:
+                mp3_data = f.read()
+        self.assertTrue(mp3_data)
+        # MPEG frame sync.
+        self.assertEqual(mp3_data[0], 0xFF)
+
+    def test_transcribe_recordings(self):
+        self.Settings.set_param('transcipt_recording', True)
+        self.Settings.set_param('transcription_engine', 'command')
+        self.Settings.set_param('transcription_command', 'sh -c "echo Hello"')
+        self.Settings.set_param('transcription_attempts', 2)
+        rec = self.Recording.create({'uniqueid': 'test-4.1',
+                                     'state': 'uploading'})
+        rec.upload_file(io.BytesIO(wav_file()))
+        self.assertEqual(rec.transcript_state, 'pending')
+        Recording = self.Recording.with_context(no_commit=True)
+        Recording.transcribe_recordings()
+        rec.invalidate_cache()
+        self.assertEqual(rec.transcript_state, 'done')
+        self.assertEqual(rec.transcript, 'Hello')
+        # Failed command is retried.
+        self.Settings.set_param('transcription_command', 'false')
+        rec.transcribe_button()
+        Recording.transcribe_recordings()
+        rec.invalidate_cache()
+        self.assertEqual(rec.transcript_state, 'pending')
+        self.assertEqual(rec.transcript_attempts, 1)
+        Recording.transcribe_recordings()
+        rec.invalidate_cache()
+        self.assertEqual(rec.transcript_state, 'failed')
+        self.assertTrue(rec.transcript_error)
+
+    def test_command_engine_args(self):
+        engine = transcription.get_engine('command', {
+            'command': 'whisper-cli -l {lang} -f {file}',
+            'language': 'en-US'})
+        self.assertEqual(engine.get_args('/tmp/a.wav'), [
+            'whisper-cli', '-l', 'en', '-f', '/tmp/a.wav'])
+        engine.options['command'] = 'vosk-transcriber -i'
+        self.assertEqual(engine.get_args('/tmp/a.wav'), [
+            'vosk-transcriber', '-i', '/tmp/a.wav'])
+        engine.options['command'] = "run --opts '{\"beam\": 5}' {0} {language}"
+        self.assertEqual(engine.get_args('/tmp/a.wav'), [
+            'run', '--opts', '{"beam": 5}', '{0}', 'en-US', '/tmp/a.wav'])
+
+    def test_storage_migration(self):
+        data = wav_file()
+        self.Settings.set_param('recording_storage', 'db')
+        recs = self.Recording
+        for k in range(3):
+            rec = self.Recording.create({'uniqueid': 'test-5.{}'.format(k),
+                                         'state': 'uploading'})
+            rec.upload_file(io.BytesIO(data))
+            recs |= rec
+        Recording = self.Recording.with_context(no_commit=True)
+        # Move to files.
+        self.Settings.set_param('recording_storage', 'filestore')
+        Recording.start_storage_migration()
+        # One batch per run, the next run resumes.
+        Recording.migrate_storage(batch_size=1, batches=1)
+        migration = Recording.get_storage_migration()
+        self.assertEqual(migration['state'], 'running')
+        self.assertEqual(migration['moved'], 1)
+        Recording.migrate_storage(batch_size=2)
+        migration = Recording.get_storage_migration()
+        self.assertEqual(migration['state'], 'done')
+        self.assertEqual(migration['moved'], 3)
+        for rec in recs:
+            self.assertFalse(rec.recording_data)
+            self.assertEqual(base64.b64decode(rec.recording_attachment), data)
+        # Cancelled migration is not resumed.
+        self.Settings.set_param('recording_storage', 'db')
+        Recording.start_storage_migration()
+        Recording.cancel_storage_migration()
+        Recording.migrate_storage(batch_size=2)
+        self.assertEqual(Recording.get_storage_migration()['moved'], 0)
+        # Move back to the database.
+        Recording.start_storage_migration()
+        Recording.migrate_storage(batch_size=2)
+        self.assertEqual(Recording.get_storage_migration()['moved'], 3)
+        for rec in recs:
+            self.assertFalse(rec._get_file_attachment())
+            self.assertEqual(base64.b64decode(rec.recording_data), data)
+
+    def test_transcription_engine_not_available(self):
+        self.Settings.set_param('transcipt_recording', True)
+        self.Settings.set_param('transcription_engine', 'google')
+        self.Settings.set_param('use_mp3_encoder', recording.LAMEENC)
+        self.Settings.set_param('mp3_encoder_workers', 1)
+        Recording = self.Recording.with_context(no_commit=True)
+        with patch.object(transcription.GoogleEngine, 'is_available',
+                          return_value=False):
+            rec = self.Recording.create({'uniqueid': 'test-6.1',
+                                         'state': 'uploading'})
+            rec.upload_file(io.BytesIO(wav_file()))
+            self.assertFalse(rec.transcript_state)
+            # Engine became unavailable after the recording was queued.
+            rec.transcript_state = 'pending'
+            self.assertFalse(Recording.transcribe_recordings())
+            self.assertEqual(rec.transcript_state, 'failed')
+            self.assertTrue(rec.transcript_error)
+        if recording.LAMEENC:
+            self.assertEqual(rec.state, 'pending_encode')
+            Recording.encode_recordings()
+            rec.invalidate_cache()
+            self.assertEqual(rec.state, 'done')
+            self.assertEqual(rec.recording_filename, 'test-6.1.mp3')
@@ -1,6 +1,9 @@
 from odoo.tests.common import SavepointCase, TransactionCase
 from odoo.tests import new_test_user, Form, tagged
 from odoo import tools, _
+from odoo.addons.asterisk_plus.models.caller_index import NumberCache, unknown_numbers
+from odoo.addons.asterisk_plus.models import caller_index, phone_number
+from unittest.mock import patch
 
 @tagged('res_partner_test')
 class TestResPartner(SavepointCase):
@@ -56,11 +59,242 @@ class TestResPartner(SavepointCase):
         no_number = self.env['res.partner'].get_partner_by_number('unknown')
         self.assertEqual({'name': _('Unknown'), 'id': False}, no_number)
         self.env['res.partner'].get_partner_by_number('+442083661171')
-        partner = self.env['res.partner'].with_context({'no_clear_cache': True}).create({
+        partner = self.env['res.partner'].create({
             'name': "Test User",
             'phone': "+442083661171",
         })
-        self.assertEqual(partner.get_partner_by_number('+442083661171'), {'name': _('Unknown'), 'id': False})
-        partner.clear_caches()
+        # Only the changed number is updated, no cache clearing required.
         self.assertEqual(partner.get_partner_by_number('+442083661171').get('name'), 'Test User')
-        
\ No newline at end of file
+        partner.write({'comment': 'Not indexed field'})
+        self.assertEqual(partner.get_partner_by_number('+442083661171').get('name'), 'Test User')
+        partner.phone = '+442083661178'
+        self.assertEqual(partner.get_partner_by_number('+442083661171'), {'name': _('Unknown'), 'id': False})
+        
+    def test_caller_index(self):
+        Index = self.env['asterisk_plus.caller_index']
+        company = self.env['res.partner'].create({
+            'name': 'Test Company',
+            'is_company': True,
+        })
+        partner = self.env['res.partner'].create({
+            'name': 'Test User',
+            'phone': '+442083661176',
+            'parent_id': company.id,
+        })
+        self.assertEqual(Index.lookup(['+442083661176']),
+                         (partner.id, 'Test User (Test Company)'))
+        company.name = 'New Company'
+        self.assertEqual(Index.lookup(['+442083661176']),
+                         (partner.id, 'Test User (New Company)'))
+        partner.phone = '+442083661177'
+        self.assertIsNone(Index.lookup(['+442083661176']))
+        self.assertEqual(Index.lookup(['+442083661176', '+442083661177'])[0],
+                         partner.id)
+        partner.unlink()
+        self.assertIsNone(Index.lookup(['+442083661177']))
+
+    def test_caller_index_rebuild(self):
+        Index = self.env['asterisk_plus.caller_index']
+        company = self.env['res.partner'].create({
+            'name': 'Test Company',
+            'is_company': True,
+            'phone': '+442083661181',
+        })
+        partner = self.env['res.partner'].create({
+            'name': 'Test User',
+            'phone': '+442083661180',
+            'mobile': '+442083661180',
+            'parent_id': company.id,
+        })
+        # Contact of the company with the company number.
+        contact = self.env['res.partner'].create({
+            'name': 'Other User',
+            'phone': '+442083661181',
+            'parent_id': company.id,
+        })
+        Index.rebuild()
+        self.assertEqual(Index.lookup(['+442083661180']),
+                         (partner.id, 'Test User (Test Company)'))
+        # Resolved as by search_by_number.
+        self.assertEqual(Index.lookup(['+442083661181'])[0], contact.id)
+        self.assertEqual(Index.search([('number', '=', '+442083661180')]).suffix,
+                         '081166380244')
+
+    def test_caller_index_update(self):
+        Index = self.env['asterisk_plus.caller_index']
+        company = self.env['res.partner'].create({
+            'name': 'Test Company',
+            'is_company': True,
+            'phone': '+442083661191',
+        })
+        contact = self.env['res.partner'].create({
+            'name': 'Test User',
+            'phone': '+442083661190',
+            'parent_id': company.id,
+        })
+        self.assertEqual(company._get_indexed_numbers(children=False),
+                         {'+442083661191'})
+        self.assertEqual(company._get_indexed_numbers(),
+                         {'+442083661191', '+442083661190'})
+        self.assertEqual(
+            self.env['res.partner'].search_by_numbers(
+                ['+442083661190', '+442083661191', '+442083661192']),
+            {'+442083661190': contact, '+442083661191': company,
+             '+442083661192': None})
+        company.name = 'New Company'
+        self.assertEqual(Index.lookup(['+442083661190']),
+                         (contact.id, 'Test User (New Company)'))
+        # Numbers are evicted and the version bumped once per transaction.
+        self.env.cr.postcommit.clear()
+        with patch.object(type(self.env.cr.postcommit), 'add') as add:
+            Index._forget_unknown(['+442083661190'])
+            Index._forget_unknown(['+442083661191'])
+            Index.clear_unknown()
+        self.assertEqual(add.call_count, 2)
+
+    def test_unknown_numbers(self):
+        key = (self.env.cr.dbname, '+442083661179')
+        unknown_numbers.discard(key)
+        self.assertEqual(self.env['res.partner'].get_partner_by_number(
+            '+442083661179'), {'name': _('Unknown'), 'id': False})
+        self.assertIn(key, unknown_numbers)
+        partner = self.env['res.partner'].create({
+            'name': 'Test User',
+            'phone': '+442083661179',
+        })
+        self.assertNotIn(key, unknown_numbers)
+        self.assertEqual(self.env['res.partner'].get_partner_by_number(
+            '+442083661179')['id'], partner.id)
+
+    def test_number_cache(self):
+        cache = NumberCache(size=2, ttl=60)
+        cache.add('a')
+        cache.add('b')
+        cache.add('c')
+        self.assertNotIn('a', cache)
+        self.assertIn('c', cache)
+        cache.ttl = -1
+        cache.add('d')
+        self.assertNotIn('d', cache)
+        # Numbers changed by other workers.
+        cache.ttl = 60
+        key = (self.env.cr.dbname, 'e')
+        cache.check_version(self.env.cr)
+        cache.add(key)
+        self.env['asterisk_plus.caller_index']._bump_version()
+        cache.check_version(self.env.cr)
+        self.assertIn(key, cache)
+        with patch.object(caller_index, 'VERSION_CHECK_INTERVAL', 0):
+            cache.check_version(self.env.cr)
+        self.assertNotIn(key, cache)
+
+    def test_get_caller_info(self):
+        tag = self.env['res.partner.category'].create({'name': 'VIP'})
+        partner = self.env['res.partner'].create({
+            'name': 'Test User',
+            'phone': '+442083661180',
+            'category_id': [(6, 0, [tag.id])],
+        })
+        res = self.env['res.partner'].get_caller_info(
+            ['+442083661180', '+442083661181'])
+        self.assertEqual(res['+442083661180']['partner'], partner.id)
+        self.assertEqual(res['+442083661180']['name'], 'Test User')
+        self.assertEqual(res['+442083661180']['tags'], ['VIP'])
+        self.assertFalse(res['+442083661181']['partner'])
+        self.assertEqual(res['+442083661181']['name'], '')
+
+    def test_recompute_phone_normalized(self):
+        gb = self.env['res.country'].search([('code', '=', 'GB')])
+        partners = self.env['res.partner'].create([{
+            'name': 'Test User {}'.format(k),
+            'phone': '020 8366 118{}'.format(k),
+            'country_id': gb.id,
+        } for k in range(3)])
+        self.assertEqual(partners.mapped('phone_normalized'), [
+            '+44208366118{}'.format(k) for k in range(3)])
+        self.env.cr.execute(
+            'UPDATE res_partner SET phone_normalized = NULL WHERE id IN %s',
+            (tuple(partners.ids),))
+        partners.invalidate_cache()
+        count = self.env['res.partner'].with_context(
+            no_commit=True).recompute_phone_normalized(batch_size=2)
+        self.assertGreaterEqual(count, 3)
+        self.assertEqual(partners.mapped('phone_normalized'), [
+            '+44208366118{}'.format(k) for k in range(3)])
+        self.assertEqual(self.env['res.partner'].get_partner_by_number(
+            '+442083661181')['id'], partners[1].id)
+        # Recompute by the cron.
+        self.env.cr.execute(
+            'UPDATE res_partner SET phone_normalized = NULL WHERE id IN %s',
+            (tuple(partners.ids),))
+        partners.invalidate_cache()
+        Settings = self.env['asterisk_plus.settings'].with_context(
+            no_commit=True)
+        Settings.search([], limit=1).recompute_phone_numbers()
+        self.assertEqual(Settings.get_phone_recompute()['state'], 'running')
+        while Settings.get_phone_recompute()['state'] == 'running':
+            Settings.process_phone_recompute(batches=1, batch_size=1000)
+        self.assertGreaterEqual(Settings.get_phone_recompute()['count'], 3)
+        self.assertEqual(partners.mapped('phone_normalized'), [
+            '+44208366118{}'.format(k) for k in range(3)])
+
+    def test_format_number(self):
+        phone_number.clear_cache()
+        self.assertEqual(phone_number.format_number('2083661171', 'GB'),
+                         '+442083661171')
+        self.assertEqual(phone_number.format_number('2083661171', 'GB'),
+                         '+442083661171')
+        self.assertEqual(phone_number.format_number(
+            '2083661171', 'GB', 'international'), '+44 20 8366 1171')
+        self.assertEqual(phone_number.format_number(
+            '2083661171', 'GB', 'out_of_country', 'US'), '011 44 20 8366 1171')
+        self.assertEqual(phone_number.format_number('abc', 'GB'), 'abc')
+        stats = self.env['asterisk_plus.settings'].get_number_format_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 4)
+
+    def test_country_code_cache(self):
+        gb = self.env['res.country'].search([('code', '=', 'GB')])
+        us = self.env['res.country'].search([('code', '=', 'US')])
+        company = self.env['res.partner'].create({
+            'name': 'Test Company',
+            'is_company': True,
+            'country_id': gb.id,
+        })
+        partner = self.env['res.partner'].create({
+            'name': 'Test User',
+            'parent_id': company.id,
+        })
+        self.assertEqual(partner._get_country_code(), 'GB')
+        company.country_id = us
+        self.assertEqual(partner._get_country_code(), 'US')
+        partner.country_id = gb
+        self.assertEqual(partner._get_country_code(), 'GB')
+        # Unchanged values sent by forms keep the cache.
+        with patch.object(self.registry, '_clear_cache') as clear_cache:
+            partner.write({'country_id': gb.id, 'parent_id': company.id})
+            self.assertFalse(clear_cache.called)
+            partner.write({'country_id': us.id})
+            self.assertTrue(clear_cache.called)
+
+    def test_suffix_match(self):
+        Index = self.env['asterisk_plus.caller_index']
+        partner = self.env['res.partner'].create({
+            'name': 'Test User',
+            'phone': '+442083661190',
+        })
+        self.env['asterisk_plus.settings'].set_param(
+            'caller_id_suffix_digits', 0)
+        self.assertIsNone(Index.lookup(['02083661190']))
+        self.env['asterisk_plus.settings'].set_param(
+            'caller_id_suffix_digits', 9)
+        self.assertEqual(Index.lookup(['02083661190']),
+                         (partner.id, 'Test User'))
+        # Too short number.
+        self.assertIsNone(Index.lookup(['61190']))
+        # Ambiguous match.
+        self.env['res.partner'].create({
+            'name': 'Other User',
+            'phone': '+12083661190',
+        })
+        self.assertIsNone(Index.lookup(['02083661190']))
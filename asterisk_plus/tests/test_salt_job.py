@@ -0,0 +1,103 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+from datetime import datetime, timedelta
+import json
+from odoo.addons.asterisk_plus.models import salt_job
+from odoo.addons.asterisk_plus.models.server import Server
+from odoo.tests.common import TransactionCase
+from unittest.mock import MagicMock, patch
+
+
+def salt_return(jid, ret=True):
+    return {
+        'jid': jid,
+        'return': ret,
+        'retcode': 0,
+        'id': 'asterisk',
+        'fun': 'test.ping',
+        'fun_args': [],
+        'success': True,
+    }
+
+
+class TestSaltJob(TransactionCase):
+
+    def setUp(self):
+        super(TestSaltJob, self).setUp()
+        self.SaltJob = self.env['asterisk_plus.salt_job']
+        # Jobs are looked up in the test transaction instead of a new one.
+        cursor = MagicMock()
+        cursor.return_value.__enter__.return_value = self.env.cr
+        for patcher in [patch.object(self.registry, 'cursor', cursor),
+                        patch.object(salt_job, 'JOB_LOOKUP_DELAY', 0)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_claim_job(self):
+        job = self.SaltJob.create({
+            'fun': 'test.ping',
+            'jid': 'test-1',
+            'res_model': 'asterisk_plus.server',
+            'res_method': 'ping_reply',
+            'pass_back': json.dumps({'uid': self.env.uid}),
+        })
+        with patch.object(Server, 'ping_reply', return_value=True) as reply:
+            self.assertTrue(self.SaltJob.returner(salt_return('test-1')))
+            reply.assert_called_once_with(True, {'uid': self.env.uid})
+            job.invalidate_cache()
+            self.assertEqual(job.status, 'done')
+            self.assertTrue(job.completed_at)
+            self.assertEqual(job.success, 'True')
+            # The job is already claimed by the first return.
+            self.assertFalse(self.SaltJob.returner(salt_return('test-1')))
+            self.assertEqual(reply.call_count, 1)
+            # Unknown job.
+            self.assertFalse(self.SaltJob.returner(salt_return('test-2')))
+
+    def test_claim_job_poll(self):
+        # The job is registered by another transaction after a few attempts.
+        job = {'res_model': False, 'res_method': False,
+               'res_notify_uid': 0, 'pass_back': False}
+        with patch.object(type(self.SaltJob), '_claim_job_query',
+                          side_effect=[None, None, None, job]) as claim, \
+                patch.object(type(self.env.cr.postrollback), 'add') as postrollback:
+            self.assertEqual(self.SaltJob._claim_job('test-3', True), job)
+            self.assertEqual(claim.call_count, 4)
+            # The job is put back to pending if the callback fails.
+            postrollback.assert_called_once()
+        with patch.object(type(self.SaltJob), '_claim_job_query',
+                          return_value=None) as claim:
+            self.assertIsNone(self.SaltJob._claim_job('test-4', True))
+            self.assertEqual(claim.call_count,
+                             salt_job.JOB_LOOKUP_ATTEMPTS + 1)
+
+    def test_reopen_job(self):
+        job = self.SaltJob.create({'jid': 'test-4.1'})
+        self.assertTrue(self.SaltJob._claim_job('test-4.1', True))
+        job.invalidate_cache()
+        self.assertEqual(job.status, 'done')
+        self.SaltJob._reopen_job('test-4.1')
+        job.invalidate_cache()
+        self.assertEqual(job.status, 'pending')
+        self.assertFalse(job.completed_at)
+
+    def test_delete_jobs(self):
+        now = datetime.utcnow()
+        jobs = self.SaltJob.create([{'jid': 'test-5.{}'.format(k)}
+                                    for k in range(4)])
+        # Done jobs are kept for hours, pending jobs for 7 * hours.
+        dates = [
+            ('done', now - timedelta(hours=25), now - timedelta(hours=25)),
+            ('done', now - timedelta(hours=1), now - timedelta(hours=25)),
+            ('pending', None, now - timedelta(hours=25)),
+            ('pending', None, now - timedelta(hours=24 * 7 + 1)),
+        ]
+        for job, (status, completed_at, create_date) in zip(jobs, dates):
+            self.env.cr.execute("""
+                UPDATE asterisk_plus_salt_job
+                SET status = %s, completed_at = %s, create_date = %s
+                WHERE id = %s""", (status, completed_at, create_date, job.id))
+        jobs.invalidate_cache()
+        count = self.SaltJob.with_context(no_commit=True).delete_jobs(
+            hours=24, batch_size=1)
+        self.assertGreaterEqual(count, 2)
+        self.assertEqual(jobs.exists(), jobs[1] | jobs[2])
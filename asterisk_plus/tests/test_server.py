@@ -1,6 +1,9 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+import json
+import time
 from odoo.tests import tagged
 from  odoo.addons.asterisk_plus.models.server import Server
+from odoo.addons.asterisk_plus.models.server import PooledPepper, saltapi_pool
 from odoo.tests.common import TransactionCase
 from unittest.mock import patch, call
 from unittest.mock import MagicMock
@@ -88,3 +91,104 @@ class ServerTest(TransactionCase):
             self.env['bus.bus'].search([], order='id desc', limit=1).message,
             '{"message":"Extension does not exist.","title":"PBX","sticky":false,"warning":true}'
         )
+
+    def test_local_jobs(self):
+        saltapi = MagicMock()
+        saltapi.low.return_value = {'return': [
+            {'jid': '20210928122846179815', 'minions': ['test']},
+            {'jid': '20210928122846179816', 'minions': ['test']},
+        ]}
+        cursor = MagicMock()
+        cursor.return_value.__enter__.return_value = self.env.cr
+        with patch.object(Server, '_saltapi_call',
+                          side_effect=lambda func: func(saltapi)), \
+                patch.object(self.registry, 'cursor', cursor):
+            ret = self.env['asterisk_plus.server'].local_jobs([
+                (self.server, 'test.ping', None, None, None),
+                (self.server, 'asterisk.manager_action',
+                 [{'Action': 'Ping'}], {'timeout': 5}, {
+                     'timeout': 10,
+                     'res_model': 'asterisk_plus.server',
+                     'res_method': 'ping_reply',
+                     'res_notify_uid': self.env.uid,
+                     'pass_back': {'uid': self.env.uid}}),
+            ])
+        self.assertEqual(ret, saltapi.low.return_value['return'])
+        saltapi.low.assert_called_once_with([
+            {'client': 'local_async', 'tgt': 'test', 'fun': 'test.ping',
+             'expr_form': 'glob', 'ret': 'odoo'},
+            {'client': 'local_async', 'tgt': 'test',
+             'fun': 'asterisk.manager_action', 'expr_form': 'glob',
+             'ret': 'odoo', 'arg': [{'Action': 'Ping'}],
+             'kwarg': {'timeout': 5}, 'timeout': 10},
+        ])
+        jobs = self.env['asterisk_plus.salt_job'].search(
+            [('jid', 'in', [r['jid'] for r in ret])], order='jid')
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(jobs.mapped('fun'),
+                         ['test.ping', 'asterisk.manager_action'])
+        self.assertEqual(jobs.mapped('status'), ['pending', 'pending'])
+        self.assertFalse(jobs[0].res_model)
+        self.assertFalse(jobs[0].pass_back)
+        self.assertEqual(jobs[1].res_model, 'asterisk_plus.server')
+        self.assertEqual(jobs[1].res_method, 'ping_reply')
+        self.assertEqual(jobs[1].res_notify_uid, self.env.uid)
+        self.assertEqual(json.loads(jobs[1].pass_back), {'uid': self.env.uid})
+        # Minion is not accepted for one of the jobs.
+        saltapi.low.return_value = {'return': [
+            {}, {'jid': '20210928122846179817', 'minions': ['test']}]}
+        with patch.object(Server, '_saltapi_call',
+                          side_effect=lambda func: func(saltapi)), \
+                patch.object(self.registry, 'cursor', cursor):
+            ret = self.env['asterisk_plus.server'].local_jobs([
+                (self.server, 'test.ping', None, None, None),
+                (self.server, 'test.version', None, None, None),
+            ])
+        self.assertEqual(ret[0], {})
+        jobs = self.env['asterisk_plus.salt_job'].search(
+            [('jid', '=', '20210928122846179817')])
+        self.assertEqual(jobs.fun, 'test.version')
+        # No request without jobs.
+        saltapi.low.reset_mock()
+        self.assertEqual(self.env['asterisk_plus.server'].local_jobs([]), [])
+        saltapi.low.assert_not_called()
+
+    def test_saltapi_ensure_login(self):
+        saltapi = PooledPepper('http://localhost:8000')
+        with patch.object(saltapi, 'login') as login:
+            # No token yet.
+            self.assertIs(saltapi.ensure_login('user', 'pass'), saltapi)
+            login.assert_called_once_with('user', 'pass', 'file')
+            # The token is valid.
+            login.reset_mock()
+            saltapi.auth = {'token': 'test', 'expire': time.time() + 3600}
+            saltapi.ensure_login('user', 'pass')
+            login.assert_not_called()
+            # The token is about to expire.
+            saltapi.auth['expire'] = time.time() + 30
+            saltapi.ensure_login('user', 'pass')
+            login.assert_called_once_with('user', 'pass', 'file')
+            # Authentication denied with a valid token.
+            login.reset_mock()
+            saltapi.auth['expire'] = time.time() + 3600
+            saltapi.ensure_login('user', 'pass', force=True)
+            login.assert_called_once_with('user', 'pass', 'file')
+
+    def test_saltapi_pool(self):
+        dbname = self.env.cr.dbname
+        url = 'http://localhost:8000'
+        Settings = self.env['asterisk_plus.settings']
+        Settings.set_param('saltapi_url', url)
+        saltapi = saltapi_pool.get(dbname, url)
+        self.assertIsInstance(saltapi, PooledPepper)
+        self.assertIs(saltapi_pool.get(dbname, url), saltapi)
+        self.assertIsNot(saltapi_pool.get(dbname, 'http://salt:8000'), saltapi)
+        other = saltapi_pool.get('asterisk_plus_other_db', url)
+        self.assertIsNot(other, saltapi)
+        # Salt API settings change drops clients of this database only.
+        Settings.set_param('saltapi_url', 'http://salt:8000')
+        self.assertIsNot(saltapi_pool.get(dbname, url), saltapi)
+        self.assertIs(saltapi_pool.get('asterisk_plus_other_db', url), other)
+        saltapi_pool.clear('asterisk_plus_other_db')
+        self.assertIsNot(saltapi_pool.get('asterisk_plus_other_db', url), other)
+        saltapi_pool.clear('asterisk_plus_other_db')
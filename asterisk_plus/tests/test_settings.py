@@ -0,0 +1,21 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+from odoo.tests.common import TransactionCase
+
+
+class TestSettings(TransactionCase):
+
+    def test_is_ip_permitted(self):
+        Settings = self.env['asterisk_plus.settings']
+        Settings.set_param('permit_ip_addresses', '')
+        self.assertTrue(Settings.is_ip_permitted('10.0.0.1'))
+        Settings.set_param('permit_ip_addresses',
+                           '127.0.0.1, 10.0.0.0/24,bad,2001:db8::/32')
+        self.assertTrue(Settings.is_ip_permitted('127.0.0.1'))
+        self.assertTrue(Settings.is_ip_permitted('10.0.0.254'))
+        self.assertTrue(Settings.is_ip_permitted('2001:db8::1'))
+        self.assertFalse(Settings.is_ip_permitted('10.0.1.1'))
+        self.assertFalse(Settings.is_ip_permitted('not an address'))
+        # Settings write invalidates parsed networks.
+        Settings.set_param('permit_ip_addresses', '10.0.1.0/24')
+        self.assertTrue(Settings.is_ip_permitted('10.0.1.1'))
+        self.assertFalse(Settings.is_ip_permitted('127.0.0.1'))
@@ -47,3 +47,20 @@ class TestUserChannel(TransactionCase):
             user_channel.with_user(self.test_user).write({
                 'originate_context': 'test-context',
             })
+
+    def test_get_user_channel(self):
+        user_channel = self.env['asterisk_plus.user_channel'].create({
+                'name': 'PJSIP/1001',
+                'asterisk_user': self.asterisk_user.id,
+            })
+        system_name = user_channel.system_name
+        get_user_channel = self.env['asterisk_plus.user_channel'].get_user_channel
+        self.assertEqual(
+            get_user_channel('PJSIP/1001-0000abcd', system_name), user_channel)
+        self.assertFalse(get_user_channel('PJSIP/1002-0000abcd', system_name))
+        # Cache is invalidated on user channel change.
+        user_channel.name = 'Local/1001@from-internal'
+        self.assertFalse(get_user_channel('PJSIP/1001-0000abcd', system_name))
+        self.assertEqual(
+            get_user_channel('Local/1001@from-internal-00000023;1', system_name),
+            user_channel)
@@ -33,34 +33,30 @@ class CallbackChannel(models.Model):
             channel.callback.status = 'failed'
         return channel_id
 
-    @api.model
-    def on_ami_hangup(self, event):
-        channel_id = super(CallbackChannel, self).on_ami_hangup(event)
-        if channel_id:
-            try:
-                channel = self.env['asterisk_plus.channel'].browse(channel_id)
-                # Check for the situation when channel originate did not succeed normally
-                # but it is not a failure (channel busy). In this case both Hangup and 
-                # OriginateResponse come but Hangup comes later.
-                if channel.callback and channel.callback.status == 'failed' and \
-                        channel.cause != '16':
-                    # Restore callback status that was set on OriginateResponse.
-                    channel.callback.status = 'progress'
-                    debug(self, 'Restoring callback status to progress.')                
-                elif channel.callback:
-                    if event['Cause'] == '16' and not channel.callback.done_by_event:
-                        # Normal Clearing, set callback status to done.
-                        channel.callback.status = 'done'
-                        debug(self, 'Channel {} callback done.'.format(channel.channel))
-                    elif event['Cause'] == '16' and channel.callback.done_by_event:
-                        debug(self, 'Channel {} ignore normal call clearing as'
-                                    ' waiting for done event.'.format(channel.channel))
-                    else:
-                        debug(self, 'Channel callback {} status not done'.format(channel.channel))
-                elif channel.parent_channel.callback:
-                    debug(self, 'Not setting done by leg 2 hangup.')
+    def _on_ami_hangup_done(self, channel, event):
+        super(CallbackChannel, self)._on_ami_hangup_done(channel, event)
+        try:
+            # Check for the situation when channel originate did not succeed normally
+            # but it is not a failure (channel busy). In this case both Hangup and 
+            # OriginateResponse come but Hangup comes later.
+            if channel.callback and channel.callback.status == 'failed' and \
+                    channel.cause != '16':
+                # Restore callback status that was set on OriginateResponse.
+                channel.callback.status = 'progress'
+                debug(self, 'Restoring callback status to progress.')                
+            elif channel.callback:
+                if event['Cause'] == '16' and not channel.callback.done_by_event:
+                    # Normal Clearing, set callback status to done.
+                    channel.callback.status = 'done'
+                    debug(self, 'Channel {} callback done.'.format(channel.channel))
+                elif event['Cause'] == '16' and channel.callback.done_by_event:
+                    debug(self, 'Channel {} ignore normal call clearing as'
+                                ' waiting for done event.'.format(channel.channel))
                 else:
-                    debug(self, 'Channel {} does not belong to callback'.format(channel.channel))
-            except Exception:
-                logger.exception('Callback on_ami_hangup error')
-        return channel_id
+                    debug(self, 'Channel callback {} status not done'.format(channel.channel))
+            elif channel.parent_channel.callback:
+                debug(self, 'Not setting done by leg 2 hangup.')
+            else:
+                debug(self, 'Channel {} does not belong to callback'.format(channel.channel))
+        except Exception:
+            logger.exception('Callback on_ami_hangup error')
@@ -1,3 +1,5 @@
 from .import call
 from .import crm_lead
+from .import crm_stage
+from .import res_partner
 from .import settings
\ No newline at end of file
@@ -27,24 +27,32 @@ class CrmCall(models.Model):
                 self.ref = lead
                 return True
 
+    def _get_end_call_jobs(self):
+        return super(CrmCall, self)._get_end_call_jobs() + [
+            'auto_create_missed_call_lead']
+
+    def _get_auto_create_leads_params(self):
+        get_param = self.env['asterisk_plus.settings'].get_param
+        return (get_param('auto_create_leads_from_calls'),
+                get_param('auto_create_leads_missed_calls_only'),
+                get_param('auto_create_leads_sales_person'))
+
     @api.constrains('is_active', 'direction')
     def auto_create_lead(self):
-        auto_create_leads = self.env['asterisk_plus.settings'].get_param(
-            'auto_create_leads_from_calls')
-        only_missed = self.env[
-            'asterisk_plus.settings'].get_param(
-            'auto_create_leads_missed_calls_only')
-        default_sales_person = self.env[
-            'asterisk_plus.settings'].get_param(
-            'auto_create_leads_sales_person')
+        """Match or create a lead on incoming call start. Call end is processed
+        in auto_create_missed_call_lead from the call jobs queue.
+        """
+        auto_create_leads, only_missed, default_sales_person = \
+            self._get_auto_create_leads_params()
         for rec in self:            
-            if not self.direction == 'in' or rec.ref:
+            if not rec.direction == 'in' or rec.ref or not rec.is_active:
                 # We only do it for incoming calls without reference.
                 continue
-            if not rec.is_active:
-                # Call end
-                if auto_create_leads and only_missed and rec.status != 'answered':
-                    debug(self, 'CREATE LEAD FROM MISSED CALL')
+            # Call start
+            lead = self.env['crm.lead'].get_lead_by_number(rec.calling_number)
+            if not lead:
+                if auto_create_leads and not only_missed:
+                    debug(self, 'CREATE LEAD FROM CALL START')
                     lead = self.env['crm.lead'].create({
                         'name': rec.calling_name,
                         'type': 'lead',
@@ -54,23 +62,26 @@ class CrmCall(models.Model):
                     })
                     rec.ref = lead
             else:
-                # Call start
-                lead = self.env['crm.lead'].get_lead_by_number(self.calling_number)
-                if not lead:
-                    if auto_create_leads and not only_missed:
-                        debug(self, 'CREATE LEAD FROM CALL START')
-                        lead = self.env['crm.lead'].create({
-                            'name': rec.calling_name,
-                            'type': 'lead',
-                            'user_id': rec.called_user.id or default_sales_person.id,
-                            'partner_id': rec.partner.id,
-                            'phone': rec.calling_number,
-                        })
-                        rec.ref = lead
-                else:
-                    # Lead found
-                    rec.ref = lead
+                # Lead found
+                rec.ref = lead
 
+    def auto_create_missed_call_lead(self):
+        auto_create_leads, only_missed, default_sales_person = \
+            self._get_auto_create_leads_params()
+        for rec in self:
+            if not rec.direction == 'in' or rec.ref or rec.is_active:
+                continue
+            # Call end
+            if auto_create_leads and only_missed and rec.status != 'answered':
+                debug(self, 'CREATE LEAD FROM MISSED CALL')
+                lead = self.env['crm.lead'].create({
+                    'name': rec.calling_name,
+                    'type': 'lead',
+                    'user_id': rec.called_user.id or default_sales_person.id,
+                    'partner_id': rec.partner.id,
+                    'phone': rec.calling_number,
+                })
+                rec.ref = lead
 
     def lead_button(self):
         self.ensure_one()
@@ -1,35 +1,54 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
+from collections import defaultdict
 import logging
-from phonenumbers import phonenumberutil
-import phonenumbers
-from odoo import api, models, tools, fields, release, _
+from psycopg2.extras import execute_values
+from odoo import api, models, fields, tools, release, _
 from odoo.exceptions import ValidationError, UserError
 from odoo.addons.asterisk_plus.models.settings import debug
+from odoo.addons.asterisk_plus.models.caller_index import NumberCache
+from odoo.addons.asterisk_plus.models.phone_number import format_number
+from odoo.addons.asterisk_plus.models.res_partner import normalize_number
 
 logger = logging.getLogger(__name__)
 
+#: Lead fields that affect lead lookup by number.
+LEAD_NUMBER_FIELDS = {'phone', 'mobile', 'country_id', 'partner_id',
+                      'stage_id', 'active'}
+
+#: Numbers that have no open lead.
+unknown_numbers = NumberCache()
+
+
+def normalize_lead_number(number, country_code):
+    number = normalize_number(number, country_code)
+    # Strip the number if no phone validation installed or parse error.
+    number = number.replace(' ', '')
+    number = number.replace('(', '')
+    number = number.replace(')', '')
+    number = number.replace('-', '')
+    return number
+
 
 class Lead(models.Model):
     _inherit = 'crm.lead'
 
     asterisk_calls_count = fields.Integer(compute='_get_asterisk_calls_count',
                                           string=_('Calls'))
+    # Indexed by partial indexes on active leads, see init().
     phone_normalized = fields.Char(compute='_get_phone_normalized',
-                                   index=True, store=True)
+                                   store=True)
     mobile_normalized = fields.Char(compute='_get_phone_normalized',
-                                    index=True, store=True)
+                                    store=True)
 
-    def write(self, values):
-        res = super(Lead, self).write(values)
-        if res:
-            self.pool.clear_caches()
-        return res
-
-    def unlink(self):
-        res = super(Lead, self).unlink()
-        if res:
-            self.pool.clear_caches()
-        return res
+    def init(self):
+        # Only active leads are matched by number.
+        for column in ('phone_normalized', 'mobile_normalized'):
+            index = 'crm_lead_active_{}_index'.format(column)
+            if not tools.index_exists(self.env.cr, index):
+                self.env.cr.execute("""
+                    CREATE INDEX {0} ON crm_lead ({1})
+                    WHERE active = true AND {1} IS NOT NULL""".format(
+                        index, column))
 
     @api.model
     def create(self, vals):        
@@ -46,35 +65,118 @@ class Lead(models.Model):
         except Exception as e:
             logger.exception(e)
         res = super(Lead, self).create(vals)
-        if res:
-            self.pool.clear_caches()
+        res._forget_unknown_numbers()
+        return res
+
+    def write(self, values):
+        res = super(Lead, self).write(values)
+        if LEAD_NUMBER_FIELDS.intersection(values):
+            self._forget_unknown_numbers()
         return res
 
+    def unlink(self):
+        self._forget_unknown_numbers()
+        return super(Lead, self).unlink()
+
+    def _write(self, vals):
+        res = super(Lead, self)._write(vals)
+        # Stored numbers are also recomputed without write(), e.g. when
+        # the lead partner phone is changed.
+        if 'phone_normalized' in vals or 'mobile_normalized' in vals:
+            self.env['asterisk_plus.caller_index']._forget_unknown(
+                [vals.get('phone_normalized'), vals.get('mobile_normalized')],
+                cache=unknown_numbers)
+        return res
+
+    def _forget_unknown_numbers(self):
+        numbers = set()
+        for rec in self:
+            numbers.update([rec.phone_normalized, rec.mobile_normalized])
+        self.env['asterisk_plus.caller_index']._forget_unknown(
+            numbers, cache=unknown_numbers)
+
     @api.depends('phone', 'mobile', 'country_id', 'partner_id', 'partner_id.phone', 'partner_id.mobile')
     def _get_phone_normalized(self):
-        for rec in self:            
-            if release.version_info[0] >= 14:
-                # Odoo > 14.0
-                if rec.phone:
-                    rec.phone_normalized = rec.normalize_phone(rec.phone)
-                if rec.mobile:
-                    rec.mobile_normalized = rec.normalize_phone(rec.mobile)
-            else:
-                # Old Odoo versions
-                if rec.partner_id:
-                    # We have partner set, take phones from him.
-                    if rec.partner_address_phone:
-                        rec.phone_normalized = rec.normalize_phone(
-                            rec.partner_address_phone)
-                    if rec.partner_address_mobile:
-                        rec.mobile_normalized = rec.normalize_phone(
-                            rec.partner_address_mobile)
-                else:
-                    # No partner set takes phones from lead.
-                    if rec.phone:
-                        rec.phone_normalized = rec.normalize_phone(rec.phone)
-                    if rec.mobile:
-                        rec.mobile_normalized = rec.normalize_phone(rec.mobile)
+        numbers = self._get_normalized_numbers()
+        for rec in self:
+            rec.phone_normalized, rec.mobile_normalized = numbers[rec.id]
+
+    def _get_lead_numbers(self):
+        self.ensure_one()
+        if release.version_info[0] < 14 and self.partner_id:
+            # Old Odoo versions: we have partner set, take phones from him.
+            return self.partner_address_phone, self.partner_address_mobile
+        return self.phone, self.mobile
+
+    def _get_normalized_numbers(self):
+        """Normalize phone and mobile numbers of many leads at once.
+        Leads are grouped by country and every number is parsed once.
+
+        Returns:
+            A dictionary lead ID -> (phone_normalized, mobile_normalized).
+        """
+        by_country = defaultdict(list)
+        for rec in self:
+            by_country[rec._get_country_code()].append(rec)
+        res = {}
+        for country_code, leads in by_country.items():
+            parsed = {}
+            for rec in leads:
+                values = []
+                for number in rec._get_lead_numbers():
+                    if number and number not in parsed:
+                        parsed[number] = normalize_lead_number(
+                            number, country_code)
+                    values.append(parsed[number] if number else False)
+                res[rec.id] = tuple(values)
+        return res
+
+    @api.model
+    def recompute_phone_normalized(self, batch_size=5000):
+        """Recompute normalized numbers of all leads. Changed numbers are
+        written with one SQL update per batch.
+        """
+        count = last_id = 0
+        while last_id is not None:
+            last_id, changed = self.recompute_phone_batch(last_id, batch_size)
+            count += changed
+            if not self.env.context.get('no_commit'):
+                self.env.cr.commit()
+        return count
+
+    @api.model
+    def recompute_phone_batch(self, last_id, batch_size):
+        """Recompute normalized numbers of leads with ID after last_id.
+
+        Returns:
+            (last processed ID or None when there are no more leads,
+            number of changed leads) tuple.
+        """
+        Lead = self.sudo().with_context(active_test=False)
+        self.env.cr.execute("""
+            SELECT id FROM crm_lead WHERE id > %s
+            ORDER BY id LIMIT %s""", (last_id, batch_size))
+        leads = Lead.browse([k[0] for k in self.env.cr.fetchall()])
+        if not leads:
+            return None, 0
+        numbers = leads._get_normalized_numbers()
+        changed = [
+            (rec.id, numbers[rec.id][0] or None, numbers[rec.id][1] or None)
+            for rec in leads if numbers[rec.id] != (
+                rec.phone_normalized or False, rec.mobile_normalized or False)]
+        if changed:
+            execute_values(self.env.cr, """
+                UPDATE crm_lead l
+                SET phone_normalized = v.phone, mobile_normalized = v.mobile
+                FROM (VALUES %s) AS v(id, phone, mobile)
+                WHERE l.id = v.id""", changed)
+            self.env['asterisk_plus.caller_index']._forget_unknown(
+                [n for k in changed for n in k[1:]], cache=unknown_numbers)
+        last_id = leads[-1].id
+        logger.info('Lead numbers recomputed: %s changed up to ID %s.',
+                    len(changed), last_id)
+        self.invalidate_cache()
+        return last_id, len(changed)
 
     def _get_country_code(self):
         if self and self.country_id:
@@ -88,23 +190,7 @@ class Lead(models.Model):
 
     def normalize_phone(self, number):
         self.ensure_one()
-        country_code = self._get_country_code()
-        try:
-            phone_nbr = phonenumbers.parse(number, country_code)
-            if phonenumbers.is_possible_number(phone_nbr) or \
-                    phonenumbers.is_valid_number(phone_nbr):
-                number = phonenumbers.format_number(
-                    phone_nbr, phonenumbers.PhoneNumberFormat.E164)
-        except phonenumbers.phonenumberutil.NumberParseException:
-            pass
-        except Exception as e:
-            logger.warning('Normalize phone error: %s', e)
-        # Strip the number if no phone validation installed or parse error.
-        number = number.replace(' ', '')
-        number = number.replace('(', '')
-        number = number.replace(')', '')
-        number = number.replace('-', '')
-        return number
+        return normalize_lead_number(number, self._get_country_code())
 
     def _get_asterisk_calls_count(self):
         for rec in self:
@@ -112,47 +198,60 @@ class Lead(models.Model):
                 'asterisk_plus.call'].search_count(
                     [('res_id', '=', rec.id), ('model', '=', 'crm.lead')])
 
+    @api.model
+    @tools.ormcache()
+    def _get_open_stage_ids(self):
+        """Stages of open leads. Invalidated on stages change.
+        """
+        return tuple(self.env['crm.stage'].sudo().search(
+            [('is_won', '=', False)]).ids)
+
     def _search_lead_by_number(self, number):
-        # Odoo < 12 does not have partner_address_phone field.
-        open_stages_ids = [k.id for k in self.env['crm.stage'].search(
-            [('is_won', '=', False)])]
+        return self._search_lead_by_numbers([number])
+
+    def _search_lead_by_numbers(self, numbers):
+        """Return the last open lead with any of the numbers.
+        """
+        numbers = list({k for k in numbers if k})
+        if not numbers:
+            return
+        open_stages_ids = self._get_open_stage_ids()
         debug(self, open_stages_ids)
         domain = [
             ('active', '=', True),
             ('stage_id', 'in', open_stages_ids),
             '|',
-            ('phone_normalized', '=', number),
-            ('mobile_normalized', '=', number)]
+            ('phone_normalized', 'in', numbers),
+            ('mobile_normalized', 'in', numbers)]
         # Get last open lead
-        found = self.env['crm.lead'].search(domain, order='id desc')
-        if len(found) == 1:
-            debug(self, 'FOUND LEAD {} BY NUMBER {}'.format(found[0].id, number))
-            return found[0]
-        elif len(found) > 1:
-            logger.warning('[ASTCALLS] MULTIPLE LEADS FOUND BY NUMBER %s', number)
-            return found[0]
-        else:
-            debug(self, 'LEAD BY NUMBER {} NOT FOUND'.format(number))
+        found = self.env['crm.lead'].search(domain, order='id desc', limit=1)
+        if found:
+            debug(self, 'FOUND LEAD {} BY NUMBERS {}'.format(found.id, numbers))
+            return found
+        debug(self, 'LEAD BY NUMBERS {} NOT FOUND'.format(numbers))
 
-    @tools.ormcache('number', 'country_code')
     def get_lead_by_number(self, number, country_code=None):
         if not number or 'unknown' in number or number == 's':
             debug(self, 'GET LEAD BY NUMBER NO NUMBER PASSED')
             return
         lead = None
-        # 1. Convert to E.164 and make a search
         e164_number = self._format_number(
             number, country_code=country_code, format_type='e164')
-        lead = self._search_lead_by_number(e164_number)
-        # 2. Make a search as as.
-        if not lead:
-            lead = self._search_lead_by_number(number)
-        # 3. Add + and make a search.
-        if not lead:
-            number_plus = '+' + number if number[0] != '+' else number
-            lead = self._search_lead_by_number(number_plus)
+        number_plus = '+' + number if number[0] != '+' else number
+        keys = [(self.env.cr.dbname, k)
+                for k in (e164_number, number, number_plus)]
+        unknown_numbers.check_version(self.env.cr)
+        if all(k in unknown_numbers for k in keys):
+            debug(self, 'GET LEAD BY NUMBER {} UNKNOWN'.format(number))
+            return
+        # Search by E.164 number, number as is and number with + at once.
+        lead = self._search_lead_by_numbers(
+            [e164_number, number, number_plus])
         debug(self, 'GET LEAD BY NUMBER RESULT: {}'.format(
             lead.id if lead else None))
+        if not lead:
+            for key in keys:
+                unknown_numbers.add(key)
         return lead
 
     def _format_number(self, number, country_code=None, format_type='e164'):
@@ -168,28 +267,13 @@ class Lead(models.Model):
                 'COUNTRY FOR LEAD %s CODE %s', self, country_code)
         elif not country_code:
             # Get country code for requesting account
-            country_code = self.env.user.partner_id._get_country_code()
+            country_code = self.env['res.partner']._get_user_country_code()
             logger.debug(self, 'LEAD GOT COUNTRY CODE %s FROM ENV USER', country_code)
         elif not country_code:
             logger.debug(self, 'LEAD COULD NOT GET COUNTRY CODE')
-        if country_code is False:
-            # False -> None
-            country_code = None
-        try:
-            phone_nbr = phonenumbers.parse(number, country_code)
-            if not phonenumbers.is_possible_number(phone_nbr):
-                logger.debug(self, 'LEAD PHONE NUMBER {} NOT POSSIBLE'.format(number))
-            elif not phonenumbers.is_valid_number(phone_nbr):
-                logger.debug(self, 'LEAD PHONE NUMBER {} NOT VALID'.format(number))
-            elif format_type == 'e164':
-                number = phonenumbers.format_number(
-                    phone_nbr, phonenumbers.PhoneNumberFormat.E164)
-                logger.debug(self, 'LEAD E164 FORMATTED NUMBER: {}'.format(number))
-            else:
-                logger.error('LEAD WRONG FORMATTING PASSED: %s', format_type)
-        except phonenumberutil.NumberParseException:
-            logger.debug(self, 'LEAD PHONE NUMBER {} PARSE ERROR'.format(number))
-        except Exception:
-            logger.exception('LEAD FORMAT NUMBER ERROR:')
-        finally:
+        if format_type != 'e164':
+            logger.error('LEAD WRONG FORMATTING PASSED: %s', format_type)
             return number
+        number = format_number(number, country_code, format_type)
+        logger.debug('LEAD FORMATTED NUMBER: %s', number)
+        return number
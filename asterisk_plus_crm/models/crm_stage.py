@@ -0,0 +1,29 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+from odoo import models, api
+
+
+class Stage(models.Model):
+    _inherit = 'crm.stage'
+
+    @api.model
+    def create(self, vals):
+        res = super(Stage, self).create(vals)
+        # Open stages are cached for lead lookup by number.
+        self._clear_open_stage_ids()
+        return res
+
+    def write(self, vals):
+        res = super(Stage, self).write(vals)
+        if 'is_won' in vals:
+            self._clear_open_stage_ids()
+        return res
+
+    def unlink(self):
+        res = super(Stage, self).unlink()
+        self._clear_open_stage_ids()
+        return res
+
+    @api.model
+    def _clear_open_stage_ids(self):
+        Lead = self.env['crm.lead']
+        Lead._get_open_stage_ids.clear_cache(Lead)
@@ -0,0 +1,17 @@
+# ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2021
+from odoo import models, api
+
+
+class Partner(models.Model):
+    _inherit = 'res.partner'
+
+    @api.model
+    def get_caller_info(self, numbers, country_code=None):
+        res = super(Partner, self).get_caller_info(numbers, country_code)
+        for number, info in res.items():
+            lead = self.env['crm.lead'].sudo().get_lead_by_number(
+                number, country_code)
+            info['lead'] = lead.id if lead else False
+            if lead:
+                info['reference'] = 'crm.lead,{}'.format(lead.id)
+        return res
@@ -1,5 +1,5 @@
 # ©️ OdooPBX by Odooist, Odoo Proprietary License v1.0, 2020
-from odoo import fields, models
+from odoo import api, fields, models
 
 
 class CallsCrmSettings(models.Model):
@@ -13,3 +13,8 @@ class CallsCrmSettings(models.Model):
         'res.users',
         domain=[('share', '=', False)],
         string='Default Salesperson')
+
+    @api.model
+    def _get_phone_recompute_models(self):
+        return super(CallsCrmSettings, self)._get_phone_recompute_models() + [
+            'crm.lead']
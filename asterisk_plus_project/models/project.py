@@ -31,7 +31,4 @@ class Project(models.Model):
                     vals['partner_id'] = call.partner.id
         except Exception as e:
             logger.exception(e)
-        res = super(Project, self).create(vals)
-        if res:
-            self.pool.clear_caches()
-        return res
+        return super(Project, self).create(vals)
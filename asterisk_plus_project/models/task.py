@@ -31,7 +31,4 @@ class Task(models.Model):
                     vals['partner_id'] = call.partner.id
         except Exception as e:
             logger.exception(e)
-        res = super(Task, self).create(vals)
-        if res:
-            self.pool.clear_caches()
-        return res
+        return super(Task, self).create(vals)